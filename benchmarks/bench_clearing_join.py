@@ -0,0 +1,118 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import duckdb
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'duckdb_script')))
+
+# the duckdb scripts open data.duckdb in the working directory at import, keep it out of the repo
+os.chdir(tempfile.mkdtemp(prefix="bench_clearing_join_"))
+from every_datetime_demand import every_datetime_demand_sql
+from given_datetime_final_price import curves_sql, CURVES_TABLE
+
+# the inequality join + ROW_NUMBER query every_datetime_demand used before
+legacy_every_datetime_demand_sql = """
+    WITH joined_data AS (
+    SELECT C.*, U.usep_price, U.demand_mw
+    FROM merit_cumulative_volumn C LEFT JOIN user_validation U
+    on C.date = U.date and C.period = U.period
+    where C.cumulative_bid_volumn >= U.demand_mw
+    ),
+    ranked_data AS (
+    SELECT *, ROW_NUMBER() OVER (
+        PARTITION BY date, period
+        ORDER BY cumulative_bid_volumn ASC
+    ) AS rn
+    FROM joined_data
+    )
+    SELECT date, period, demand_mw, bid_price as final_bid_price, cumulative_bid_volumn
+    FROM ranked_data
+    WHERE rn = 1
+    ORDER BY date, period
+"""
+
+# ASOF join alternative, kept to show how it scales next to the other two
+asof_every_datetime_demand_sql = """
+    SELECT C.date, C.period, U.demand_mw, C.bid_price AS final_bid_price, C.cumulative_bid_volumn
+    FROM user_validation U
+    ASOF JOIN merit_cumulative_volumn C
+    ON U.date = C.date
+    AND U.period = C.period
+    AND C.cumulative_bid_volumn >= U.demand_mw
+    ORDER BY C.date, C.period
+"""
+
+# synthetic user_validation and merit_cumulative_volumn, demand sits in the middle of every merit curve
+def build_tables(con, days, offers_per_period):
+    con.execute(f"""
+    CREATE OR REPLACE TABLE merit_cumulative_volumn AS
+    SELECT
+        DATE '2023-01-01' + CAST(d AS INTEGER) AS date,
+        CAST(p AS INTEGER) AS period,
+        CAST(o AS DOUBLE) * 1.5 + hash(d, p, o) % 100 / 100.0 AS bid_price,
+        10.0 AS bid_volumn,
+        10.0 * (o + 1) AS cumulative_bid_volumn
+    FROM range({days}) t1(d), range(1, 49) t2(p), range({offers_per_period}) t3(o)
+    ORDER BY date, period, bid_price
+    """)
+    # built once next to merit_cumulative_volumn by refresh_cumulative_table, timed on its own
+    start = time.perf_counter()
+    con.execute(f"CREATE OR REPLACE TABLE {CURVES_TABLE} AS " + curves_sql.format(where=""))
+    curves_seconds = time.perf_counter() - start
+    con.execute(f"""
+    CREATE OR REPLACE TABLE user_validation AS
+    SELECT
+        CAST(DATE '2023-01-01' + CAST(d AS INTEGER) AS TIMESTAMP) AS date,
+        CAST(p AS INTEGER) AS period,
+        100.0 AS usep_price,
+        10.0 * {offers_per_period} * (0.1 + (hash(d, p) % 800) / 1000.0) AS demand_mw
+    FROM range({days}) t1(d), range(1, 49) t2(p)
+    """)
+    return curves_seconds
+
+def time_query(con, sql, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = con.execute(sql).fetchall()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def run(days, offers, repeat):
+    con = duckdb.connect()
+    queries = {
+        'legacy_join': legacy_every_datetime_demand_sql,
+        'asof_join': asof_every_datetime_demand_sql,
+        'curve_search': every_datetime_demand_sql,
+    }
+    results = []
+    for offers_per_period in offers:
+        curves_seconds = build_tables(con, days, offers_per_period)
+        result = {'days': days, 'offers_per_period': offers_per_period, 'merit_rows': days * 48 * offers_per_period,
+                  'curves_build_seconds': curves_seconds}
+        expected_rows = None
+        for name, sql in queries.items():
+            seconds, rows = time_query(con, sql, repeat)
+            if expected_rows is not None and rows != expected_rows:
+                raise AssertionError(f"{name} result differs from the legacy join for {offers_per_period} offers per period")
+            expected_rows = rows
+            result[f"{name}_seconds"] = seconds
+        results.append(result)
+        print(f"{offers_per_period:>6} offers/period: " + ", ".join(f"{name} {result[f'{name}_seconds']:.4f}s" for name in queries)
+              + f" (merit_curves built once in {curves_seconds:.4f}s)")
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='benchmark the every_datetime_demand clearing join against offers per period')
+    parser.add_argument('--days', type=int, default=31, help='number of days of periods')
+    parser.add_argument('--offers', type=int, nargs='+', default=[10, 100, 1000, 5000], help='offers per period to measure')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per query, best time is kept')
+    parser.add_argument('--output', default=None, help='write the results as json to this file')
+    args = parser.parse_args()
+    results = run(args.days, args.offers, args.repeat)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,98 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+
+USEP_COLUMNS = ["INFORMATION TYPE", "DATE", "PERIOD", "USEP ($/MWh)", "LCP ($/MWh)", "DEMAND (MW)", "TCL (MW)"]
+MERIT_COLUMNS = ["Date", "Period", "Lowest to Highest Offer Price ($/MWh)", "Total Offer Capacity At Specified Offer Price (MW)"]
+MERIT_PREAMBLE = "Delayed Offer Stacks (Energy)\nSynthetic data generated for benchmarks\n"
+
+
+def month_starts(start, months):
+    return pd.date_range(pd.Timestamp(start), periods=months, freq="MS")
+
+
+def usep_file_name(month_start):
+    return f"USEP_{month_start.strftime('%b-%Y')}.csv"
+
+
+def merit_file_name(month_start):
+    month_end = month_start + pd.offsets.MonthEnd(0)
+    return f"DelayedOfferStacks_Energy_{month_start.strftime('%d-%b-%Y')} to {month_end.strftime('%d-%b-%Y')}.csv"
+
+
+# one row per (date, period) with a demand curve peaking in the evening, in the raw USEP format
+def generate_usep_month(month_start, rng, mixed_date_rate=0.01, invalid_date_rate=0.002):
+    days = pd.date_range(month_start, month_start + pd.offsets.MonthEnd(0), freq="D")
+    dates = np.repeat(days, 48)
+    periods = np.tile(np.arange(1, 49), len(days))
+    demand = 5500 + 800 * np.sin((periods - 14) / 48 * 2 * np.pi) + rng.normal(0, 120, len(periods))
+    usep = np.round(np.maximum(0, 40 + demand / 30 + rng.gamma(2, 20, len(periods))), 2)
+
+    date_strings = pd.Series(dates.strftime("%d %b %Y"))
+    # the raw files mix date formats and carry a few impossible dates such as '40 Jan 2024'
+    mixed = rng.random(len(date_strings)) < mixed_date_rate
+    date_strings[mixed] = dates[mixed].strftime("%d-%b-%Y")
+    invalid = rng.random(len(date_strings)) < invalid_date_rate
+    date_strings[invalid] = "40 " + dates[invalid].strftime("%b %Y")
+
+    return pd.DataFrame({
+        "INFORMATION TYPE": "USEP",
+        "DATE": date_strings,
+        "PERIOD": periods,
+        "USEP ($/MWh)": usep,
+        "LCP ($/MWh)": 0,
+        "DEMAND (MW)": np.round(demand, 3),
+        "TCL (MW)": 0,
+    }, columns=USEP_COLUMNS)
+
+
+# offers_per_period ascending price steps per (date, period), total capacity always above the demand
+def generate_merit_month(month_start, offers_per_period, rng, peak_demand=7500.0):
+    days = pd.date_range(month_start, month_start + pd.offsets.MonthEnd(0), freq="D")
+    n_periods = len(days) * 48
+    step_prices = np.cumsum(rng.gamma(1.5, 2000.0 / (1.5 * offers_per_period), (n_periods, offers_per_period)), axis=1) - 50
+    step_volumes = rng.dirichlet(np.ones(offers_per_period), n_periods) * peak_demand * rng.uniform(1.3, 1.8, (n_periods, 1))
+
+    return pd.DataFrame({
+        "Date": np.repeat(days.strftime("%d-%b-%Y"), 48 * offers_per_period),
+        "Period": np.repeat(np.tile(np.arange(1, 49), len(days)), offers_per_period),
+        "Lowest to Highest Offer Price ($/MWh)": np.round(step_prices.ravel(), 2),
+        "Total Offer Capacity At Specified Offer Price (MW)": np.round(step_volumes.ravel(), 1),
+    }, columns=MERIT_COLUMNS)
+
+
+def generate_market_data(output_dir, months=1, offers_per_period=50, start="2023-01-01", seed=0):
+    """
+    Args:
+        output_dir: folder to write the raw USEP and DelayedOfferStacks csv files to
+        months: number of monthly file pairs
+        offers_per_period: offer steps of every (date, period) in the merit files
+
+    Returns:
+        list of written file paths
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for month_start in month_starts(start, months):
+        usep_path = os.path.join(output_dir, usep_file_name(month_start))
+        generate_usep_month(month_start, rng).to_csv(usep_path, index=False, lineterminator="\r\n")
+        merit_path = os.path.join(output_dir, merit_file_name(month_start))
+        with open(merit_path, "w") as f:
+            f.write(MERIT_PREAMBLE)
+            generate_merit_month(month_start, offers_per_period, rng).to_csv(f, index=False)
+        paths += [usep_path, merit_path]
+    return paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='generate synthetic USEP and DelayedOfferStacks files')
+    parser.add_argument('--output-dir', default="raw_data", help='folder for the generated files')
+    parser.add_argument('--months', type=int, default=1, help='number of months to generate')
+    parser.add_argument('--offers', type=int, default=50, help='offer steps per period')
+    parser.add_argument('--start', default="2023-01-01", help='first month')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+    for path in generate_market_data(args.output_dir, args.months, args.offers, args.start, args.seed):
+        print(path)
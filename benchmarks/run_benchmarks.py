@@ -0,0 +1,191 @@
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import contextlib
+import subprocess
+from datetime import datetime
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(REPO_DIR)
+sys.path.append(os.path.join(REPO_DIR, 'duckdb_script'))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import matplotlib
+matplotlib.use("Agg")
+from generate_data import generate_market_data, month_starts, usep_file_name, merit_file_name
+import stage_metrics
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class BenchmarkRecorder:
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.results = {}
+
+    def measure(self, name, func, rows=None, repeat=None):
+        """Run func repeat times, keep the best wall time, return the last result"""
+        best = float("inf")
+        result = None
+        for _ in range(repeat or self.repeat):
+            # the functions under test print DataFrames, keep them out of the report
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                result = func()
+                best = min(best, time.perf_counter() - start)
+        self.results[name] = {
+            'seconds': best,
+            'rows': rows,
+            'rows_per_second': rows / best if rows and best > 0 else None,
+        }
+        print(f"{name:<45} {best:>10.4f}s" + (f" {rows:>12,} rows" if rows else ""))
+        return result
+
+    def set_rows(self, name, rows):
+        """Rows for a benchmark whose row count is only known after it ran"""
+        result = self.results[name]
+        result['rows'] = rows
+        result['rows_per_second'] = rows / result['seconds'] if result['seconds'] > 0 else None
+
+
+def run_pandas_benchmarks(recorder, raw_dir, start, queries):
+    import pandas as pd
+    import util
+    from check_final_price import check_final_price
+    from plot_merit_order import plot_merit_table
+
+    usep_path = os.path.join(raw_dir, usep_file_name(month_starts(start, 1)[0]))
+    merit_path = os.path.join(raw_dir, merit_file_name(month_starts(start, 1)[0]))
+
+    raw_usep = pd.read_csv(usep_path)
+    raw_usep.columns = util.standardize_columns(raw_usep.columns)
+    recorder.measure("clean_mixed_date_column", lambda: util.clean_mixed_date_column(raw_usep.copy()), rows=len(raw_usep))
+    df_usep = recorder.measure("cleansed_usep_table", lambda: util.cleansed_usep_table(usep_path), rows=len(raw_usep))
+    df_merit = recorder.measure("cleansed_merit_table", lambda: util.cleansed_merit_table(merit_path))
+    recorder.set_rows("cleansed_merit_table", len(df_merit))
+    merit_with_index = recorder.measure("generate_datetime_index", lambda: util.generate_datetime_index(df_merit.copy()), rows=len(df_merit))
+
+    lookups = list(zip(
+        pd.DatetimeIndex(df_usep['date'][:queries]).strftime("%Y-%m-%d"),
+        df_usep['period'][:queries],
+        df_usep['demand'][:queries],
+    ))
+
+    def select_and_check():
+        for date_str, period, demand in lookups:
+            curve, max_vol = util.cumulative_vol_for_certain_period(util.select_certain_period(merit_with_index, date_str, period))
+            check_final_price(curve, demand, max_vol)
+    recorder.measure("select_certain_period+check_final_price", select_and_check, rows=len(lookups))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        curve, _ = util.cumulative_vol_for_certain_period(util.select_certain_period(merit_with_index, lookups[0][0], lookups[0][1]))
+    recorder.measure("plot_merit_table", lambda: plot_merit_table(curve), rows=len(curve), repeat=1)
+
+
+def run_duckdb_benchmarks(recorder, queries):
+    import load_file
+    import duckdb_cleansed_file
+    import given_datetime_final_price
+    import every_datetime_demand
+    import analysis_duckdb
+
+    recorder.measure("duckdb load_file.load_files_into_db", load_file.load_files_into_db, repeat=1)
+    con = load_file.con
+    merit_rows = con.execute("SELECT count(*) FROM RAW_MERIT_TABLE").fetchone()[0]
+    recorder.set_rows("duckdb load_file.load_files_into_db", merit_rows)
+    recorder.measure("duckdb cleansing_tables", duckdb_cleansed_file.cleansing_tables, rows=merit_rows)
+
+    def rebuild_cumulative():
+        con.execute("DROP TABLE IF EXISTS merit_cumulative_volumn")
+        given_datetime_final_price.refresh_cumulative_table()
+    recorder.measure("duckdb merit_cumulative_volumn build", rebuild_cumulative, rows=merit_rows)
+
+    lookups = con.execute(
+        "SELECT strftime(date, '%Y-%m-%d'), period, demand_mw FROM user_validation ORDER BY date, period LIMIT ?", [queries]
+    ).fetchall()
+
+    def given_datetime_queries():
+        for date_str, period, demand in lookups:
+            given_datetime_final_price.given_datetime_final_price(date_str, period, demand)
+    recorder.measure("duckdb given_datetime_final_price", given_datetime_queries, rows=len(lookups))
+
+    demand_rows = con.execute("SELECT count(*) FROM user_validation").fetchone()[0]
+    recorder.measure("duckdb every_datetime_demand", every_datetime_demand.every_datetime_demand, rows=demand_rows)
+
+    for name in ("demand_limit_by_date", "period_for_MAX_demand", "demand_fprice_by_date", "peak_demand_identification", "price_volatility_analysis"):
+        sql = getattr(analysis_duckdb, name)
+        recorder.measure(f"duckdb analysis {name}", lambda: con.execute(sql).fetchall(), rows=demand_rows)
+    recorder.measure("duckdb analysis run_analyses", lambda: analysis_duckdb.run_analyses(force=True), rows=demand_rows)
+    recorder.measure("duckdb analysis run_analyses cached", analysis_duckdb.run_analyses, rows=demand_rows)
+
+
+# wall time of the entry points answering --help, they must not load the data stack
+def run_startup_benchmarks(recorder):
+    for script in ("check_final_price.py", "plot_merit_order.py", "cleansed_file.py", "price_service.py"):
+        command = [sys.executable, os.path.join(REPO_DIR, script), "--help"]
+        recorder.measure(f"startup {script} --help", lambda: subprocess.run(command, capture_output=True, check=True))
+
+
+def run(months, offers, start, queries, repeat, workdir):
+    raw_dir = os.path.join(workdir, "raw_data")
+    duckdb_dir = os.path.join(workdir, "duckdb_script")
+    for folder in (raw_dir, duckdb_dir, os.path.join(workdir, "cleansed_data")):
+        os.makedirs(folder, exist_ok=True)
+    start_time = time.perf_counter()
+    generate_market_data(raw_dir, months, offers, start)
+    print(f"generated {months} months with {offers} offers per period in {time.perf_counter() - start_time:.1f}s")
+
+    recorder = BenchmarkRecorder(repeat)
+    run_startup_benchmarks(recorder)
+    # the scripts resolve raw_data/, cleansed_data/ and data.duckdb against the working directory
+    os.chdir(workdir)
+    run_pandas_benchmarks(recorder, raw_dir, start, queries)
+    os.chdir(duckdb_dir)
+    run_duckdb_benchmarks(recorder, queries)
+
+    return {
+        'commit': git_commit(),
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'params': {'months': months, 'offers_per_period': offers, 'start': start, 'queries': queries, 'repeat': repeat},
+        'results': recorder.results,
+        # per-stage breakdown of everything above, summed over the repeats
+        'stages': stage_metrics.report()['stages'],
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='run the pipeline benchmarks on synthetic market data')
+    parser.add_argument('--months', type=int, default=1, help='months of raw data to generate')
+    parser.add_argument('--offers', type=int, default=50, help='offer steps per period')
+    parser.add_argument('--start', default="2023-01-01", help='first generated month')
+    parser.add_argument('--queries', type=int, default=100, help='clearing price lookups per lookup benchmark')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per benchmark, best time is kept')
+    parser.add_argument('--output', default="bench_results.json", help='json file for the results')
+    parser.add_argument('--keep-workdir', action='store_true', help='keep the generated data and database')
+    args = parser.parse_args()
+
+    output_path = os.path.abspath(args.output)
+    workdir = tempfile.mkdtemp(prefix="assessment_bench_")
+    try:
+        report = run(args.months, args.offers, args.start, args.queries, args.repeat, workdir)
+    finally:
+        os.chdir(REPO_DIR)
+        if args.keep_workdir:
+            print(f"work directory kept at {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    with open(output_path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"results written to {output_path}")
@@ -1,11 +1,18 @@
-import pandas as pd
+from lazy_import import lazy_import
 from logger_config import setup_logger
+from stage_metrics import stage, timed_stage
 import argparse
-from util import select_certain_period, cumulative_vol_for_certain_period, validate_date
+import os
+import columnar_store
+from merit_index import MeritIndex, MERIT_INDEX_PATH, ERROR_NAMES
+from util import select_certain_period, cumulative_vol_for_certain_period, validate_date, read_cleansed_table
 
+pd = lazy_import("pandas")
 # Initialize logger
 logger = setup_logger('check_final_price')
 
+MERIT_CLEANSED_PATH = "cleansed_data/merit_cleansed.csv"
+
 # to plot merit table for certain date and period, and 
 # def cumulative_vol_for_certain_period(df, date_str, period): 
 
@@ -20,6 +27,7 @@ def non_negative_demand_number(value:float):
         
     return fvalue
 
+@timed_stage("check_final_price")
 def check_final_price(df, demand: float, max_vol: float):
     if demand > max_vol:
         raise ValueError(f"Demand {demand} exceeds maximum capacity {max_vol}")
@@ -35,12 +43,105 @@ def check_final_price(df, demand: float, max_vol: float):
         raise ValueError(f"Error finding clearing price: {str(e)}")
 
 
+# open the precomputed merit curves, or build them in memory from the cleansed merit table
+def load_merit_index(compact=False):
+    if os.path.exists(MERIT_INDEX_PATH):
+        return MeritIndex.open(MERIT_INDEX_PATH)
+    logger.warning(f"{MERIT_INDEX_PATH} not found, building merit curves from {MERIT_CLEANSED_PATH}")
+    return MeritIndex.from_frame(read_cleansed_table(MERIT_CLEANSED_PATH, compact=compact))
+
+# clearing price for many (date, period, demand) queries in one vectorized pass
+@timed_stage("batch_check_final_price", rows=len)
+def batch_check_final_price(merit_index, queries):
+    """
+    Args:
+        merit_index: MeritIndex with the merit curves, or any engine of clearing_engines
+        queries: DataFrame with date, period and demand columns
+
+    Returns:
+        copy of queries with final_price (NaN when failed) and error columns,
+        bad rows are flagged instead of raising
+    """
+    dates = pd.to_datetime(queries['date'], errors='coerce').to_numpy(dtype='datetime64[D]')
+    periods = pd.to_numeric(queries['period'], errors='coerce').fillna(0).to_numpy(dtype='int64')
+    demands = pd.to_numeric(queries['demand'], errors='coerce').to_numpy(dtype='float64')
+    prices, errors = merit_index.clearing_prices(dates, periods, demands)
+
+    result = queries.copy()
+    result['final_price'] = prices
+    result['error'] = pd.Series(errors, index=queries.index).map(ERROR_NAMES)
+    failed = int((errors != 0).sum())
+    if failed:
+        logger.warning(f"{failed} of {len(queries)} queries have no clearing price")
+    return result
+
+# capacity offered up to a price cap and the headroom to the next price step for many (date, period, price) queries
+@timed_stage("batch_supply_at_price", rows=len)
+def batch_supply_at_price(merit_index, queries):
+    """
+    Args:
+        merit_index: MeritIndex with the merit curves
+        queries: DataFrame with date, period and price columns
+
+    Returns:
+        copy of queries with offered_volume, marginal_step, marginal_price, next_price,
+        price_headroom, next_step_volume and error columns, bad rows are flagged instead of raising
+    """
+    dates = pd.to_datetime(queries['date'], errors='coerce').to_numpy(dtype='datetime64[D]')
+    periods = pd.to_numeric(queries['period'], errors='coerce').fillna(0).to_numpy(dtype='int64')
+    price_caps = pd.to_numeric(queries['price'], errors='coerce').to_numpy(dtype='float64')
+    supply = merit_index.supply_at_prices(dates, periods, price_caps)
+
+    result = queries.copy()
+    errors = supply.pop('error')
+    for column, values in supply.items():
+        result[column] = values
+    result['error'] = pd.Series(errors, index=queries.index).map(ERROR_NAMES)
+    failed = int((errors != 0).sum())
+    if failed:
+        logger.warning(f"{failed} of {len(queries)} price queries have no supply curve")
+    return result
+
+def supply_batch_main(args):
+    with stage("read_csv.queries") as run:
+        queries = pd.read_csv(args.supply_batch)
+        run.rows = len(queries)
+    logger.info(f"read {len(queries)} price queries from {args.supply_batch}")
+    result = batch_supply_at_price(load_merit_index(getattr(args, 'compact', False)), queries)
+    result.to_csv(args.output, index=False)
+    print(f"{len(result)} supply lookups written to {args.output}")
+
+def batch_main(args):
+    with stage("read_csv.queries") as run:
+        queries = pd.read_csv(args.batch)
+        run.rows = len(queries)
+    logger.info(f"read {len(queries)} queries from {args.batch}")
+    from clearing_engines import AUTO, select_engine, open_engine
+    compact = getattr(args, 'compact', False)
+    engine_name = getattr(args, 'engine', AUTO)
+    engine = select_engine(queries, compact) if engine_name == AUTO else open_engine(engine_name, compact)
+    result = batch_check_final_price(engine, queries)
+    result.to_csv(args.output, index=False)
+    print(f"{len(result)} clearing prices from the {engine.name} engine written to {args.output}")
 
 def main(args):
-    merit_fulltable = pd.read_csv("merit_cleansed.csv", index_col=0, parse_dates=True)
-    logger.info("read cleansed user table")
-    # only select the certain date and period merit data
-    selected_merit_table = select_certain_period(merit_fulltable, args.date, args.period)
+    # precomputed merit curves answer the lookup without loading any table
+    if os.path.exists(MERIT_INDEX_PATH):
+        with stage("merit_index.clearing_price", rows=1):
+            final_price = MeritIndex.open(MERIT_INDEX_PATH).clearing_price(args.date, args.period, args.demand)
+        logger.info("clearing price found from merit index")
+        print(f"based on the demand {args.demand}, final clearing price is {final_price}")
+        return
+
+    # only load the partition of the certain date and period when the columnar store exists
+    if columnar_store.has_partition(columnar_store.MERIT_STORE, args.date):
+        selected_merit_table = columnar_store.read_period(columnar_store.MERIT_STORE, args.date, args.period, columns=['bid_price', 'bid_volumn'])
+        logger.info("read merit partition from columnar store")
+    else:
+        merit_fulltable = read_cleansed_table(MERIT_CLEANSED_PATH, compact=getattr(args, 'compact', False))
+        logger.info("read cleansed user table")
+        # only select the certain date and period merit data
+        selected_merit_table = select_certain_period(merit_fulltable, args.date, args.period)
     # new column to count the cumulative merit volumn, and get the max capacity
     certain_time_merit_data, max_vol = cumulative_vol_for_certain_period(selected_merit_table)
     final_price = check_final_price(certain_time_merit_data, args.demand, max_vol)
@@ -51,14 +152,26 @@ def main(args):
 if __name__ == "__main__":
     # 1st param is for date, 2nd param is for period to choose
     parser = argparse.ArgumentParser(description='input date, period data and demand')
-    parser.add_argument('--date', required=True, type=validate_date, help='Target date (YYYY-MM-DD)')
+    parser.add_argument('--date', type=validate_date, help='Target date (YYYY-MM-DD)')
     #ensure period only be integar beween 1-48
     parser.add_argument('--period', type=int, choices=range(1, 49), 
                       help='30-min period (1-48)')
     #ensure demand only be the non-negative num
-    parser.add_argument('--demand', required=True, type=non_negative_demand_number, help='Non-negative demand value (can be integer or float)')
-    # parser.add_argument('--output', default='result.csv', help='Output file path')
+    parser.add_argument('--demand', type=non_negative_demand_number, help='Non-negative demand value (can be integer or float)')
+    # batch mode: csv file with date, period, demand columns
+    parser.add_argument('--batch', help='CSV file of date, period, demand queries')
+    parser.add_argument('--engine', choices=("auto", "numpy", "pandas", "duckdb"), default="auto",
+                        help='engine answering --batch (default: chosen by data and batch size, see clearing_engines.choose_engine)')
+    # inverse batch mode: csv file with date, period, price columns
+    parser.add_argument('--supply-batch', help='CSV of date, period, price queries for the capacity offered up to each price')
+    parser.add_argument('--output', default='clearing_prices.csv', help='Output file path for --batch or --supply-batch')
+    parser.add_argument('--compact', action='store_true', help='load the cleansed merit table with compact dtypes')
     args = parser.parse_args()
-    main(args)
-    
-
+    if args.batch:
+        batch_main(args)
+    elif args.supply_batch:
+        supply_batch_main(args)
+    else:
+        if args.date is None or args.demand is None:
+            parser.error("--date and --demand are required unless --batch or --supply-batch is given")
+        main(args)
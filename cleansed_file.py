@@ -1,37 +1,152 @@
-import pandas as pd
-import re
-import logging
-from logger_config import setup_logger
+from logger_config import setup_logger, init_worker_logging, worker_log_queue
+from stage_metrics import stage, worker_call, worker_result
 from util import clean_mixed_date_column,generate_datetime_index,cleansed_usep_table,cleansed_merit_table
 import os
-import numpy
 import util
-from datetime import datetime
-from functools import wraps
+import columnar_store
+from merit_index import build_merit_index, build_merit_index_from_csv, MERIT_INDEX_PATH
 import sys
+import argparse
+import glob
+from concurrent.futures import ProcessPoolExecutor, as_completed
 # adds the current working directory
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 # Initialize logger
 logger = setup_logger('clean_file')
 
-print("Current working directory:", os.getcwd())
-print("Files in ../raw_data/:", os.listdir("raw_data/"))
-
-def cleansed_file():
-    merit_file_path = "raw_data/DelayedOfferStacks_Energy_01-Jan-2023 to 31-Jan-2023.csv"
-    usep_file_path = "raw_data/USEP_Jan-2023.csv"
-    df_usep = util.cleansed_usep_table(usep_file_path)
-    df_merit = util.cleansed_merit_table(merit_file_path)
-    logger.info("user table and merit table columns cleaned and converted.")
+MERIT_RAW_PATH = "raw_data/DelayedOfferStacks_Energy_01-Jan-2023 to 31-Jan-2023.csv"
+USEP_RAW_PATH = "raw_data/USEP_Jan-2023.csv"
+MERIT_OUTPUT_PATH = "cleansed_data/merit_cleansed.csv"
+USEP_OUTPUT_PATH = "cleansed_data/user_cleansed.csv"
+# rows breaking a data-quality rule, with the rules they broke
+MERIT_QUARANTINE_PATH = "cleansed_data/merit_quarantine.csv"
+USEP_QUARANTINE_PATH = "cleansed_data/user_quarantine.csv"
 
+def cleanse_usep_file(compact=False):
+    df_usep = util.cleansed_usep_table(USEP_RAW_PATH, compact=compact, quarantine_path=USEP_QUARANTINE_PATH)
     df_usep_with_index = util.generate_datetime_index(df_usep)
+    logger.info("write user table to /cleansed_data folder.")
+    with stage("write_csv.user", rows=len(df_usep_with_index)):
+        df_usep_with_index.to_csv(USEP_OUTPUT_PATH)
+    if columnar_store.store_available():
+        columnar_store.write_partitioned(df_usep_with_index, columnar_store.USEP_STORE)
+
+def cleanse_merit_file(chunksize=None, compact=False):
+    # stream the merit file chunk by chunk when it is too big to hold in memory
+    if chunksize:
+        store_root = columnar_store.MERIT_STORE if columnar_store.store_available() else None
+        stats = util.stream_cleansed_merit_table(MERIT_RAW_PATH, MERIT_OUTPUT_PATH, chunksize=chunksize, store_root=store_root, compact=compact, quarantine_path=MERIT_QUARANTINE_PATH)
+        logger.info(f"merit table streamed to /cleansed_data folder: {stats}")
+        if stats is None:
+            # the lookups would keep answering from the previous cleanse
+            if os.path.exists(MERIT_INDEX_PATH):
+                os.remove(MERIT_INDEX_PATH)
+            return
+        # the whole table is never in memory here, the index is built from the written output
+        build_merit_index_from_csv(MERIT_OUTPUT_PATH, MERIT_INDEX_PATH)
+        return
+
+    df_merit = util.cleansed_merit_table(MERIT_RAW_PATH, compact=compact, quarantine_path=MERIT_QUARANTINE_PATH)
+    logger.info("user table and merit table columns cleaned and converted.")
     df_merit_with_index = util.generate_datetime_index(df_merit)
     logger.info("created index for user table and merit table.")
-    merit_file_output_path = "cleansed_data/merit_cleansed.csv"
-    usep_file_output_path = "cleansed_data/user_cleansed.csv"
-    logger.info("write merit and user table to /cleansed_data folder.")
-    df_usep_with_index.to_csv(usep_file_output_path)
-    df_merit_with_index.to_csv(merit_file_output_path)
+    logger.info("write merit table to /cleansed_data folder.")
+    with stage("write_csv.merit", rows=len(df_merit_with_index)):
+        df_merit_with_index.to_csv(MERIT_OUTPUT_PATH)
+    # typed, date-partitioned copy so readers only load the date they need
+    if columnar_store.store_available():
+        columnar_store.write_partitioned(df_merit_with_index, columnar_store.MERIT_STORE)
+    # sorted bid prices and cumulative volumes of every period for the clearing price lookups
+    build_merit_index(df_merit_with_index, MERIT_INDEX_PATH)
+
+def cleansed_file(chunksize=None, compact=False):
+    logger.debug("cleansing raw files in %s", os.path.abspath("raw_data"))
+    cleanse_usep_file(compact)
+    cleanse_merit_file(chunksize, compact)
+
+# raw file name prefix -> (file kind, cleansing function, columnar store)
+RAW_FILE_KINDS = {
+    "USEP": ("user", util.cleansed_usep_table, columnar_store.USEP_STORE),
+    "DelayedOfferStacks": ("merit", util.cleansed_merit_table, columnar_store.MERIT_STORE),
+}
+
+def raw_file_kind(file_path):
+    name = os.path.basename(file_path)
+    for prefix, kind in RAW_FILE_KINDS.items():
+        if name.startswith(prefix):
+            return kind
+    return None
+
+# worker: cleanse one raw file and write its own output partition
+def cleanse_raw_file(file_path, output_dir="cleansed_data", compact=False):
+    kind, cleansing_function, store_root = raw_file_kind(file_path)
+    stem = os.path.splitext(os.path.basename(file_path))[0]
+    quarantine_path = os.path.join(output_dir, f"{kind}_quarantine_{stem}.csv")
+    df = cleansing_function(file_path, compact=compact, quarantine_path=quarantine_path)
+    if df is None:
+        raise ValueError(f"cleansing failed for {file_path}, see the util log")
+    df_with_index = util.generate_datetime_index(df)
+
+    output_path = os.path.join(output_dir, f"{kind}_cleansed_{stem}.csv")
+    df_with_index.to_csv(output_path)
+    if columnar_store.store_available():
+        # monthly files do not share dates, so each file replaces only its own date partitions
+        columnar_store.write_partitioned(df_with_index, os.path.join(output_dir, os.path.basename(store_root)),
+                                         basename_template=f"{stem}-{{i}}.parquet")
+    return output_path, len(df_with_index)
+
+# cleanse many raw files across a process pool, failures are collected instead of stopping the run
+def cleansed_files_parallel(raw_files, output_dir="cleansed_data", workers=None, compact=False):
+    """
+    Args:
+        raw_files: raw USEP / DelayedOfferStacks csv files
+        output_dir: folder for the per-file cleansed csv and the columnar store
+        workers: number of processes, os.cpu_count() when None
+        compact: cleanse with compact dtypes (see util.compact_dtypes)
+
+    Returns:
+        (outputs, failures): {raw file: (output path, rows)} and {raw file: error message}
+    """
+    outputs, failures = {}, {}
+    raw_files = [path for path in raw_files if raw_file_kind(path)]
+    os.makedirs(output_dir, exist_ok=True)
+    # the workers log through this process, which alone writes the log file
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker_logging, initargs=(worker_log_queue(),)) as executor:
+        futures = {executor.submit(worker_call, cleanse_raw_file, path, output_dir, compact): path for path in raw_files}
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                outputs[path] = worker_result(future)
+                logger.info(f"cleansed {path} -> {outputs[path][0]} ({outputs[path][1]} rows)")
+            except Exception as e:
+                failures[path] = str(e)
+                logger.error(f"failed to cleanse {path}: {e}")
+    logger.info(f"{len(outputs)} files cleansed, {len(failures)} failed")
+    # the lookups read the merit index whenever it exists. It is rebuilt from every merit output in the folder,
+    # earlier runs included, so a backfill of one month keeps the others; a failed merit file leaves it as it was
+    index_path = os.path.join(output_dir, os.path.basename(MERIT_INDEX_PATH))
+    merit_failures = [path for path in failures if raw_file_kind(path)[0] == "merit"]
+    if merit_failures:
+        logger.warning(f"{index_path} not rebuilt, {len(merit_failures)} merit files failed")
+    elif any(raw_file_kind(path)[0] == "merit" for path in outputs):
+        build_merit_index_from_csv(sorted(glob.glob(os.path.join(output_dir, "merit_cleansed_*.csv"))), index_path)
+    return outputs, failures
 
 if __name__ == "__main__":
-    cleansed_file()
+    parser = argparse.ArgumentParser(description='cleanse the raw user and merit files')
+    parser.add_argument('--chunksize', type=int, default=None,
+                      help='stream the merit file in chunks of this many rows')
+    parser.add_argument('--raw-dir', default=None,
+                      help='cleanse every raw file in this folder in parallel instead of the default pair')
+    parser.add_argument('--workers', type=int, default=None,
+                      help='number of worker processes for --raw-dir (default: cpu count)')
+    parser.add_argument('--compact', action='store_true',
+                      help='categorical, int8 and float32 columns to cut memory, see util.compact_dtypes')
+    args = parser.parse_args()
+    if args.raw_dir:
+        raw_files = sorted(glob.glob(os.path.join(args.raw_dir, "*.csv")))
+        outputs, failures = cleansed_files_parallel(raw_files, workers=args.workers, compact=args.compact)
+        for path, error in failures.items():
+            print(f"FAILED {path}: {error}")
+        sys.exit(1 if failures else 0)
+    cleansed_file(args.chunksize, args.compact)
@@ -0,0 +1,334 @@
+from lazy_import import lazy_import
+from logger_config import setup_logger
+from stage_metrics import stage, timed_stage
+import os
+import sys
+import argparse
+import columnar_store
+from check_final_price import load_merit_index, MERIT_CLEANSED_PATH
+from merit_index import (MERIT_INDEX_PATH, PERIODS_PER_DAY, SLOT_NS, ERROR_NAMES, PRICE_OK,
+                         UNKNOWN_PERIOD, DEMAND_EXCEEDS_CAPACITY, INVALID_DEMAND)
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+logger = setup_logger('clearing_engines')
+
+DUCKDB_SCRIPT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'duckdb_script')
+DUCKDB_DATABASE_PATH = os.path.join(DUCKDB_SCRIPT_DIR, 'data.duckdb')
+CUMULATIVE_TABLE = "merit_cumulative_volumn"
+CURVES_TABLE = "merit_curves"
+
+ENGINES = ("numpy", "pandas", "duckdb")
+AUTO = "auto"
+# a batch touching at most this many periods reads only their partitions in the pandas engine
+# (about 5 ms a period), a bigger batch pays once for building all the merit curves (0.12 s for a month)
+PANDAS_MAX_PERIODS = 16
+# without a merit index, a cleansed csv above this size is left in DuckDB instead of being loaded
+# into memory; both take about 0.1 s for a month of offers (5 MB)
+LARGE_MERIT_BYTES = 64 * 2**20
+
+
+# every engine answers clearing_prices(dates, periods, demands) -> (prices, errors) like MeritIndex,
+# so batch_check_final_price and the parity check take any of them
+def _validate(dates, periods, demands):
+    dates = pd.to_datetime(pd.Series(np.asarray(dates)), errors='coerce').to_numpy(dtype='datetime64[D]')
+    periods = pd.to_numeric(pd.Series(np.asarray(periods)), errors='coerce').fillna(0).to_numpy(dtype=np.int64)
+    demands = pd.to_numeric(pd.Series(np.asarray(demands)), errors='coerce').to_numpy(dtype=np.float64)
+    errors = np.full(len(demands), PRICE_OK, dtype=np.int8)
+    errors[np.isnat(dates) | (periods < 1) | (periods > PERIODS_PER_DAY)] = UNKNOWN_PERIOD
+    errors[(errors == PRICE_OK) & ~(demands >= 0)] = INVALID_DEMAND
+    return dates, periods, demands, errors
+
+# slot number of every (date, period), the key of the datetime index of the cleansed tables
+def _slots(dates, periods):
+    return dates.astype(np.int64) * PERIODS_PER_DAY + periods - 1
+
+
+class NumpyEngine:
+    """Binary search over the precomputed merit curves of a MeritIndex, memory-mapped or built in memory"""
+    name = "numpy"
+
+    def __init__(self, merit_index):
+        self.merit_index = merit_index
+
+    @classmethod
+    def open(cls, compact=False):
+        return cls(load_merit_index(compact))
+
+    def clearing_prices(self, dates, periods, demands):
+        dates, periods, demands, _ = _validate(dates, periods, demands)
+        return self.merit_index.clearing_prices(dates, periods, demands)
+
+
+class PandasEngine:
+    """
+    The row-filter path of check_final_price: the curve of every queried period is built with
+    cumulative_vol_for_certain_period and the first step covering the demand is looked up.
+
+    Args:
+        merit_table: cleansed merit DataFrame with datetime index; None reads each period
+                     from the columnar store, or the whole cleansed csv when there is no store
+    """
+    name = "pandas"
+
+    def __init__(self, merit_table=None, compact=False):
+        self.compact = compact
+        self.merit_table = None
+        self._curves = {}
+        if merit_table is not None:
+            self._set_table(merit_table)
+
+    def _set_table(self, merit_table):
+        # sorted by period, so the rows of one period are a slice found by binary search
+        self.merit_table = merit_table.sort_index(kind='stable')
+        self._table_slots = pd.DatetimeIndex(self.merit_table.index).as_unit('ns').asi8 // SLOT_NS
+
+    def _period_rows(self, slot):
+        date_str = pd.Timestamp(slot * SLOT_NS).strftime("%Y-%m-%d")
+        if self.merit_table is None and columnar_store.has_partition(columnar_store.MERIT_STORE, date_str):
+            return columnar_store.read_period(columnar_store.MERIT_STORE, date_str, int(slot % PERIODS_PER_DAY) + 1,
+                                              columns=['bid_price', 'bid_volumn'])
+        if self.merit_table is None:
+            from util import read_cleansed_table
+            self._set_table(read_cleansed_table(MERIT_CLEANSED_PATH, compact=self.compact))
+        start, end = np.searchsorted(self._table_slots, [slot, slot + 1])
+        return self.merit_table.iloc[start:end][['bid_price', 'bid_volumn']]
+
+    def curve(self, slot):
+        """(curve DataFrame with cumulative_volume, max volume) of one period, None when it has no offers"""
+        if slot not in self._curves:
+            from util import cumulative_vol_for_certain_period
+            rows = self._period_rows(slot)
+            self._curves[slot] = cumulative_vol_for_certain_period(rows) if len(rows) else None
+        return self._curves[slot]
+
+    def clearing_prices(self, dates, periods, demands):
+        dates, periods, demands, errors = _validate(dates, periods, demands)
+        prices = np.full(len(demands), np.nan)
+        slots = _slots(dates, periods)
+        for i in np.flatnonzero(errors == PRICE_OK):
+            curve = self.curve(int(slots[i]))
+            if curve is None:
+                errors[i] = UNKNOWN_PERIOD
+                continue
+            merit_curve, max_vol = curve
+            if demands[i] > max_vol:
+                errors[i] = DEMAND_EXCEEDS_CAPACITY
+                continue
+            # same rule as check_final_price: the first step whose cumulative volume meets the demand
+            prices[i] = merit_curve['bid_price'].to_numpy()[np.argmax(merit_curve['cumulative_volume'].to_numpy() >= demands[i])]
+        return prices, errors
+
+
+# the first step covering the demand of every query, found by bisecting the curve of its period,
+# ties of cumulative volume go to the lower bid price like the sorted curves of the other engines.
+# {step} is covering_step_sql of the curve volumes and the query demand
+duckdb_clearing_sql = """
+    SELECT
+        q.query_id,
+        c.cumulative_volumes[-1] AS max_volume,
+        c.bid_prices[{step}] AS final_price
+    FROM clearing_queries q
+    LEFT JOIN {table} c ON c.date = q.date AND c.period = q.period
+"""
+
+def _import_duckdb_scripts():
+    if DUCKDB_SCRIPT_DIR not in sys.path:
+        sys.path.append(DUCKDB_SCRIPT_DIR)
+
+class DuckDBEngine:
+    """
+    Search of the query batch in merit_curves, the table every_datetime_demand.py reads.
+
+    Args:
+        con: DuckDB connection or cursor holding the curves table
+        table: name of the curves table
+    """
+    name = "duckdb"
+
+    def __init__(self, con, table=CURVES_TABLE):
+        self.con = con
+        self.table = table
+
+    @classmethod
+    def open(cls, path=DUCKDB_DATABASE_PATH):
+        """Read-only cursor on the database built by the duckdb_script pipeline"""
+        _import_duckdb_scripts()
+        from db_connection import manager
+        # the process-wide connection may already be open on this database, e.g. after select_engine probed it
+        if not (manager.is_open and os.path.abspath(manager.path) == os.path.abspath(path)):
+            manager.configure(path=path, read_only=True)
+        return cls(manager.cursor())
+
+    @classmethod
+    def from_frame(cls, merit_table):
+        """In-memory database with the merit curves of a cleansed merit DataFrame, same SQL as the scripts"""
+        import duckdb
+        _import_duckdb_scripts()
+        from given_datetime_final_price import cumulative_sql, curves_sql
+        timestamps = pd.DatetimeIndex(merit_table.index)
+        days = timestamps.normalize()
+        merit_validation = pd.DataFrame({
+            'date': days.to_numpy(dtype='datetime64[D]'),
+            'period': (timestamps.as_unit('ns').asi8 - days.as_unit('ns').asi8) // SLOT_NS + 1,
+            'bid_price': merit_table['bid_price'].to_numpy(dtype='float64'),
+            'bid_volumn': merit_table['bid_volumn'].to_numpy(dtype='float64'),
+        })
+        con = duckdb.connect()
+        con.register("merit_validation_frame", merit_validation)
+        con.execute("CREATE TABLE merit_validation AS SELECT * FROM merit_validation_frame")
+        con.unregister("merit_validation_frame")
+        con.execute(f"CREATE TABLE {CUMULATIVE_TABLE} AS " + cumulative_sql.format(where=""))
+        con.execute(f"CREATE TABLE {CURVES_TABLE} AS " + curves_sql.format(where=""))
+        return cls(con)
+
+    def available(self):
+        return self.con.execute("SELECT count(*) FROM duckdb_tables() WHERE table_name = ?", [self.table]).fetchone()[0] > 0
+
+    def clearing_prices(self, dates, periods, demands):
+        dates, periods, demands, errors = _validate(dates, periods, demands)
+        prices = np.full(len(demands), np.nan)
+        valid = np.flatnonzero(errors == PRICE_OK)
+        if len(valid) == 0:
+            return prices, errors
+        _import_duckdb_scripts()
+        from given_datetime_final_price import covering_step_sql
+        self.con.register("clearing_queries", pd.DataFrame({
+            'query_id': valid, 'date': dates[valid], 'period': periods[valid], 'demand': demands[valid],
+        }))
+        try:
+            step = covering_step_sql("c.cumulative_volumes", "q.demand")
+            result = self.con.execute(duckdb_clearing_sql.format(table=self.table, step=step)).fetchnumpy()
+        finally:
+            self.con.unregister("clearing_queries")
+        query_ids = np.asarray(result['query_id'], dtype=np.int64)
+        # NULL comes back masked: no offers for the period, or none covering the demand
+        max_volumes = np.ma.filled(np.ma.asarray(result['max_volume']).astype(np.float64), np.nan)
+        found = np.ma.filled(np.ma.asarray(result['final_price']).astype(np.float64), np.nan)
+
+        errors[query_ids[np.isnan(max_volumes)]] = UNKNOWN_PERIOD
+        errors[query_ids[demands[query_ids] > max_volumes]] = DEMAND_EXCEEDS_CAPACITY
+        ok = errors[query_ids] == PRICE_OK
+        prices[query_ids[ok]] = found[ok]
+        return prices, errors
+
+
+def choose_engine(n_periods, index_available, store_available, duckdb_available, merit_bytes=0):
+    """
+    Args:
+        n_periods: distinct (date, period) pairs in the query batch
+        index_available: the merit index file exists
+        store_available: the columnar store of the cleansed merit data exists
+        duckdb_available: the DuckDB database holds the curves table
+        merit_bytes: size of the cleansed merit csv
+
+    Returns:
+        engine name: numpy when the curves are precomputed, pandas for a batch of a few periods read
+        from the store, duckdb to leave a big merit table in the database, else numpy over curves
+        built once in memory
+    """
+    if index_available:
+        return "numpy"
+    if store_available and n_periods <= PANDAS_MAX_PERIODS:
+        return "pandas"
+    if duckdb_available and (merit_bytes > LARGE_MERIT_BYTES or not merit_bytes):
+        return "duckdb"
+    return "numpy"
+
+def open_engine(name, compact=False, duckdb_path=DUCKDB_DATABASE_PATH):
+    if name == "numpy":
+        return NumpyEngine.open(compact)
+    if name == "pandas":
+        return PandasEngine(compact=compact)
+    if name == "duckdb":
+        return DuckDBEngine.open(duckdb_path)
+    raise ValueError(f"unknown engine {name}, expected one of {ENGINES}")
+
+def select_engine(queries, compact=False, duckdb_path=DUCKDB_DATABASE_PATH):
+    """Open the engine choose_engine picks for this batch of date, period, demand queries"""
+    n_periods = len(queries[['date', 'period']].drop_duplicates())
+    sources = dict(
+        index_available=os.path.exists(MERIT_INDEX_PATH),
+        store_available=columnar_store.store_available() and os.path.isdir(columnar_store.MERIT_STORE),
+        merit_bytes=os.path.getsize(MERIT_CLEANSED_PATH) if os.path.exists(MERIT_CLEANSED_PATH) else 0,
+    )
+    # the database is only opened, and locked, when DuckDB would be picked if it holds the curves
+    duckdb_engine = None
+    if choose_engine(n_periods, duckdb_available=True, **sources) == "duckdb" and os.path.exists(duckdb_path):
+        try:
+            duckdb_engine = DuckDBEngine.open(duckdb_path)
+            if not duckdb_engine.available():
+                duckdb_engine = None
+        except Exception as e:
+            # e.g. the process-wide connection is already open on another database
+            logger.warning(f"{duckdb_path} can not be read, falling back to another engine: {e}")
+    name = choose_engine(n_periods, duckdb_available=duckdb_engine is not None, **sources)
+    logger.info(f"{name} engine chosen for {len(queries)} queries over {n_periods} periods")
+    # the probe already holds the process-wide connection, which can not be configured again
+    if name == "duckdb":
+        return duckdb_engine
+    return open_engine(name, compact, duckdb_path)
+
+# run the same queries through several engines and list every query they disagree on
+@timed_stage("parity_check", rows=lambda result: result[1]['queries'])
+def parity_check(engines, queries):
+    """
+    Args:
+        engines: engines to compare, the first one is the reference
+        queries: DataFrame with date, period and demand columns
+
+    Returns:
+        (mismatches, summary): the queries where any engine returns another price or error, with the
+        price and error of every engine; and a dict with queries, mismatches and the seconds of every engine
+    """
+    import time
+    dates, periods, demands = queries['date'], queries['period'], pd.to_numeric(queries['demand'], errors='coerce')
+    prices, errors, seconds = {}, {}, {}
+    for engine in engines:
+        start = time.perf_counter()
+        with stage(f"parity.{engine.name}", rows=len(queries)):
+            prices[engine.name], errors[engine.name] = engine.clearing_prices(dates, periods, demands)
+        seconds[engine.name] = round(time.perf_counter() - start, 4)
+
+    reference = engines[0].name
+    differs = np.zeros(len(queries), dtype=bool)
+    for name in prices:
+        same_price = (prices[name] == prices[reference]) | (np.isnan(prices[name]) & np.isnan(prices[reference]))
+        differs |= ~same_price | (errors[name] != errors[reference])
+
+    mismatches = queries[differs].copy()
+    for name in prices:
+        mismatches[f"{name}_price"] = prices[name][differs]
+        mismatches[f"{name}_error"] = pd.Series(errors[name][differs], index=mismatches.index).map(ERROR_NAMES)
+    summary = {'queries': len(queries), 'mismatches': int(differs.sum()), 'seconds': seconds}
+    if differs.any():
+        logger.error(f"engines disagree on {summary['mismatches']} of {len(queries)} queries")
+    else:
+        logger.info(f"{', '.join(prices)} agree on all {len(queries)} queries")
+    return mismatches, summary
+
+
+def main(args):
+    with stage("read_csv.queries") as run:
+        queries = pd.read_csv(args.batch)
+        run.rows = len(queries)
+    engines = [open_engine(name, args.compact, args.duckdb_path) for name in args.engines]
+    mismatches, summary = parity_check(engines, queries)
+    print(f"{summary['mismatches']} of {summary['queries']} queries differ between {', '.join(args.engines)}")
+    for name, seconds in summary['seconds'].items():
+        print(f"{name:8} {seconds:.4f} s")
+    if len(mismatches):
+        mismatches.to_csv(args.output, index=False)
+        print(f"mismatches written to {args.output}")
+    return 1 if len(mismatches) else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='run a batch of date, period, demand queries on several clearing engines and report where they disagree')
+    parser.add_argument('--batch', required=True, help='CSV file of date, period, demand queries')
+    parser.add_argument('--engines', nargs='+', choices=ENGINES, default=list(ENGINES), help='engines to compare, the first is the reference')
+    parser.add_argument('--output', default='engine_mismatches.csv', help='Output file of the queries the engines disagree on')
+    parser.add_argument('--duckdb-path', default=DUCKDB_DATABASE_PATH, help='database holding merit_curves')
+    parser.add_argument('--compact', action='store_true', help='load the cleansed merit table with compact dtypes')
+    args = parser.parse_args()
+    sys.exit(main(args))
@@ -0,0 +1,132 @@
+import os
+import shutil
+from lazy_import import lazy_import
+from logger_config import setup_logger
+from stage_metrics import timed_stage
+
+pd = lazy_import("pandas")
+# pyarrow is optional, without it the pipeline keeps using the csv files only
+pa = lazy_import("pyarrow")
+
+logger = setup_logger('columnar_store')
+
+MERIT_STORE = "cleansed_data/merit"
+USEP_STORE = "cleansed_data/usep"
+
+# partition directories are named date=YYYY-MM-DD
+PARTITIONING = "hive"
+
+
+def store_available():
+    return pa is not None
+
+
+def partition_path(root, date_str):
+    return os.path.join(root, f"date={pd.to_datetime(date_str).strftime('%Y-%m-%d')}")
+
+
+def has_partition(root, date_str):
+    return store_available() and os.path.isdir(partition_path(root, date_str))
+
+
+def _to_date_period_table(df):
+    # split the datetime index back into the date partition key and the period column
+    datetime_index = pd.DatetimeIndex(df.index)
+    date = datetime_index.normalize()
+    table_df = df.reset_index(drop=True)
+    table_df.insert(0, 'period', ((datetime_index - date) // pd.Timedelta(minutes=30) + 1).astype('int64'))
+    table_df.insert(0, 'date', date.date)
+    return pa.Table.from_pandas(table_df, preserve_index=False)
+
+
+# write a cleansed DataFrame with datetime index as parquet files partitioned by date
+@timed_stage("columnar_store.write_partitioned", rows=int)
+def write_partitioned(df, root, basename_template=None, replace_dates=True):
+    """
+    Args:
+        df: cleansed DataFrame with datetime index (output of generate_datetime_index)
+        root: directory of the partitioned store
+        basename_template: parquet file name template, e.g. 'part-3-{i}.parquet' for one chunk
+        replace_dates: delete the existing partitions of the dates being written
+
+    Returns:
+        number of rows written
+    """
+    if not store_available():
+        raise ImportError("pyarrow is required to write the columnar store")
+
+    import pyarrow.dataset as ds
+    table = _to_date_period_table(df)
+    ds.write_dataset(
+        table, root,
+        format="parquet",
+        partitioning=ds.partitioning(pa.schema([('date', pa.date32())]), flavor=PARTITIONING),
+        basename_template=basename_template or "part-{i}.parquet",
+        existing_data_behavior="delete_matching" if replace_dates else "overwrite_or_ignore",
+    )
+    logger.info(f"wrote {table.num_rows} rows to {root}")
+    return table.num_rows
+
+
+def clear_store(root):
+    if os.path.isdir(root):
+        shutil.rmtree(root)
+
+
+# read every period of one date partition, the periods become the time of the datetime index
+@timed_stage("columnar_store.read_date", rows=len)
+def read_date(root, date_str, columns=None):
+    """
+    Args:
+        root: directory of the partitioned store
+        date_str: Date as string ('YYYY-MM-DD') or datetime object
+        columns: value columns to load, all value columns when None
+
+    Returns:
+        DataFrame with datetime index for all 48 periods of the date
+    """
+    path = partition_path(root, date_str)
+    if not has_partition(root, date_str):
+        raise KeyError(f"No partition for {date_str} in {root}")
+
+    import pyarrow.dataset as ds
+    dataset = ds.dataset(path, format="parquet")
+    if columns is None:
+        columns = [name for name in dataset.schema.names if name != 'period']
+    df = dataset.to_table(columns=['period'] + list(columns)).to_pandas()
+    datetime_index = pd.to_datetime(date_str).normalize() + pd.to_timedelta((df.pop('period') - 1) * 30, unit='min')
+    df.index = pd.DatetimeIndex(datetime_index, name='datetime')
+    logger.info("read %d rows for %s from %s", len(df), date_str, root)
+    return df
+
+
+# read only the partition and columns needed for one date and period
+@timed_stage("columnar_store.read_period", rows=len)
+def read_period(root, date_str, period, columns=None, period_duration='30min'):
+    """
+    Args:
+        root: directory of the partitioned store
+        date_str: Date as string ('YYYY-MM-DD') or datetime object
+        period: Integer representing period (1-48 for 30min)
+        columns: columns to load, all value columns when None
+
+    Returns:
+        DataFrame with datetime index, same shape as util.select_certain_period
+    """
+    if period_duration != '30min':
+        raise ValueError("period_duration must be '30min'")
+    path = partition_path(root, date_str)
+    if not has_partition(root, date_str):
+        raise KeyError(f"No partition for {date_str} in {root}")
+
+    # the partition directory is opened directly, so the cost does not depend on how many dates are stored
+    import pyarrow.dataset as ds
+    dataset = ds.dataset(path, format="parquet")
+    if columns is None:
+        columns = [name for name in dataset.schema.names if name != 'period']
+    table = dataset.to_table(columns=list(columns), filter=ds.field('period') == period)
+    df = table.to_pandas()
+    target_timestamp = pd.to_datetime(date_str).normalize() + pd.to_timedelta((period - 1) * 30, unit='min')
+    df.index = pd.DatetimeIndex([target_timestamp] * len(df), name='datetime')
+    logger.info("read %d rows for %s from %s", len(df), target_timestamp, root)
+    return df
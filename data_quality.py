@@ -0,0 +1,269 @@
+from lazy_import import lazy_import
+from logger_config import setup_logger
+import os
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+logger = setup_logger('data_quality')
+
+# what happens to a row breaking a rule
+QUARANTINE = "quarantine"
+WARN = "warn"
+# column of the quarantine file and table listing the rules a row broke
+VIOLATIONS_COLUMN = "violations"
+VIOLATIONS_SEPARATOR = ";"
+# a repeated row is looked for among the rows of its own date, and the hashes of the dates this far
+# behind the latest one are dropped; rows of an already dropped date are counted as out of order
+DUPLICATE_WINDOW = "1D"
+
+
+# one declarative data-quality rule, evaluated on a DataFrame or rendered to a SQL condition
+class Rule:
+    """
+    Args:
+        kind: 'not_null', 'range' or 'duplicate' (the whole row repeats an earlier one)
+        column: checked column, None for 'duplicate'
+        low, high: allowed values of a 'range' rule, None for an open end; nulls are left to 'not_null'
+        low_inclusive: False when the value must be strictly above low
+        action: QUARANTINE moves the offending rows to the quarantine file, WARN only counts them
+    """
+
+    def __init__(self, kind, column=None, low=None, high=None, low_inclusive=True, action=QUARANTINE):
+        if kind not in ("not_null", "range", "duplicate"):
+            raise ValueError(f"unknown rule kind {kind}")
+        self.kind = kind
+        self.column = column
+        self.low = low
+        self.high = high
+        self.low_inclusive = low_inclusive
+        self.action = action
+        self.name = "duplicate_row" if kind == "duplicate" else f"{column.replace(' ', '_')}_{kind}"
+
+    def violations(self, df):
+        """
+        Returns:
+            bool array, True where the row breaks the rule ('duplicate' rows are found by QualityChecker)
+        """
+        values = df[self.column]
+        if self.kind == "not_null":
+            return values.isna().to_numpy()
+        values = pd.to_numeric(values, errors='coerce').to_numpy(dtype='float64')
+        bad = np.zeros(len(values), dtype=bool)
+        with np.errstate(invalid='ignore'):
+            if self.low is not None:
+                bad |= values < self.low if self.low_inclusive else values <= self.low
+            if self.high is not None:
+                bad |= values > self.high
+        return bad
+
+    def sql(self, columns=None, row_columns=()):
+        """
+        Args:
+            columns: SQL column of each DataFrame column the table names differently
+            row_columns: SQL columns making up a row, for 'duplicate'
+
+        Returns:
+            SQL condition, true where the row breaks the rule and never NULL
+        """
+        columns = columns or {}
+        if self.kind == "duplicate":
+            return f"row_number() OVER (PARTITION BY {', '.join(quote(column) for column in row_columns)}) > 1"
+        column = quote(columns.get(self.column, self.column))
+        if self.kind == "not_null":
+            return f"{column} IS NULL"
+        conditions = []
+        if self.low is not None:
+            conditions.append(f"{column} {'<' if self.low_inclusive else '<='} {self.low}")
+        if self.high is not None:
+            conditions.append(f"{column} > {self.high}")
+        return f"coalesce({' OR '.join(conditions)}, false)"
+
+
+def quote(column):
+    return '"' + column.replace('"', '""') + '"'
+
+def not_null(*columns):
+    return [Rule("not_null", column) for column in columns]
+
+def in_range(column, low=None, high=None, low_inclusive=True):
+    return Rule("range", column, low=low, high=high, low_inclusive=low_inclusive)
+
+def duplicate_rows(action=WARN):
+    return Rule("duplicate", action=action)
+
+
+# rules of the cleansed tables, in the column names of util.clean_merit_frame / clean_usep_frame;
+# repeated rows have always been kept, so duplicates are only counted
+MERIT_RULES = not_null('date', 'period', 'bid_price', 'bid_volumn') + [
+    in_range('period', 1, 48),
+    in_range('bid_volumn', low=0),
+    duplicate_rows(),
+]
+USEP_RULES = not_null('information type', 'date', 'period', 'usep', 'lcp', 'demand', 'tcl') + [
+    in_range('period', 1, 48),
+    in_range('usep', low=0),
+    in_range('lcp', low=0),
+    in_range('demand', low=0, low_inclusive=False),
+    in_range('tcl', low=0),
+    duplicate_rows(),
+]
+
+
+# SQL expression listing the broken rules of a row, '' when it breaks none
+def violations_sql(rules, columns=None, row_columns=()):
+    cases = ", ".join(f"CASE WHEN {rule.sql(columns, row_columns)} THEN '{rule.name}' END" for rule in rules)
+    return f"concat_ws('{VIOLATIONS_SEPARATOR}', {cases})"
+
+# SQL condition, true when a row breaks a rule that quarantines it
+def quarantine_sql(rules, columns=None, row_columns=()):
+    conditions = [rule.sql(columns, row_columns) for rule in rules if rule.action == QUARANTINE]
+    return " OR ".join(conditions) if conditions else "false"
+
+# SQL select of the row count and the count of every rule over a table with a violations column
+def rule_counts_sql(rules, table_name):
+    counts = ", ".join(
+        f"count(*) FILTER (WHERE list_contains(string_split({VIOLATIONS_COLUMN}, '{VIOLATIONS_SEPARATOR}'), '{rule.name}'))"
+        for rule in rules
+    )
+    return f"SELECT count(*), {counts} FROM {table_name}"
+
+
+# applies a rule set to a table, whole or chunk by chunk, counting every violation
+# and moving the offending rows to a quarantine file instead of failing the whole file
+class QualityChecker:
+    """
+    Args:
+        rules: list of Rule
+        name: table name used in the log
+        quarantine_path: csv file the quarantined rows are written to, with the raw row number
+                         and the broken rules; an earlier file is replaced. None keeps no file
+        window_column: date column a repeated row repeats too. The row hashes are kept per date and
+                       dropped DUPLICATE_WINDOW behind the latest date, so the files are expected in
+                       date order; rows of a dropped date can not be checked and are counted in
+                       out_of_order instead
+    """
+
+    def __init__(self, rules, name, quarantine_path=None, window_column='date'):
+        self.rules = rules
+        self.name = name
+        self.quarantine_path = quarantine_path
+        self.window_column = window_column
+        self.rows = 0
+        self.quarantined = 0
+        self.out_of_order = 0
+        self.counts = {rule.name: 0 for rule in rules}
+        # date -> hashes of its rows, duplicates are found across chunks too; rows without a
+        # date are kept under None for the whole table
+        self._hashes = {}
+        self._latest = None
+        self._quarantine_written = False
+        if quarantine_path and os.path.exists(quarantine_path):
+            os.remove(quarantine_path)
+
+    def _seen(self, key, hashes):
+        known = self._hashes.get(key)
+        duplicated = np.isin(hashes, known) if known is not None else np.zeros(len(hashes), dtype=bool)
+        self._hashes[key] = hashes if known is None else np.concatenate([known, hashes])
+        return duplicated
+
+    def _duplicates(self, df):
+        hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+        duplicated = pd.Series(hashes).duplicated().to_numpy(copy=True)
+        if self.window_column not in df.columns:
+            return duplicated | self._seen(None, hashes)
+        values = df[self.window_column]
+        # the watermark of the earlier chunks, the dates of this chunk are all checked
+        watermark = None if self._latest is None else self._latest - pd.Timedelta(DUPLICATE_WINDOW)
+        late = np.zeros(len(df), dtype=bool)
+        for key, positions in df.groupby(values, dropna=False, sort=False).indices.items():
+            key = None if pd.isna(key) else key
+            if key is not None and watermark is not None and key < watermark:
+                late[positions] = True
+                continue
+            duplicated[positions] |= self._seen(key, hashes[positions])
+        if late.any():
+            self.out_of_order += int(late.sum())
+            logger.warning(f"{self.name}: {int(late.sum())} rows dated before {watermark} arrived after it, "
+                           f"they are not checked for duplicates")
+        if values.notna().any():
+            latest = values.max()
+            self._latest = latest if self._latest is None else max(self._latest, latest)
+            watermark = self._latest - pd.Timedelta(DUPLICATE_WINDOW)
+            # the dates behind the watermark can not come back in a date ordered file
+            for key in [key for key in self._hashes if key is not None and key < watermark]:
+                del self._hashes[key]
+        return duplicated
+
+    def check(self, df):
+        """
+        Args:
+            df: cleaned rows, the next chunk when the table is checked chunk by chunk
+
+        Returns:
+            the rows breaking no quarantine rule
+        """
+        violations = np.vstack([
+            self._duplicates(df) if rule.kind == "duplicate" else rule.violations(df)
+            for rule in self.rules
+        ]) if self.rules else np.zeros((0, len(df)), dtype=bool)
+        for rule, count in zip(self.rules, violations.sum(axis=1).tolist()):
+            self.counts[rule.name] += count
+        self.rows += len(df)
+
+        quarantine = np.array([rule.action == QUARANTINE for rule in self.rules], dtype=bool)
+        bad = violations[quarantine].any(axis=0)
+        # the file is written even without bad rows, an empty quarantine is a result too
+        if self.quarantine_path and (bad.any() or not self._quarantine_written):
+            self._write_quarantine(df[bad], violations[:, bad])
+        if not bad.any():
+            return df
+        self.quarantined += int(bad.sum())
+        return df[~bad].copy()
+
+    def _write_quarantine(self, bad_rows, violations):
+        names = np.array([rule.name for rule in self.rules], dtype=object)
+        bad_rows = bad_rows.copy()
+        bad_rows[VIOLATIONS_COLUMN] = [VIOLATIONS_SEPARATOR.join(names[broken]) for broken in violations.T]
+        bad_rows.to_csv(self.quarantine_path, mode='a' if self._quarantine_written else 'w',
+                        header=not self._quarantine_written, index_label='row')
+        self._quarantine_written = True
+
+    def summary(self):
+        return quality_summary(self.rules, [self.counts[rule.name] for rule in self.rules], self.rows, self.quarantined)
+
+    def log_summary(self):
+        log_quality_summary(self.name, self.summary(), self.quarantine_path)
+        if self.out_of_order:
+            logger.warning(f"{self.name}: {self.out_of_order} rows out of date order were not checked for duplicates")
+
+
+def quality_summary(rules, counts, rows, quarantined):
+    """
+    Args:
+        rules: list of Rule
+        counts: violations of every rule, in rule order
+        rows: rows checked
+        quarantined: rows moved to the quarantine
+
+    Returns:
+        dict with rows, quarantined, the violations of every rule and of every column
+    """
+    columns = {}
+    for rule, count in zip(rules, counts):
+        column = rule.column or "(row)"
+        columns[column] = columns.get(column, 0) + int(count)
+    return {
+        'rows': int(rows),
+        'quarantined': int(quarantined),
+        'rules': {rule.name: int(count) for rule, count in zip(rules, counts)},
+        'columns': columns,
+    }
+
+def log_quality_summary(name, summary, quarantine_path=None):
+    broken = {rule: count for rule, count in summary['rules'].items() if count}
+    if not broken:
+        logger.info(f"{name}: {summary['rows']} rows passed every data-quality rule")
+        return
+    where = f", written to {quarantine_path}" if quarantine_path and summary['quarantined'] else ""
+    logger.warning(f"{name}: {summary['quarantined']} of {summary['rows']} rows quarantined{where}; "
+                   f"violations per rule {broken}, per column {summary['columns']}")
@@ -1,13 +1,17 @@
-import duckdb
 import sys
 import os
+import argparse
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from logger_config import setup_logger
+from db_connection import manager, thread_cursor, preview, format_preview
+from stage_metrics import stage
+from duckdb_cleansed_file import table_version
 
 
 logger = setup_logger('duckdb_analysis')
 
-con = duckdb.connect("data.duckdb")
+# the calling thread's cursor on the shared data.duckdb connection
+con = thread_cursor()
 
 # analysis - 1
 # for each date, to find out the max/min power demand and the corresponding period
@@ -190,3 +194,162 @@ LIMIT 10;
 # 7 2023-01-04         91.202852       255.57             1.084904
 # 8 2023-01-13         90.323391       294.11             1.208263
 # 9 2023-01-10         81.214693       383.99             1.376105
+
+
+# the five analyses above each scan user_validation (analysis 2 reads the table of analysis 1).
+# run_analyses answers all of them from one scan: per-date and per-period aggregates are
+# computed together with GROUPING SETS, and every result is derived from those few rows.
+SOURCE_TABLE = "user_validation"
+SHARED_AGGREGATES_TABLE = "analysis_shared_aggregates"
+# source table -> version of it the stored results were computed from
+ANALYSIS_CACHE_TABLE = "analysis_cache"
+BY_DATE = 1
+BY_PERIOD = 2
+
+# a daily extreme shared by several periods is reported once, at the earliest period
+shared_aggregates_sql = f"""
+SELECT
+    grouping(date, period) AS grouping_id,
+    date,
+    period,
+    MAX(demand_mw) AS max_demand,
+    MIN(demand_mw) AS min_demand,
+    arg_max(period, (demand_mw, -period)) FILTER (WHERE demand_mw IS NOT NULL) AS max_demand_period,
+    arg_min(period, (demand_mw, period)) FILTER (WHERE demand_mw IS NOT NULL) AS min_demand_period,
+    arg_max(usep_price, (demand_mw, -period)) FILTER (WHERE demand_mw IS NOT NULL) AS usep_at_max_demand,
+    SUM(usep_price) AS usep_sum,
+    COUNT(usep_price) AS usep_count,
+    SUM(demand_mw) AS demand_sum,
+    COUNT(demand_mw) AS demand_count,
+    COUNT(*) AS observation_count,
+    STDDEV(usep_price) AS usep_stddev,
+    MAX(usep_price) AS max_usep,
+    MIN(usep_price) AS min_usep
+FROM
+    {SOURCE_TABLE}
+GROUP BY
+    GROUPING SETS ((date), (period))
+"""
+
+# result table -> query over the shared aggregates, run in this order
+analysis_sql = {
+    # analysis - 1
+    "analysis_demand_limit_by_date": f"""
+        SELECT date, period, demand_mw, demand_type
+        FROM (
+            SELECT date, max_demand_period AS period, max_demand AS demand_mw, 'MAX' AS demand_type
+            FROM {SHARED_AGGREGATES_TABLE} WHERE grouping_id = {BY_DATE}
+            UNION ALL
+            SELECT date, min_demand_period, min_demand, 'MIN'
+            FROM {SHARED_AGGREGATES_TABLE} WHERE grouping_id = {BY_DATE} AND min_demand < max_demand
+        )
+        ORDER BY date, demand_type DESC
+    """,
+    # analysis - 2
+    "analysis_period_for_max_demand": """
+        SELECT period, COUNT(*) AS max_demand_count
+        FROM analysis_demand_limit_by_date
+        WHERE demand_type = 'MAX'
+        GROUP BY period
+        ORDER BY max_demand_count DESC, period
+        LIMIT 10
+    """,
+    # analysis - 3
+    "analysis_time_of_day_price": f"""
+        SELECT
+            CASE
+                WHEN period BETWEEN 14 AND 36 THEN 'Daytime'
+                WHEN period BETWEEN 37 AND 44 THEN 'Evening'
+                WHEN period BETWEEN 45 AND 48 OR period BETWEEN 1 AND 13 THEN 'Night'
+                ELSE 'Other'
+            END AS time_of_day,
+            SUM(usep_sum) / SUM(usep_count) AS avg_price,
+            SUM(demand_sum) / SUM(demand_count) AS avg_demand,
+            CAST(SUM(observation_count) AS BIGINT) AS observation_count
+        FROM {SHARED_AGGREGATES_TABLE}
+        WHERE grouping_id = {BY_PERIOD}
+        GROUP BY time_of_day
+        ORDER BY avg_price DESC
+    """,
+    # analysis - 4
+    "analysis_peak_demand_identification": f"""
+        SELECT date, max_demand_period AS period, max_demand AS demand_mw, usep_at_max_demand AS usep_price
+        FROM {SHARED_AGGREGATES_TABLE}
+        WHERE grouping_id = {BY_DATE} AND max_demand IS NOT NULL
+        ORDER BY demand_mw DESC
+    """,
+    # analysis - 5
+    "analysis_price_volatility": f"""
+        SELECT
+            date,
+            usep_stddev AS price_volatility,
+            max_usep - min_usep AS price_range,
+            (max_usep - min_usep) / (usep_sum / usep_count) AS relative_volatility
+        FROM {SHARED_AGGREGATES_TABLE}
+        WHERE grouping_id = {BY_DATE}
+        ORDER BY price_volatility DESC
+        LIMIT 10
+    """,
+}
+
+def table_exists(table_name) -> bool:
+    return con.execute(
+        "SELECT count(*) FROM duckdb_tables() WHERE table_name = ?", [table_name]
+    ).fetchone()[0] > 0
+
+def ensure_analysis_cache() -> None:
+    con.execute(f"""
+                CREATE TABLE IF NOT EXISTS {ANALYSIS_CACHE_TABLE} (
+                    source_table VARCHAR PRIMARY KEY,
+                    source_version BIGINT,
+                    built_at TIMESTAMP
+                )""")
+
+def cached_version():
+    row = con.execute(f"SELECT source_version FROM {ANALYSIS_CACHE_TABLE} WHERE source_table = ?", [SOURCE_TABLE]).fetchone()
+    return row[0] if row else None
+
+# run the whole analysis suite, or reuse the stored results while user_validation is unchanged
+def run_analyses(force=False):
+    """
+    Args:
+        force: recompute even when the stored results match the user_validation version
+
+    Returns:
+        list of result table names, in analysis order
+    """
+    version = table_version(SOURCE_TABLE)
+    if (not force and table_exists(ANALYSIS_CACHE_TABLE) and cached_version() == version
+            and all(table_exists(table) for table in analysis_sql)):
+        logger.info("analysis results are up to date with %s version %s", SOURCE_TABLE, version)
+        return list(analysis_sql)
+
+    logger.info("computing analysis results for %s version %s", SOURCE_TABLE, version)
+    # a read-only process keeps its results in temp tables of its own cursor, they shadow the stored ones
+    table_kind = "TEMP TABLE" if manager.read_only else "TABLE"
+    with manager.transaction():
+        # the only scan of user_validation
+        with stage("sql.analysis.shared_aggregates"):
+            con.execute(f"CREATE OR REPLACE {table_kind} {SHARED_AGGREGATES_TABLE} AS {shared_aggregates_sql}")
+        for table, sql in analysis_sql.items():
+            with stage(f"sql.analysis.{table}"):
+                con.execute(f"CREATE OR REPLACE {table_kind} {table} AS {sql}")
+        if not manager.read_only:
+            ensure_analysis_cache()
+            con.execute(f"INSERT OR REPLACE INTO {ANALYSIS_CACHE_TABLE} VALUES (?, ?, now())", [SOURCE_TABLE, version])
+    return list(analysis_sql)
+
+def main(args):
+    for table in run_analyses(args.force):
+        print(table)
+        # the result tables are a few rows each
+        print(format_preview(preview(table, limit=None)))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='run the demand and price analyses, results are kept in data.duckdb')
+    parser.add_argument('--force', action='store_true', help='recompute even when user_validation has not changed')
+    parser.add_argument('--read-only', action='store_true',
+                        help='open data.duckdb read-only next to other scripts, stale results are recomputed in temp tables')
+    args = parser.parse_args()
+    manager.configure(read_only=args.read_only)
+    main(args)
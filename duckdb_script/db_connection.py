@@ -0,0 +1,176 @@
+import os
+import sys
+import threading
+from contextlib import contextmanager
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from lazy_import import lazy_import
+from logger_config import setup_logger
+
+duckdb = lazy_import("duckdb")
+logger = setup_logger('db_connection')
+
+# database file and engine settings, unset ones keep the DuckDB defaults
+DUCKDB_PATH = os.environ.get("DUCKDB_PATH", "data.duckdb")
+DUCKDB_THREADS = os.environ.get("DUCKDB_THREADS")
+DUCKDB_MEMORY_LIMIT = os.environ.get("DUCKDB_MEMORY_LIMIT")        # e.g. '4GB'
+DUCKDB_TEMP_DIRECTORY = os.environ.get("DUCKDB_TEMP_DIRECTORY")    # spill folder of larger-than-memory joins and sorts
+# a read-only process shares the file with other read-only processes, a read-write one locks it
+DUCKDB_READ_ONLY = os.environ.get("DUCKDB_READ_ONLY", "").lower() in ("1", "true", "yes")
+
+# results stay in Arrow: rows per record batch of a streamed result, and rows of a preview
+RECORD_BATCH_ROWS = 122_880
+PREVIEW_ROWS = 5
+# COPY options of the export formats, chosen by the file extension
+EXPORT_FORMATS = {
+    '.csv': "FORMAT CSV, HEADER",
+    '.parquet': "FORMAT PARQUET",
+}
+
+
+# one database connection per process, shared by every script.
+# Each thread runs its queries on its own cursor, which DuckDB executes concurrently,
+# and writers take write_lock so two threads never race on the same tables
+class ConnectionManager:
+    def __init__(self, path=DUCKDB_PATH, read_only=DUCKDB_READ_ONLY, threads=DUCKDB_THREADS,
+                 memory_limit=DUCKDB_MEMORY_LIMIT, temp_directory=DUCKDB_TEMP_DIRECTORY):
+        self.path = path
+        self.read_only = read_only
+        self.threads = threads
+        self.memory_limit = memory_limit
+        self.temp_directory = temp_directory
+        self.write_lock = threading.RLock()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._connection = None
+        self._cursors = []
+
+    def configure(self, **settings):
+        """
+        Args:
+            settings: path, read_only, threads, memory_limit or temp_directory, only before the first query
+        """
+        if self._connection is not None:
+            raise RuntimeError(f"{self.path} is already open, configure the connection before the first query")
+        for name, value in settings.items():
+            if not hasattr(self, name) or name.startswith("_") or name == "write_lock":
+                raise TypeError(f"unknown connection setting {name}")
+            setattr(self, name, value)
+
+    # the connection was opened, its settings can no longer change
+    @property
+    def is_open(self):
+        return self._connection is not None
+
+    def config(self):
+        config = {'threads': self.threads, 'memory_limit': self.memory_limit, 'temp_directory': self.temp_directory}
+        return {name: str(value) for name, value in config.items() if value is not None}
+
+    # the process-wide connection, opened on first use
+    def connection(self):
+        with self._lock:
+            if self._connection is None:
+                self._connection = duckdb.connect(self.path, read_only=self.read_only, config=self.config())
+                logger.info("opened %s (%s) %s", self.path, "read-only" if self.read_only else "read-write", self.config())
+            return self._connection
+
+    # the calling thread's cursor, created on its first query
+    def cursor(self):
+        cursor = getattr(self._local, 'cursor', None)
+        if cursor is None:
+            cursor = self.connection().cursor()
+            self._local.cursor = cursor
+            self._local.prepared = set()
+            with self._lock:
+                self._cursors.append(cursor)
+        return cursor
+
+    # prepared statements belong to one cursor, so every thread prepares its own copy once
+    def prepare(self, name, sql):
+        """
+        Args:
+            name: statement name used with EXECUTE
+            sql: the PREPARE <name> AS ... statement
+
+        Returns:
+            the calling thread's cursor
+        """
+        cursor = self.cursor()
+        if name not in self._local.prepared:
+            cursor.execute(sql)
+            self._local.prepared.add(name)
+        return cursor
+
+    # one write transaction at a time on the calling thread's cursor, rolled back when the block raises
+    @contextmanager
+    def transaction(self):
+        with self.write_lock:
+            cursor = self.cursor()
+            cursor.execute("BEGIN TRANSACTION")
+            try:
+                yield cursor
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+            cursor.execute("COMMIT")
+
+    def close(self):
+        with self._lock:
+            for cursor in self._cursors:
+                cursor.close()
+            if self._connection is not None:
+                self._connection.close()
+            self._cursors = []
+            self._connection = None
+            self._local = threading.local()
+
+
+# stands in for a module-level connection: every attribute resolves on the calling thread's cursor
+class ThreadCursor:
+    def __init__(self, manager):
+        self._manager = manager
+
+    def __getattr__(self, name):
+        return getattr(self._manager.cursor(), name)
+
+
+manager = ConnectionManager()
+
+def thread_cursor():
+    return ThreadCursor(manager)
+
+
+# Arrow record batch reader over a query result, the rows are read batch by batch and never go through pandas
+def record_batches(sql, params=None, batch_rows=RECORD_BATCH_ROWS):
+    return manager.cursor().execute(sql, params).to_arrow_reader(batch_rows)
+
+# first rows of a table, view or file as an Arrow table; the LIMIT runs in DuckDB, so nothing else is read
+def preview(source, limit=PREVIEW_ROWS):
+    """
+    Args:
+        source: anything FROM takes, e.g. 'user_validation' or "'every_datetime_demand.csv'"
+        limit: rows to fetch, None for the whole result (only for small tables)
+    """
+    if limit is None:
+        return record_batches(f"SELECT * FROM {source}").read_all()
+    return record_batches(f"SELECT * FROM {source} LIMIT {int(limit)}", batch_rows=max(int(limit), 1)).read_all()
+
+# an Arrow table rendered as a text table by DuckDB, for the console and the debug log
+def format_preview(table):
+    return str(manager.cursor().from_arrow(table))
+
+def export_query(sql, path):
+    """
+    Write a query result straight from DuckDB to a file, without fetching it into Python.
+
+    Args:
+        sql: SELECT statement
+        path: output file, .csv (with header) or .parquet
+
+    Returns:
+        number of rows written
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in EXPORT_FORMATS:
+        raise ValueError(f"can not export to {path}, expected one of {', '.join(EXPORT_FORMATS)}")
+    target = path.replace("'", "''")
+    return manager.cursor().execute(f"COPY ({sql}) TO '{target}' ({EXPORT_FORMATS[extension]})").fetchone()[0]
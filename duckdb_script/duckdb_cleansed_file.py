@@ -1,80 +1,181 @@
-import duckdb
 import sys
 import os
+import logging
+import argparse
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from logger_config import setup_logger
+from db_connection import manager, thread_cursor, export_query, preview, format_preview
+from stage_metrics import stage
+from load_file import UNDATED
+from data_quality import (USEP_RULES, MERIT_RULES, VIOLATIONS_COLUMN, violations_sql, quarantine_sql,
+                          rule_counts_sql, quality_summary, log_quality_summary)
 
 
 logger = setup_logger('duckdb_cleansed_file')
 
-con = duckdb.connect("data.duckdb")
-def fetch_table_as_df(table_name):
-    return con.execute(f"SELECT * FROM {table_name}").fetchdf()
+# the calling thread's cursor on the shared data.duckdb connection
+con = thread_cursor()
 
-# 5.b perform cleaning to the raw table, this will generated 2 validated table
-def cleansing_tables() -> None:
-    cleaning_merit_sql = """
-    -- Step 1: First identify valid dates and mark rows
-    CREATE OR REPLACE TABLE merit_validation AS
-    with validated_merit_data AS (
+# parsing sql for the raw merit table, {where} limits it to certain dates;
+# the rows are checked against data_quality.MERIT_RULES afterwards
+cleaning_merit_sql = """
+    with parsed_merit_data AS (
         SELECT
+            rowid AS raw_row,
             Date as date,
-            CASE WHEN "PERIOD" BETWEEN 1 AND 48 THEN "PERIOD" ELSE NULL END AS period,
-            CASE WHEN "Total Offer Capacity At Specified Offer Price (MW)" >= 0 THEN "Total Offer Capacity At Specified Offer Price (MW)" ELSE NULL END AS bid_volumn,
-            CASE WHEN TRY_CAST("Lowest to Highest Offer Price ($/MWh)" AS DOUBLE) IS NOT NULL THEN "Lowest to Highest Offer Price ($/MWh)" ELSE NULL END AS bid_price
+            "PERIOD" AS period,
+            TRY_CAST("Lowest to Highest Offer Price ($/MWh)" AS DOUBLE) AS bid_price,
+            "Total Offer Capacity At Specified Offer Price (MW)" AS bid_volumn
         FROM RAW_MERIT_TABLE
-    ),
-    with_datetime_merit_data AS (
-        SELECT date, period, bid_price, bid_volumn
-        FROM validated_merit_data
-        where date IS NOT NULL AND period IS NOT NULL
     )
     select *
-    from with_datetime_merit_data
-    """
-    cleaning_user_sql = """
-    -- Step 1: First identify valid dates and mark rows
-    CREATE OR REPLACE TABLE user_validation AS
-    with validated_user_data AS (
+    from parsed_merit_data
+    {where}
+"""
+# parsing sql for the raw user table, {where} limits it to certain dates;
+# the rows are checked against data_quality.USEP_RULES afterwards
+cleaning_user_sql = """
+    with parsed_user_data AS (
         SELECT
+            rowid AS raw_row,
             "INFORMATION TYPE" AS info_type,
-            CASE WHEN "PERIOD" BETWEEN 1 AND 48 THEN "PERIOD" ELSE NULL END AS period,
-            CASE WHEN "USEP ($/MWh)" >= 0 THEN "USEP ($/MWh)" ELSE NULL END AS usep_price,
-            CASE WHEN "LCP ($/MWh)" >= 0 THEN "LCP ($/MWh)" ELSE NULL END AS lcp_price,
-            CASE WHEN "DEMAND (MW)" > 0 THEN "DEMAND (MW)" ELSE NULL END AS demand_mw,
-            CASE WHEN "TCL (MW)" >= 0 THEN "TCL (MW)" ELSE NULL END AS tcl_mw,
-            CASE 
-                WHEN TRY_STRPTIME("DATE", '%d %b %Y') IS NOT NULL 
-                AND DAY(STRPTIME("DATE", '%d %b %Y')) <= 31 
-                THEN STRPTIME("DATE", '%d %b %Y')
-                ELSE NULL
-            END AS date
+            TRY_STRPTIME("DATE", '%d %b %Y') AS date,
+            "PERIOD" AS period,
+            "USEP ($/MWh)" AS usep_price,
+            "LCP ($/MWh)" AS lcp_price,
+            "DEMAND (MW)" AS demand_mw,
+            "TCL (MW)" AS tcl_mw
         FROM RAW_USER_TABLE
-    ),
-    with_datetime_user_data AS (
-        select info_type, date, period, usep_price, lcp_price, demand_mw, tcl_mw,
-        from validated_user_data
-        where date IS NOT NULL AND period IS NOT NULL
     )
-
     select *
-    from with_datetime_user_data
+    from parsed_user_data
+    {where}
+"""
+# parsing sql, data-quality rules, columns and the validated column of each rule column named differently
+VALIDATION_TABLES = {
+    "user_validation": {
+        'sql': cleaning_user_sql,
+        'rules': USEP_RULES,
+        'columns': ["info_type", "date", "period", "usep_price", "lcp_price", "demand_mw", "tcl_mw"],
+        'rule_columns': {'information type': "info_type", 'usep': "usep_price", 'lcp': "lcp_price", 'demand': "demand_mw", 'tcl': "tcl_mw"},
+    },
+    "merit_validation": {
+        'sql': cleaning_merit_sql,
+        'rules': MERIT_RULES,
+        'columns': ["date", "period", "bid_price", "bid_volumn"],
+        'rule_columns': {},
+    },
+}
+# rows breaking a rule are kept in <table>_quarantine, with their raw_row in the raw table,
+# and exported to <table>_quarantine.csv
+QUARANTINE_SUFFIX = "_quarantine"
+# parsed rows of the table being cleansed with the rules they break, on the cleansing cursor only
+CHECKED_TABLE = "validation_checked"
+# rows without a date match load_file.UNDATED, so they are re-checked when the load reports it
+DATES_CONDITION = f"coalesce(CAST(date AS DATE), DATE '{UNDATED}') IN (SELECT UNNEST(?::DATE[]))"
+# version counter of every validated table, bumped whenever its rows are rewritten,
+# so results derived from a table can tell whether they are stale
+TABLE_VERSIONS = "table_versions"
+
+def table_exists(table_name) -> bool:
+    return con.execute(
+        "SELECT count(*) FROM duckdb_tables() WHERE table_name = ?", [table_name]
+    ).fetchone()[0] > 0
+
+def ensure_table_versions() -> None:
+    con.execute(f"""
+                CREATE TABLE IF NOT EXISTS {TABLE_VERSIONS} (
+                    table_name VARCHAR PRIMARY KEY,
+                    version BIGINT,
+                    updated_at TIMESTAMP
+                )""")
+
+def bump_table_version(table_name) -> None:
+    ensure_table_versions()
+    con.execute(f"""
+                INSERT INTO {TABLE_VERSIONS} VALUES (?, 1, now())
+                ON CONFLICT (table_name) DO UPDATE SET version = version + 1, updated_at = now()
+                """, [table_name])
+
+# 0 for a table that was built before versions were tracked, read-only connections can ask too
+def table_version(table_name) -> int:
+    if not table_exists(TABLE_VERSIONS):
+        return 0
+    row = con.execute(f"SELECT version FROM {TABLE_VERSIONS} WHERE table_name = ?", [table_name]).fetchone()
+    return row[0] if row else 0
+
+# parse the raw rows of a validated table and mark the data-quality rules every row breaks, in one scan
+def check_raw_rows(table_name, where="", params=None):
+    settings = VALIDATION_TABLES[table_name]
+    rules, rule_columns, columns = settings['rules'], settings['rule_columns'], settings['columns']
+    with stage(f"sql.cleansing.check_{table_name}") as run:
+        con.execute(f"""
+            CREATE OR REPLACE TEMP TABLE {CHECKED_TABLE} AS
+            SELECT *,
+                {violations_sql(rules, rule_columns, columns)} AS {VIOLATIONS_COLUMN},
+                {quarantine_sql(rules, rule_columns, columns)} AS quarantined
+            FROM ({settings['sql'].format(where=where)})
+        """, params)
+        counts = con.execute(rule_counts_sql(rules, CHECKED_TABLE)).fetchone()
+        quarantined = con.execute(f"SELECT count(*) FROM {CHECKED_TABLE} WHERE quarantined").fetchone()[0]
+        run.rows = counts[0]
+    return quality_summary(rules, counts[1:], counts[0], quarantined)
+
+# 5.b perform cleaning to the raw table, this will generated 2 validated table
+def cleansing_tables(dates=None, tables=None):
+    """
+    Args:
+        dates: only re-clean these dates in the validated tables, the whole raw tables when None
+        tables: only rebuild these of user_validation / merit_validation, both when None
+
+    Returns:
+        {validated table: data-quality summary (rows, quarantined, violations per rule and per column)}
+        of the rows cleansed now; the rows breaking a rule go to <table>_quarantine instead
     """
     logger.info("ready to execute cleaning sql script")
-    con.execute(cleaning_user_sql)
-    con.execute(cleaning_merit_sql)
+    summaries = {}
+    for table_name, settings in VALIDATION_TABLES.items():
+        if tables is not None and table_name not in tables:
+            continue
+        quarantine_table = table_name + QUARANTINE_SUFFIX
+        columns = ", ".join(settings['columns'])
+        # the table and its quarantine are replaced together
+        with manager.transaction():
+            if dates is None or not table_exists(table_name):
+                summary = check_raw_rows(table_name)
+                with stage(f"sql.cleansing.create_{table_name}") as run:
+                    # raw row order, the cumulative volumes of equal bid prices follow it
+                    con.execute(f"CREATE OR REPLACE TABLE {table_name} AS SELECT {columns} FROM {CHECKED_TABLE} WHERE NOT quarantined ORDER BY raw_row")
+                    con.execute(f"CREATE OR REPLACE TABLE {quarantine_table} AS SELECT raw_row, {columns}, {VIOLATIONS_COLUMN} FROM {CHECKED_TABLE} WHERE quarantined ORDER BY raw_row")
+                    run.rows = summary['rows'] - summary['quarantined']
+            else:
+                dates = list(dates)
+                summary = check_raw_rows(table_name, where=f"where {DATES_CONDITION}", params=[dates])
+                con.execute(f"CREATE TABLE IF NOT EXISTS {quarantine_table} AS SELECT raw_row, {columns}, {VIOLATIONS_COLUMN} FROM {CHECKED_TABLE} LIMIT 0")
+                with stage(f"sql.cleansing.delete_{table_name}") as run:
+                    run.rows = con.execute(f"DELETE FROM {table_name} WHERE {DATES_CONDITION}", [dates]).fetchone()[0]
+                    con.execute(f"DELETE FROM {quarantine_table} WHERE {DATES_CONDITION}", [dates])
+                with stage(f"sql.cleansing.insert_{table_name}") as run:
+                    run.rows = con.execute(f"INSERT INTO {table_name} SELECT {columns} FROM {CHECKED_TABLE} WHERE NOT quarantined ORDER BY raw_row").fetchone()[0]
+                    con.execute(f"INSERT INTO {quarantine_table} SELECT raw_row, {columns}, {VIOLATIONS_COLUMN} FROM {CHECKED_TABLE} WHERE quarantined ORDER BY raw_row")
+                logger.info(f"re-cleansed {len(dates)} dates in {table_name}")
+            con.execute(f"DROP TABLE {CHECKED_TABLE}")
+            export_query(f"SELECT * FROM {quarantine_table}", f"{quarantine_table}.csv")
+            bump_table_version(table_name)
+        log_quality_summary(table_name, summary, f"{quarantine_table}.csv")
+        summaries[table_name] = summary
 
-    # Get cleaned data
-    cleaned_user_df = fetch_table_as_df("user_validation")
-    logger.info("Cleaned User Data Sample:")
-    logger.info(cleaned_user_df.head())
-    cleaned_merit_df = fetch_table_as_df("merit_validation")
-    logger.info("Cleaned Merit Data Sample:")
-    logger.info(cleaned_merit_df.head())
+    # samples of the cleaned data, only the previewed rows are fetched and only when they are logged
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Cleaned User Data Sample:\n%s", format_preview(preview("user_validation")))
+        logger.debug("Cleaned Merit Data Sample:\n%s", format_preview(preview("merit_validation")))
+    return summaries
 
 def main():
     cleansing_tables()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='rebuild user_validation and merit_validation from the raw tables')
+    parser.parse_args()
     main()
     
@@ -1,50 +1,71 @@
-import duckdb
 import sys
 import os
+import argparse
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from logger_config import setup_logger
+from db_connection import manager, thread_cursor, export_query, preview, format_preview, EXPORT_FORMATS
+from stage_metrics import stage
+from given_datetime_final_price import CURVES_TABLE, covering_step_sql, table_exists
 
 
 logger = setup_logger('every_datetime_demand')
-con = duckdb.connect("data.duckdb")
+# the calling thread's cursor on the shared data.duckdb connection
+con = thread_cursor()
 
-def fetch_table_as_df(table_name):
-    return con.execute(f"SELECT * FROM {table_name}").fetchdf()
+EVERY_DATETIME_DEMAND_PATH = "every_datetime_demand.csv"
 
 
 # 5.d for every datetime and demand present in the demand file, calculate the final price
 
-def every_datetime_demand():
-    # sql script to join the merit_cumulative_volumn and usep table, to match the demand with cumulative bid volumn
-    every_datetime_demand = """
-    WITH joined_data AS (
-    SELECT C.*, U.usep_price, U.demand_mw
-    FROM merit_cumulative_volumn C LEFT JOIN user_validation U
-    on C.date = U.date and C.period = U.period
-    where C.cumulative_bid_volumn >= U.demand_mw
-    ),
-    ranked_data AS (
-    SELECT *, ROW_NUMBER() OVER (
-        PARTITION BY date, period
-        ORDER BY cumulative_bid_volumn ASC
-    ) AS rn
-    FROM joined_data
+# sql script to find, for every (date, period) in the user table, the first merit step whose cumulative bid volumn covers the demand.
+# Each period's curve is one merit_curves row, searched by bisection, so the offers are never joined row by row
+every_datetime_demand_sql = f"""
+    WITH steps AS (
+        SELECT
+            C.date,
+            C.period,
+            U.demand_mw,
+            C.bid_prices,
+            C.cumulative_volumes,
+            {covering_step_sql("C.cumulative_volumes", "U.demand_mw")} AS step
+        FROM {CURVES_TABLE} C JOIN user_validation U
+        ON C.date = U.date AND C.period = U.period
+        WHERE U.demand_mw IS NOT NULL
     )
-    SELECT date, period, demand_mw, bid_price as final_bid_price, cumulative_bid_volumn
-    FROM ranked_data
-    WHERE rn = 1
+    SELECT
+        date,
+        period,
+        demand_mw,
+        bid_prices[step] AS final_bid_price,
+        cumulative_volumes[step] AS cumulative_bid_volumn
+    FROM steps
+    WHERE step <= len(cumulative_volumes)
     ORDER BY date, period
 """
+
+def every_datetime_demand(output_path=EVERY_DATETIME_DEMAND_PATH):
+    """
+    Args:
+        output_path: .csv or .parquet file, written by DuckDB straight from the query
+    """
+    if not table_exists(CURVES_TABLE):
+        raise ValueError(f"{CURVES_TABLE} is not built yet, run given_datetime_final_price.py --refresh once")
     logger.info("ready to execute the sql")
     logger.info("final result will be : datetime, period, demand, final_bid_price, cumulative_bid_volumn")
-    result_df = con.execute(every_datetime_demand).fetchdf()
-    print(result_df.head())
-    logger.info("save the result to every_datetime_demand.csv ")
-    result_df.to_csv("every_datetime_demand.csv")
+    with stage("sql.every_datetime_demand") as run:
+        run.rows = export_query(every_datetime_demand_sql, output_path)
+    logger.info(f"saved {run.rows} rows to {output_path}")
+    # the first rows are read back from the file, the result itself never comes into Python
+    print(format_preview(preview("'" + output_path.replace("'", "''") + "'")))
 
-def main():
-    every_datetime_demand()
+def main(args):
+    every_datetime_demand(args.output)
 
 if __name__ == "__main__":
-    main()
-    
+    parser = argparse.ArgumentParser(description='clearing price of every (date, period) demand in user_validation')
+    parser.add_argument('--output', default=EVERY_DATETIME_DEMAND_PATH,
+                        help=f'result file, {" or ".join(EXPORT_FORMATS)} (default: {EVERY_DATETIME_DEMAND_PATH})')
+    args = parser.parse_args()
+    # only reads, so it can run next to other read-only scripts
+    manager.configure(read_only=True)
+    main(args)
@@ -1,57 +1,162 @@
-import duckdb
 import sys
 import os
+import math
 import argparse
+from datetime import date
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from logger_config import setup_logger
+from db_connection import manager, thread_cursor
+from stage_metrics import stage
 from check_final_price import non_negative_demand_number
 from util import validate_date
 
 logger = setup_logger('given_datetime_final_price')
-con = duckdb.connect("data.duckdb")
+# the calling thread's cursor on the shared data.duckdb connection
+con = thread_cursor()
 
-def fetch_table_as_df(table_name):
-    return con.execute(f"SELECT * FROM {table_name}").fetchdf()
+CUMULATIVE_TABLE = "merit_cumulative_volumn"
+# every (date, period) curve of merit_cumulative_volumn as two lists in curve order, so the step
+# covering a demand is found by a binary search over one row instead of a join over every offer
+CURVES_TABLE = "merit_curves"
 
-# 5.c for a manually specified datetime and demand, calculate the final price
-def given_datetime_final_price(date_str: str, period: int, demand:float):
-    logger.info(f"param: date: {date_str}, period:{period}, demand:{demand}")
-    given_param = (date_str, period, demand)
-    # sql script to calculate cumulative volumn
-    create_temp_sql = """
-    CREATE OR REPLACE TABLE merit_cumulative_volumn AS
-    WITH merit_cumulative AS (
-        SELECT 
-            *,
-            SUM(bid_volumn) OVER (
-                PARTITION BY date, period
-                ORDER BY bid_price
-                ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW
-            ) AS cumulative_bid_volumn
-        FROM merit_validation
+# sql script to calculate cumulative volumn, {where} limits it to the periods that need (re)building
+cumulative_sql = """
+    SELECT
+        *,
+        SUM(bid_volumn) OVER (
+            PARTITION BY date, period
+            ORDER BY bid_price
+            ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW
+        ) AS cumulative_bid_volumn
+    FROM merit_validation m
+    {where}
+    ORDER BY date, period, bid_price
+"""
+
+# sql script to collect the curves of merit_cumulative_volumn, {where} limits it to the periods that need (re)building;
+# zero volume steps tie on cumulative volume and go to the lower bid price
+curves_sql = """
+    SELECT
+        date,
+        period,
+        list_transform(steps, lambda step: step.price) AS bid_prices,
+        list_transform(steps, lambda step: step.volume) AS cumulative_volumes
+    FROM (
+        SELECT date, period, list_sort(list(struct_pack(volume := cumulative_bid_volumn, price := bid_price))) AS steps
+        FROM merit_cumulative_volumn c
+        {where}
+        GROUP BY date, period
     )
-    SELECT * FROM merit_cumulative;
-    """
-    logger.info("ready to execute sql script to calculate cumulative volumn")
-    con.execute(create_temp_sql)
+"""
+
+# sql expression of the 1-based position of the first volume >= demand in a sorted volumes list,
+# len(volumes) + 1 when the demand exceeds the curve. Every row halves its [low, high) range
+# log2(curve length) times instead of comparing the demand with every offer
+def covering_step_sql(volumes, demand):
+    return f"""list_reduce(
+        list_transform(range(ceil(log2(len({volumes}) + 1))::BIGINT + 1), lambda i: {{'low': i, 'high': i}}),
+        lambda bounds, _: CASE
+            WHEN bounds.low >= bounds.high THEN bounds
+            WHEN {volumes}[(bounds.low + bounds.high) // 2] < {demand}
+                THEN {{'low': (bounds.low + bounds.high) // 2 + 1, 'high': bounds.high}}
+            ELSE {{'low': bounds.low, 'high': (bounds.low + bounds.high) // 2}}
+        END,
+        {{'low': 1::BIGINT, 'high': len({volumes}) + 1}}
+    ).low"""
 
-    # sql script to find the final price on certain datetime
-    final_price_sql = """
+# sql script to find the final price on certain datetime, prepared once per thread cursor
+final_price_sql = """
+    PREPARE final_price AS
     SELECT bid_price AS final_bid_price
     FROM merit_cumulative_volumn
-    WHERE date = ? AND period = ? AND cumulative_bid_volumn >= ?
+    WHERE date = $1 AND period = $2 AND cumulative_bid_volumn >= $3
     ORDER BY bid_price ASC
     LIMIT 1
+"""
+
+def table_exists(table_name) -> bool:
+    return con.execute(
+        "SELECT count(*) FROM duckdb_tables() WHERE table_name = ?", [table_name]
+    ).fetchone()[0] > 0
+
+def cumulative_table_exists() -> bool:
+    return table_exists(CUMULATIVE_TABLE)
+
+# materialize merit_cumulative_volumn and merit_curves once, afterwards only build the periods that are missing
+def refresh_cumulative_table(dates=None) -> None:
+    """
+    Args:
+        dates: dates whose merit_validation rows changed, their periods are rebuilt;
+               periods of new dates are always added
     """
-    logger.info("ready to execute sql script to calculate final_bid_price")
-    result_df = con.execute(final_price_sql, given_param).fetchdf()
+    # one transaction, so parallel lookups never see a half rebuilt date
+    with manager.transaction():
+        if not cumulative_table_exists():
+            logger.info("ready to execute sql script to materialize cumulative volumn")
+            with stage("sql.cumulative.create") as run:
+                con.execute(f"CREATE TABLE {CUMULATIVE_TABLE} AS " + cumulative_sql.format(where=""))
+                run.rows = con.execute(f"SELECT count(*) FROM {CUMULATIVE_TABLE}").fetchone()[0]
+            create_curves_table()
+            return
+
+        if dates:
+            logger.info(f"rebuild cumulative volumn for {len(dates)} changed dates")
+            with stage("sql.cumulative.delete") as run:
+                run.rows = con.execute(f"DELETE FROM {CUMULATIVE_TABLE} WHERE date IN (SELECT UNNEST(?::DATE[]))", [list(dates)]).fetchone()[0]
+
+        # only (date, period) pairs that are not built yet
+        missing_periods = f"""
+        WHERE NOT EXISTS (
+            SELECT 1 FROM {CUMULATIVE_TABLE} c WHERE c.date = m.date AND c.period = m.period
+        )
+        """
+        with stage("sql.cumulative.insert") as run:
+            inserted = run.rows = con.execute(f"INSERT INTO {CUMULATIVE_TABLE} " + cumulative_sql.format(where=missing_periods)).fetchone()[0]
+        logger.info(f"added {inserted} rows to {CUMULATIVE_TABLE}")
+
+        if not table_exists(CURVES_TABLE):
+            create_curves_table()
+            return
+        if dates:
+            con.execute(f"DELETE FROM {CURVES_TABLE} WHERE date IN (SELECT UNNEST(?::DATE[]))", [list(dates)])
+        missing_curves = f"""
+        WHERE NOT EXISTS (
+            SELECT 1 FROM {CURVES_TABLE} k WHERE k.date = c.date AND k.period = c.period
+        )
+        """
+        with stage("sql.curves.insert") as run:
+            run.rows = con.execute(f"INSERT INTO {CURVES_TABLE} " + curves_sql.format(where=missing_curves)).fetchone()[0]
+
+def create_curves_table() -> None:
+    with stage("sql.curves.create") as run:
+        con.execute(f"CREATE OR REPLACE TABLE {CURVES_TABLE} AS " + curves_sql.format(where=""))
+        run.rows = con.execute(f"SELECT count(*) FROM {CURVES_TABLE}").fetchone()[0]
+
+# 5.c for a manually specified datetime and demand, calculate the final price
+def given_datetime_final_price(date_str: str, period: int, demand:float):
+    logger.info("param: date: %s, period:%s, demand:%s", date_str, period, demand)
+    # nan or inf would go into the EXECUTE text below and fail in the SQL parser
+    if not math.isfinite(float(demand)):
+        raise ValueError(f"demand {demand} is not a finite number")
+    if not cumulative_table_exists():
+        if manager.read_only:
+            raise ValueError(f"{CUMULATIVE_TABLE} is not built yet, run once with --refresh")
+        refresh_cumulative_table()
+
+    manager.prepare("final_price", final_price_sql)
+    logger.info("ready to execute prepared sql script to calculate final_bid_price")
+    # EXECUTE does not take bound parameters, the values are typed here before they go into the statement
+    date_literal = date.fromisoformat(str(date_str)).isoformat()
+    with stage("sql.final_price", rows=1):
+        result = con.execute(f"EXECUTE final_price(DATE '{date_literal}', {int(period)}, {float(demand)!r})").fetchone()
 
     # get the final price
-    if not result_df.empty:
-        price = result_df.iloc[0]["final_bid_price"]
+    if result is not None:
+        price = result[0]
         print(f"The final clearing price for demand {demand} on {date_str} period {period} is: ${price:.2f}/MWh")
-        logger.info(f"The final clearing price for demand {demand} on {date_str} period {period} is: ${price:.2f}/MWh")
-    # if result_df is empty raise ValueError
+        logger.info("The final clearing price for demand %s on %s period %s is: $%.2f/MWh", demand, date_str, period, price)
+        return price
+    # if result is empty raise ValueError
     else:
         raise ValueError(f"No valid price found for demand {demand} on {date_str} period {period}.")
 
@@ -69,5 +174,10 @@ if __name__ == "__main__":
     parser.add_argument('--period', type=int, choices=range(1, 49), 
                       help='30-min period (1-48)')
     parser.add_argument('--demand', type=non_negative_demand_number, help='Non-negative demand value (can be integer or float)')
+    parser.add_argument('--refresh', action='store_true', help='add newly cleansed periods to merit_cumulative_volumn first')
     args = parser.parse_args()
+    # lookups only read, so several of them can share the database file
+    manager.configure(read_only=not args.refresh)
+    if args.refresh:
+        refresh_cumulative_table()
     main(args)
\ No newline at end of file
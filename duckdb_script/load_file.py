@@ -1,59 +1,239 @@
-import duckdb
 import sys
 import os
+import glob
+import hashlib
+import argparse
+from datetime import date
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from logger_config import setup_logger
+from db_connection import manager, thread_cursor
+from stage_metrics import stage
 
 
 logger = setup_logger('load_duckdb_file')
-con = duckdb.connect("data.duckdb")
-
-def fetch_table_as_df(table_name):
-    return con.execute(f"SELECT * FROM {table_name}").fetchdf()
-
-# 5.a load the raw merit order and demand file into tables
-def load_file_into_db() -> None:
-    merit_file_path = r"../raw_data/DelayedOfferStacks_Energy_01-Jan-2023 to 31-Jan-2023.csv"
-    user_file_path = r"../raw_data/USEP_Jan-2023.csv"
-    # create/replace table RAW_MERIT_TABLE, pre-define the column data type
-    con.execute("""
-                CREATE OR REPLACE TABLE RAW_MERIT_TABLE AS 
-                SELECT * FROM 
-                read_csv(?,
-                skip = 2,
-                header = true,
-                delim = ',',
-                columns = {
-                    'Date': 'DATE',
-                    'Period': 'INTEGER',
-                    'Lowest to Highest Offer Price ($/MWh)': 'DOUBLE',
-                    'Total Offer Capacity At Specified Offer Price (MW)': 'DOUBLE'
-                },
-                dateformat = '%d-%b-%Y'
-                )
-                """, [merit_file_path])
-    # create/replace table RAW_USER_TABLE, pre-define the column data type
-    # since user table DATE column 01 Jan 2023 cant directly change to date type, will put as varchar first
-    con.execute("""
-                CREATE OR REPLACE TABLE RAW_USER_TABLE AS 
-                SELECT * FROM 
-                read_csv(?,
-                header = true,
-                delim = ',',
-                columns = {
-                    'INFORMATION TYPE': 'VARCHAR',
-                    'DATE': 'VARCHAR',
-                    'PERIOD': 'INTEGER',
-                    'USEP ($/MWh)': 'DOUBLE',
-                    'LCP ($/MWh)': 'DOUBLE',
-                    'DEMAND (MW)': 'DOUBLE',
-                    'TCL (MW)': 'DOUBLE'
-                })
-                """, [user_file_path])
-
-def main():
-    load_file_into_db()
+# the calling thread's cursor on the shared data.duckdb connection
+con = thread_cursor()
+
+RAW_DATA_DIR = r"../raw_data/"
+MANIFEST_TABLE = "load_manifest"
+# date key of the rows with an unparsable date. It is reported with the affected dates, so the
+# cleansing re-checks those rows (they belong to no date and are quarantined) whenever they change
+UNDATED = date(1, 1, 1)
+
+# column data types and read_csv options of each raw file kind, file names start with the prefix
+RAW_FILE_KINDS = {
+    'merit': {
+        'prefix': "DelayedOfferStacks",
+        'table': "RAW_MERIT_TABLE",
+        'columns': {
+            'Date': 'DATE',
+            'Period': 'INTEGER',
+            'Lowest to Highest Offer Price ($/MWh)': 'DOUBLE',
+            'Total Offer Capacity At Specified Offer Price (MW)': 'DOUBLE'
+        },
+        'options': "skip = 2, dateformat = '%d-%b-%Y',",
+        'date_sql': "Date",
+    },
+    'user': {
+        'prefix': "USEP",
+        'table': "RAW_USER_TABLE",
+        # since user table DATE column 01 Jan 2023 cant directly change to date type, will put as varchar first
+        'columns': {
+            'INFORMATION TYPE': 'VARCHAR',
+            'DATE': 'VARCHAR',
+            'PERIOD': 'INTEGER',
+            'USEP ($/MWh)': 'DOUBLE',
+            'LCP ($/MWh)': 'DOUBLE',
+            'DEMAND (MW)': 'DOUBLE',
+            'TCL (MW)': 'DOUBLE'
+        },
+        'options': "",
+        'date_sql': "CAST(TRY_STRPTIME(\"DATE\", '%d %b %Y') AS DATE)",
+    },
+}
+
+def read_csv_sql(settings):
+    columns = ", ".join(f"'{name}': '{dtype}'" for name, dtype in settings['columns'].items())
+    return f"read_csv(?, header = true, delim = ',', {settings['options']} columns = {{{columns}}})"
+
+def table_columns(table_name):
+    return [row[0] for row in con.execute(
+        "SELECT column_name FROM duckdb_columns() WHERE table_name = ?", [table_name]
+    ).fetchall()]
+
+def file_kind(file_path):
+    name = os.path.basename(file_path)
+    for kind, settings in RAW_FILE_KINDS.items():
+        if name.startswith(settings['prefix']):
+            return kind
+    return None
+
+def file_hash(file_path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+# a directory (every csv inside), a glob pattern or a single file
+def discover_files(source):
+    if os.path.isdir(source):
+        paths = glob.glob(os.path.join(source, "*.csv"))
+    else:
+        paths = glob.glob(source)
+    return sorted(os.path.abspath(path) for path in paths if file_kind(path))
+
+def ensure_tables() -> None:
+    with manager.write_lock:
+        # manifests keyed by absolute path are dropped, the raw tables below are rebuilt with file names
+        if table_columns(MANIFEST_TABLE) and "file_name" not in table_columns(MANIFEST_TABLE):
+            con.execute(f"DROP TABLE {MANIFEST_TABLE}")
+            for settings in RAW_FILE_KINDS.values():
+                con.execute(f"DROP TABLE IF EXISTS {settings['table']}")
+        con.execute(f"""
+                    CREATE TABLE IF NOT EXISTS {MANIFEST_TABLE} (
+                        file_name VARCHAR PRIMARY KEY,
+                        file_path VARCHAR,
+                        file_kind VARCHAR,
+                        file_size BIGINT,
+                        file_mtime DOUBLE,
+                        file_hash VARCHAR,
+                        loaded_at TIMESTAMP
+                    )""")
+        for kind, settings in RAW_FILE_KINDS.items():
+            # raw tables from the old full reload have no source_file column, they are rebuilt from the files
+            if "source_file" not in table_columns(settings['table']):
+                columns = ", ".join(f'"{name}" {dtype}' for name, dtype in settings['columns'].items())
+                con.execute(f"CREATE OR REPLACE TABLE {settings['table']} ({columns}, source_file VARCHAR)")
+                con.execute(f"DELETE FROM {MANIFEST_TABLE} WHERE file_kind = ?", [kind])
+
+# rows with an unparsable date are grouped under UNDATED
+def date_key_sql(settings):
+    return f"coalesce({settings['date_sql']}, DATE '{UNDATED}')"
+
+def log_undated_rows(file_name, rows, action):
+    if rows:
+        logger.warning(f"{rows} rows of {file_name} with an unparsable date {action}, they are re-checked by the cleansing")
+
+# load one new or changed file, only the dates whose rows differ are replaced; returns those dates.
+# Rows are keyed by file name, so a raw folder that moves does not load its files a second time
+def load_one_file(file_path, kind, size, mtime, digest):
+    settings = RAW_FILE_KINDS[kind]
+    table = settings['table']
+    file_name = os.path.basename(file_path)
+    date_key = date_key_sql(settings)
+    row_hash = "hash(" + ", ".join(f'"{name}"' for name in settings['columns']) + ")::HUGEINT"
+    fingerprint_sql = f"SELECT {date_key} AS load_date, count(*) AS row_count, sum({row_hash}) AS row_hash FROM {{source}} GROUP BY ALL"
+
+    with manager.transaction():
+        with stage(f"sql.load.read_csv_{kind}") as run:
+            con.execute(f"CREATE OR REPLACE TEMP TABLE incoming_rows AS SELECT *, ? AS source_file FROM {read_csv_sql(settings)}", [file_name, file_path])
+            run.rows = con.execute("SELECT count(*) FROM incoming_rows").fetchone()[0]
+        # compare per-date fingerprints of the previous version of the file and the new one
+        with stage(f"sql.load.diff_{kind}"):
+            changed_dates = [row[0] for row in con.execute(f"""
+                SELECT coalesce(new.load_date, old.load_date)
+                FROM ({fingerprint_sql.format(source=f"{table} WHERE source_file = $file")}) old
+                FULL OUTER JOIN ({fingerprint_sql.format(source="incoming_rows")}) new
+                ON old.load_date = new.load_date
+                WHERE old.row_count IS DISTINCT FROM new.row_count OR old.row_hash IS DISTINCT FROM new.row_hash
+                """, {'file': file_name}).fetchall()]
+        with stage(f"sql.load.delete_{kind}") as run:
+            run.rows = con.execute(f"DELETE FROM {table} WHERE source_file = ? AND {date_key} IN (SELECT UNNEST(?::DATE[]))", [file_name, changed_dates]).fetchone()[0]
+        with stage(f"sql.load.insert_{kind}") as run:
+            run.rows = con.execute(f"INSERT INTO {table} SELECT * FROM incoming_rows WHERE {date_key} IN (SELECT UNNEST(?::DATE[]))", [changed_dates]).fetchone()[0]
+        undated_rows = 0
+        if UNDATED in changed_dates:
+            undated_rows = con.execute(f"SELECT count(*) FROM incoming_rows WHERE {date_key} = ?", [UNDATED]).fetchone()[0]
+        con.execute("DROP TABLE incoming_rows")
+        con.execute(f"INSERT OR REPLACE INTO {MANIFEST_TABLE} VALUES (?, ?, ?, ?, ?, ?, now())",
+                    [file_name, file_path, kind, size, mtime, digest])
+    log_undated_rows(file_name, undated_rows, "loaded")
+    return set(changed_dates)
+
+# drop the rows of a file that was deleted or renamed; returns their dates
+def remove_file(file_name, kind):
+    settings = RAW_FILE_KINDS[kind]
+    date_key = date_key_sql(settings)
+    with manager.transaction():
+        rows_by_date = dict(con.execute(
+            f"SELECT {date_key}, count(*) FROM {settings['table']} WHERE source_file = ? GROUP BY ALL", [file_name]
+        ).fetchall())
+        with stage(f"sql.load.remove_{kind}") as run:
+            run.rows = con.execute(f"DELETE FROM {settings['table']} WHERE source_file = ?", [file_name]).fetchone()[0]
+        con.execute(f"DELETE FROM {MANIFEST_TABLE} WHERE file_name = ?", [file_name])
+    log_undated_rows(file_name, rows_by_date.get(UNDATED, 0), "removed")
+    return set(rows_by_date)
+
+# 5.a load new or changed raw merit order and demand files into tables
+def load_files_into_db(source=RAW_DATA_DIR):
+    """
+    Args:
+        source: directory, glob pattern or file of raw USEP / DelayedOfferStacks csv files
+
+    Returns:
+        set of dates whose raw rows were added, changed or removed, with UNDATED when rows
+        with an unparsable date were
+    """
+    ensure_tables()
+    manifest = {
+        row[0]: row[1:] for row in con.execute(
+            f"SELECT file_name, file_path, file_kind, file_size, file_mtime, file_hash FROM {MANIFEST_TABLE}"
+        ).fetchall()
+    }
+    files = {}
+    for file_path in discover_files(source):
+        file_name = os.path.basename(file_path)
+        if file_name in files:
+            raise ValueError(f"{file_name} is found in {files[file_name]} and {file_path}, raw file names must be unique")
+        files[file_name] = file_path
+
+    affected_dates = set()
+    # a file that is neither found now nor at its last path was deleted or renamed
+    for file_name, (last_path, kind, *_) in manifest.items():
+        if file_name not in files and not os.path.exists(last_path):
+            dates = remove_file(file_name, kind)
+            logger.info(f"removed the rows of {file_name}, it is no longer at {last_path}")
+            affected_dates |= dates
+
+    for file_name, file_path in files.items():
+        stat = os.stat(file_path)
+        known = manifest.get(file_name)
+        # same size and mtime: unchanged without reading the file
+        if known and known[2] == stat.st_size and known[3] == stat.st_mtime:
+            if known[0] != file_path:
+                with manager.write_lock:
+                    con.execute(f"UPDATE {MANIFEST_TABLE} SET file_path = ? WHERE file_name = ?", [file_path, file_name])
+            continue
+        digest = file_hash(file_path)
+        if known and known[4] == digest:
+            with manager.write_lock:
+                con.execute(f"UPDATE {MANIFEST_TABLE} SET file_path = ?, file_mtime = ? WHERE file_name = ?",
+                            [file_path, stat.st_mtime, file_name])
+            continue
+        dates = load_one_file(file_path, file_kind(file_path), stat.st_size, stat.st_mtime, digest)
+        logger.info(f"loaded {file_path}, {len(dates)} dates changed")
+        affected_dates |= dates
+    logger.info(f"{len(affected_dates)} dates affected by the load")
+    return affected_dates
+
+# load the new files, then re-run cleansing and the cumulative volumn only for the affected dates
+def ingest(source=RAW_DATA_DIR) -> None:
+    from duckdb_cleansed_file import cleansing_tables
+    from given_datetime_final_price import refresh_cumulative_table
+
+    affected_dates = sorted(load_files_into_db(source))
+    if not affected_dates:
+        logger.info("no new or changed raw files")
+        return
+    cleansing_tables(affected_dates)
+    refresh_cumulative_table(affected_dates)
+
+def main(args):
+    ingest(args.source)
 
 if __name__ == "__main__":
-    main()
-    
+    parser = argparse.ArgumentParser(description='load new or changed raw files into data.duckdb')
+    parser.add_argument('--source', default=RAW_DATA_DIR, help='directory or glob of raw USEP / DelayedOfferStacks csv files')
+    args = parser.parse_args()
+    main(args)
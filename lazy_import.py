@@ -0,0 +1,25 @@
+import sys
+import importlib.util
+
+
+# module that is only imported when one of its attributes is first used, so entry points
+# answer --help and argument errors without paying for pandas / numpy / pyarrow
+def lazy_import(name):
+    """
+    Args:
+        name: top-level module name, e.g. 'pandas'
+
+    Returns:
+        the module (loaded on first attribute access), or None when it is not installed
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        return None
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
@@ -1,38 +1,152 @@
 import logging
+import logging.handlers
 import os
-from datetime import datetime
+import queue
+import atexit
+import threading
+import multiprocessing
+
+# settings can be overridden per run through environment variables
+LOG_DIR = os.environ.get("LOG_DIR", "logs")
+LOG_FILE = os.environ.get("LOG_FILE", "pipeline.log")
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+# size based rotation by default, set LOG_ROTATE_WHEN (e.g. 'midnight') for time based rotation
+LOG_MAX_BYTES = int(os.environ.get("LOG_MAX_BYTES", 10 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.environ.get("LOG_BACKUP_COUNT", 5))
+LOG_ROTATE_WHEN = os.environ.get("LOG_ROTATE_WHEN")
+
+FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+_queue_handler = None
+_listener = None
+_listener_lock = threading.Lock()
+# worker processes log to this queue, a second listener thread of the parent writes it with the same handlers
+_process_queue = None
+_process_listener = None
+# True in a worker process: records go to the parent, the worker never opens the log file
+_worker = False
+
+
+class _LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that starts the writer thread on the first record. Like the stock handler,
+    prepare renders msg % args on the calling thread, so objects logged and then mutated
+    are written as they were; the logger level check keeps disabled records from being rendered.
+    """
+
+    def enqueue(self, record):
+        # the log file is only opened once something is logged, importing a module does no I/O
+        if _listener is None and not _worker:
+            _ensure_listener()
+        super().enqueue(record)
+
+
+def _file_handler():
+    os.makedirs(LOG_DIR, exist_ok=True)
+    path = os.path.join(LOG_DIR, LOG_FILE)
+    if LOG_ROTATE_WHEN:
+        return logging.handlers.TimedRotatingFileHandler(path, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT)
+    return logging.handlers.RotatingFileHandler(path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
+
+
+def _ensure_listener():
+    with _listener_lock:
+        if _listener is None:
+            _start_listener()
+
+
+def _start_listener():
+    """One background thread writes every record to the rotating file and the console"""
+    global _listener
+    formatter = logging.Formatter(FORMAT)
+
+    # File handler
+    file_handler = _file_handler()
+    file_handler.setLevel(LOG_LEVEL)
+    file_handler.setFormatter(formatter)
+
+    # Console handler
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(logging.WARNING)
+    console_handler.setFormatter(formatter)
+
+    _listener = logging.handlers.QueueListener(_queue_handler.queue, file_handler, console_handler, respect_handler_level=True)
+    _listener.start()
+
+
+def _stop_listener():
+    # flush whatever is still queued before the interpreter exits
+    if _worker:
+        return
+    if _process_listener is not None:
+        _process_listener.stop()
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+
+
+def worker_log_queue():
+    """
+    Returns:
+        multiprocessing queue for init_worker_logging; the records put on it are written by
+        this process, so one process owns and rotates the log file
+    """
+    global _process_queue, _process_listener
+    with _listener_lock:
+        if _process_queue is None:
+            if _listener is None:
+                _start_listener()
+            _process_queue = multiprocessing.Queue()
+            _process_listener = logging.handlers.QueueListener(_process_queue, *_listener.handlers, respect_handler_level=True)
+            _process_listener.start()
+    return _process_queue
+
+
+def init_worker_logging(log_queue):
+    """ProcessPoolExecutor initializer, the worker's records go to the queue of worker_log_queue()"""
+    global _worker, _listener, _process_queue, _process_listener
+    _worker = True
+    _listener = _process_listener = None
+    _process_queue = log_queue
+    _get_queue_handler().queue = log_queue
+
+
+def _prepare_fork():
+    # a forked child inherits the queue to the parent's writer, whatever pool or process forks it
+    if _queue_handler is not None and not _worker:
+        worker_log_queue()
+
+
+def _restart_after_fork():
+    # the writer threads do not survive fork, the child sends its records to the parent's
+    global _listener_lock
+    _listener_lock = threading.Lock()
+    if _process_queue is not None:
+        init_worker_logging(_process_queue)
+
+
+def _get_queue_handler():
+    global _queue_handler
+    if _queue_handler is None:
+        _queue_handler = _LazyQueueHandler(queue.SimpleQueue())
+        atexit.register(_stop_listener)
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(before=_prepare_fork, after_in_child=_restart_after_fork)
+    return _queue_handler
+
 
 def setup_logger(name):
-    """Configure a logger with file and console handlers"""
-    # Create logs directory if not exists
-    os.makedirs('logs', exist_ok=True)
-    
+    """Configure a logger that hands records to the shared background writer"""
     # Create logger
     logger = logging.getLogger(name)
-    logger.setLevel(logging.INFO)
-    
+    logger.setLevel(LOG_LEVEL)
+
     # Prevent duplicate handlers
     if logger.handlers:
         return logger
-    
-    # File handler
-    log_file = f"logs/{name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
-    file_handler = logging.FileHandler(log_file)
-    file_handler.setLevel(logging.INFO)
-    
-    # Console handler
-    console_handler = logging.StreamHandler()
-    console_handler.setLevel(logging.WARNING)
-    
-    # Formatter
-    formatter = logging.Formatter(
-        '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-    )
-    file_handler.setFormatter(formatter)
-    console_handler.setFormatter(formatter)
-    
-    # Add handlers
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
-    
-    return logger
\ No newline at end of file
+
+    # logging calls only put the record on a queue, the file write happens on the writer thread
+    logger.addHandler(_get_queue_handler())
+
+    return logger
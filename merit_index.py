@@ -0,0 +1,327 @@
+import os
+import argparse
+from lazy_import import lazy_import
+from logger_config import setup_logger
+from stage_metrics import timed_stage
+
+np = lazy_import("numpy")
+logger = setup_logger('merit_index')
+
+MERIT_INDEX_PATH = "cleansed_data/merit_index.bin"
+
+# file layout: header, keys[n_keys], offsets[n_keys + 1], bid prices[n_rows], cumulative volumes[n_rows]
+MAGIC = b"MERITIDX"
+VERSION = 1
+HEADER_FIELDS = [('magic', 'S8'), ('version', '<u4'), ('reserved', '<u4'), ('n_keys', '<i8'), ('n_rows', '<i8')]
+
+PERIODS_PER_DAY = 48
+SLOT_NS = 30 * 60 * 10**9
+
+# error flags of the batch lookups
+PRICE_OK = 0
+UNKNOWN_PERIOD = 1
+DEMAND_EXCEEDS_CAPACITY = 2
+INVALID_DEMAND = 3
+INVALID_PRICE = 4
+ERROR_NAMES = {
+    PRICE_OK: "ok",
+    UNKNOWN_PERIOD: "unknown_period",
+    DEMAND_EXCEEDS_CAPACITY: "demand_exceeds_capacity",
+    INVALID_DEMAND: "invalid_demand",
+    INVALID_PRICE: "invalid_price",
+}
+
+
+# key of one (date, period): number of 30min slots since 1970-01-01, period 1 is the first slot of the day
+def period_key(date, period):
+    day = np.datetime64(date, 'D').astype(np.int64)
+    return day * PERIODS_PER_DAY + (int(period) - 1)
+
+
+def period_keys(dates, periods):
+    days = np.asarray(dates, dtype='datetime64[D]').astype(np.int64)
+    return days * PERIODS_PER_DAY + (np.asarray(periods, dtype=np.int64) - 1)
+
+
+class MeritIndex:
+    """
+    Sorted bid prices and cumulative bid volumes of every (date, period),
+    stored as flat arrays with an offsets table so one period is an O(1) slice.
+    """
+
+    def __init__(self, keys, offsets, prices, cumulative_volumes):
+        self.keys = keys
+        self.offsets = offsets
+        self.prices = prices
+        self.cumulative_volumes = cumulative_volumes
+        self._positions = dict(zip(keys.tolist(), range(len(keys))))
+
+    def __len__(self):
+        return len(self.keys)
+
+    @classmethod
+    def from_frame(cls, df, price_col='bid_price', volume_col='bid_volumn'):
+        """
+        Args:
+            df: cleansed merit DataFrame with datetime index (output of generate_datetime_index)
+
+        Returns:
+            in-memory MeritIndex
+        """
+        import pandas as pd
+        from util import widen_float32
+
+        slots = pd.DatetimeIndex(df.index).as_unit('ns').asi8 // SLOT_NS
+        # compact float32 columns come back at their 7 significant digits, not with float32 noise
+        prices = widen_float32(df[price_col].to_numpy()).astype(np.float64)
+        volumes = widen_float32(df[volume_col].to_numpy()).astype(np.float64)
+
+        # sort by period then bid price, same order as cumulative_vol_for_certain_period
+        order = np.lexsort((prices, slots))
+        slots, prices, volumes = slots[order], prices[order], volumes[order]
+        keys, starts = np.unique(slots, return_index=True)
+        offsets = np.append(starts, len(slots)).astype(np.int64)
+
+        # plain cumsum per period, so the volumes match cumulative_vol_for_certain_period bit for bit
+        cumulative_volumes = np.empty_like(volumes)
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            np.cumsum(volumes[start:end], out=cumulative_volumes[start:end])
+        return cls(keys.astype(np.int64), offsets, prices, cumulative_volumes)
+
+    def write(self, path=MERIT_INDEX_PATH):
+        header = np.zeros(1, dtype=HEADER_FIELDS)
+        header['magic'] = MAGIC
+        header['version'] = VERSION
+        header['n_keys'] = len(self.keys)
+        header['n_rows'] = len(self.prices)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            for array in (header, self.keys, self.offsets, self.prices, self.cumulative_volumes):
+                f.write(np.ascontiguousarray(array).tobytes())
+        # readers never see a half written file
+        os.replace(tmp_path, path)
+        logger.info(f"merit index with {len(self.keys)} periods and {len(self.prices)} offers written to {path}")
+
+    @classmethod
+    def open(cls, path=MERIT_INDEX_PATH):
+        header = np.fromfile(path, dtype=HEADER_FIELDS, count=1)
+        if len(header) == 0 or header['magic'][0] != MAGIC or header['version'][0] != VERSION:
+            raise ValueError(f"{path} is not a merit index file")
+        n_keys, n_rows = int(header['n_keys'][0]), int(header['n_rows'][0])
+
+        arrays = []
+        offset = header.dtype.itemsize
+        for dtype, count in ((np.int64, n_keys), (np.int64, n_keys + 1), (np.float64, n_rows), (np.float64, n_rows)):
+            if count:
+                arrays.append(np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(count,)))
+            else:
+                arrays.append(np.empty(0, dtype=dtype))
+            offset += count * np.dtype(dtype).itemsize
+        return cls(*arrays)
+
+    def curve(self, date, period):
+        """Sorted bid prices and cumulative volumes of one period"""
+        # period 0 would otherwise land on period 48 of the previous day, same guard as query_positions
+        if not 1 <= int(period) <= PERIODS_PER_DAY:
+            raise KeyError(f"Period {period} is outside 1-{PERIODS_PER_DAY}")
+        position = self._positions.get(int(period_key(date, period)))
+        if position is None:
+            raise KeyError(f"No merit data for {date} period {period}")
+        start, end = self.offsets[position], self.offsets[position + 1]
+        return self.prices[start:end], self.cumulative_volumes[start:end]
+
+    def clearing_price(self, date, period, demand):
+        prices, cumulative_volumes = self.curve(date, period)
+        if not np.isfinite(demand) or demand < 0:
+            raise ValueError(f"Invalid demand {demand}")
+        max_vol = cumulative_volumes[-1]
+        if demand > max_vol:
+            raise ValueError(f"Demand {demand} exceeds maximum capacity {max_vol}")
+        # first step where cumulative volume meets or exceeds demand
+        return float(prices[np.searchsorted(cumulative_volumes, demand, side='left')])
+
+    def positions(self, keys):
+        """Position of every period key in the index, -1 when it is not stored"""
+        keys = np.asarray(keys, dtype=np.int64)
+        if len(self.keys) == 0:
+            return np.full(len(keys), -1, dtype=np.int64)
+        found = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return np.where(self.keys[found] == keys, found, -1)
+
+    def query_positions(self, dates, periods):
+        """Position of every queried (date, period) in the index, -1 when it is unknown or invalid"""
+        dates = np.asarray(dates, dtype='datetime64[D]')
+        periods = np.asarray(periods, dtype=np.int64)
+        positions = self.positions(period_keys(dates, periods))
+        # period 0 would otherwise land on period 48 of the previous day
+        positions[np.isnat(dates) | (periods < 1) | (periods > PERIODS_PER_DAY)] = -1
+        return positions
+
+    def clearing_prices(self, dates, periods, demands):
+        """
+        Args:
+            dates: array of dates ('YYYY-MM-DD' strings, datetime64 or date objects)
+            periods: array of periods (1-48)
+            demands: array of demands in MW
+
+        Returns:
+            (prices, errors): float64 prices, NaN where the query failed, and the
+            int8 error flag of every query (PRICE_OK, UNKNOWN_PERIOD, ...)
+        """
+        demands = np.asarray(demands, dtype=np.float64)
+        positions = self.query_positions(dates, periods)
+        prices = np.full(len(demands), np.nan)
+        errors = np.full(len(demands), PRICE_OK, dtype=np.int8)
+
+        errors[positions < 0] = UNKNOWN_PERIOD
+        errors[(positions >= 0) & ~(demands >= 0)] = INVALID_DEMAND
+        ok = errors == PRICE_OK
+        max_vols = self.cumulative_volumes[self.offsets[positions[ok] + 1] - 1]
+        errors[np.flatnonzero(ok)[demands[ok] > max_vols]] = DEMAND_EXCEEDS_CAPACITY
+
+        ok = errors == PRICE_OK
+        rows = search_segments(self.cumulative_volumes, self.offsets[positions[ok]], self.offsets[positions[ok] + 1], demands[ok])
+        prices[ok] = self.prices[rows]
+        return prices, errors
+
+    def clearing_price_matrix(self, dates, periods, demands):
+        """
+        Args:
+            dates: array of n dates
+            periods: array of n periods (1-48)
+            demands: (n, k) demands in MW, one column per scenario
+
+        Returns:
+            (prices, errors): (n, k) float64 prices, NaN where there is none, and int8 error flags.
+            The curve of every period is looked up once and shared by all k demands
+        """
+        positions = self.query_positions(dates, periods)
+        demands = np.asarray(demands, dtype=np.float64).reshape(len(positions), -1)
+        known = positions >= 0
+        starts = np.zeros(len(positions), dtype=np.int64)
+        ends = np.zeros(len(positions), dtype=np.int64)
+        starts[known] = self.offsets[positions[known]]
+        ends[known] = self.offsets[positions[known] + 1]
+        max_vols = np.full(len(positions), np.nan)
+        max_vols[known] = self.cumulative_volumes[ends[known] - 1]
+
+        errors = np.full(demands.shape, PRICE_OK, dtype=np.int8)
+        errors[~known] = UNKNOWN_PERIOD
+        errors[known[:, None] & ~(demands >= 0)] = INVALID_DEMAND
+        errors[(errors == PRICE_OK) & (demands > max_vols[:, None])] = DEMAND_EXCEEDS_CAPACITY
+
+        ok = errors == PRICE_OK
+        rows, _ = np.nonzero(ok)
+        prices = np.full(demands.shape, np.nan)
+        prices[ok] = self.prices[search_segments(self.cumulative_volumes, starts[rows], ends[rows], demands[ok])]
+        return prices, errors
+
+    def supply_at_prices(self, dates, periods, price_caps):
+        """
+        Inverse of clearing_prices: what the curve of every (date, period) offers up to a price cap
+
+        Args:
+            dates: array of dates ('YYYY-MM-DD' strings, datetime64 or date objects)
+            periods: array of periods (1-48)
+            price_caps: array of prices in $/MWh
+
+        Returns:
+            dict of arrays with one entry per query:
+                offered_volume: capacity offered at or below the cap, 0 when every offer is above it
+                marginal_step: position of the most expensive offer at or below the cap in its period curve, -1 when none
+                marginal_price: bid price of that offer
+                next_price: cheapest bid price above the cap, NaN when the whole curve is at or below it
+                price_headroom: next_price minus the cap
+                next_step_volume: capacity offered at next_price
+                error: int8 error flag (PRICE_OK, UNKNOWN_PERIOD, INVALID_PRICE)
+            failed queries have NaN values and marginal_step -1
+        """
+        price_caps = np.asarray(price_caps, dtype=np.float64)
+        positions = self.query_positions(dates, periods)
+        n = len(price_caps)
+        result = {
+            'offered_volume': np.full(n, np.nan),
+            'marginal_step': np.full(n, -1, dtype=np.int64),
+            'marginal_price': np.full(n, np.nan),
+            'next_price': np.full(n, np.nan),
+            'price_headroom': np.full(n, np.nan),
+            'next_step_volume': np.full(n, np.nan),
+            'error': np.full(n, PRICE_OK, dtype=np.int8),
+        }
+        errors = result['error']
+        errors[positions < 0] = UNKNOWN_PERIOD
+        errors[(positions >= 0) & np.isnan(price_caps)] = INVALID_PRICE
+        ok = np.flatnonzero(errors == PRICE_OK)
+        if len(ok) == 0:
+            return result
+        caps = price_caps[ok]
+        starts = self.offsets[positions[ok]]
+        ends = self.offsets[positions[ok] + 1]
+        last_row = len(self.prices) - 1
+
+        # first offer priced above the cap, every offer before it is dispatched at the cap
+        above = search_segments(self.prices, starts, ends, caps, side='right')
+        has_marginal = above > starts
+        marginal = np.maximum(above - 1, 0)
+        offered = np.where(has_marginal, self.cumulative_volumes[marginal], 0.0)
+        result['offered_volume'][ok] = offered
+        result['marginal_step'][ok] = np.where(has_marginal, above - 1 - starts, -1)
+        result['marginal_price'][ok] = np.where(has_marginal, self.prices[marginal], np.nan)
+
+        # the next price step groups every offer at the next price
+        has_next = above < ends
+        next_prices = np.where(has_next, self.prices[np.minimum(above, last_row)], np.nan)
+        next_end = search_segments(self.prices, above, ends, next_prices, side='right')
+        result['next_price'][ok] = next_prices
+        result['price_headroom'][ok] = next_prices - caps
+        result['next_step_volume'][ok] = np.where(has_next, self.cumulative_volumes[np.maximum(next_end - 1, 0)] - offered, np.nan)
+        return result
+
+
+# vectorized binary search of many targets, each inside its own sorted segment [start, end) of values
+def search_segments(values, starts, ends, targets, side='left'):
+    """
+    Returns:
+        index of the first value >= target (side='left') or > target (side='right')
+        inside every segment, end when there is none
+    """
+    low = np.asarray(starts, dtype=np.int64).copy()
+    high = np.asarray(ends, dtype=np.int64).copy()
+    targets = np.asarray(targets, dtype=np.float64)
+    # every query halves its own segment on each pass, so the loop runs log2(longest segment) times
+    active = low < high
+    while active.any():
+        mid = (low + high) // 2
+        # finished queries may sit on the end of the array, clip them to a valid row
+        mid_values = values[np.minimum(mid, len(values) - 1)]
+        go_right = mid_values < targets if side == 'left' else mid_values <= targets
+        low = np.where(active & go_right, mid + 1, low)
+        high = np.where(active & ~go_right, mid, high)
+        active = low < high
+    return low
+
+
+# one-time build step from the cleansed merit data
+@timed_stage("build_merit_index", rows=lambda index: len(index.prices))
+def build_merit_index(df, path=MERIT_INDEX_PATH):
+    index = MeritIndex.from_frame(df)
+    index.write(path)
+    return index
+
+# rebuilds the index from cleansed merit csv files, reading only the columns the index keeps
+def build_merit_index_from_csv(csv_paths, path=MERIT_INDEX_PATH):
+    import pandas as pd
+    if isinstance(csv_paths, str):
+        csv_paths = [csv_paths]
+    frames = [pd.read_csv(csv_path, usecols=['datetime', 'bid_price', 'bid_volumn'], index_col='datetime', parse_dates=True)
+              for csv_path in csv_paths]
+    return build_merit_index(pd.concat(frames) if len(frames) > 1 else frames[0], path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='build the memory-mapped merit curve index')
+    parser.add_argument('--input', default="cleansed_data/merit_cleansed.csv", help='cleansed merit csv file')
+    parser.add_argument('--output', default=MERIT_INDEX_PATH, help='index file path')
+    args = parser.parse_args()
+
+    build_merit_index_from_csv(args.input, args.output)
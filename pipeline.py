@@ -0,0 +1,327 @@
+from lazy_import import lazy_import
+from logger_config import setup_logger, init_worker_logging, worker_log_queue
+from stage_metrics import stage as metrics_stage, worker_call, worker_result
+import os
+import sys
+import json
+import glob
+import hashlib
+import argparse
+import threading
+import time
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+pd = lazy_import("pandas")
+logger = setup_logger('pipeline')
+
+# input key and output fingerprints of every stage after its last run, and the content hash cache of the input files
+PIPELINE_STATE = "pipeline_state.json"
+DUCKDB_SCRIPT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'duckdb_script')
+
+RAN = "ran"
+SKIPPED = "skipped"
+FAILED = "failed"
+BLOCKED = "blocked"
+
+
+class Stage:
+    """
+    One step of a pipeline and what it reads and writes.
+
+    Args:
+        name: unique stage name
+        run: function without arguments doing the work
+        inputs: files or glob patterns the stage reads, hashed by content
+        outputs: files the stage writes
+        tables: DuckDB tables the stage writes
+        deps: names of the stages whose outputs it reads
+        isolated: run in a worker process, for pandas work that holds the GIL;
+                  DuckDB stages stay in this process and share its connection
+    """
+
+    def __init__(self, name, run, inputs=(), outputs=(), tables=(), deps=(), isolated=False):
+        self.name = name
+        self.run = run
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.tables = list(tables)
+        self.deps = list(deps)
+        self.isolated = isolated
+
+
+def file_digest(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+# order independent content hash of a DuckDB table, None when it does not exist
+def table_digest(table_name):
+    from db_connection import manager
+    con = manager.cursor()
+    if not con.execute("SELECT count(*) FROM duckdb_tables() WHERE table_name = ?", [table_name]).fetchone()[0]:
+        return None
+    rows, row_hash = con.execute(f"SELECT count(*), sum(hash(t)::HUGEINT) FROM {table_name} t").fetchone()
+    return f"{rows}:{row_hash}"
+
+
+# runs the stages in dependency order, independent ones at the same time, and skips every
+# stage whose inputs have the same content as on its last run and whose outputs are untouched
+class PipelineRunner:
+    def __init__(self, stages, state_path=PIPELINE_STATE, workers=None, force=False):
+        self.stages = {}
+        for stage in stages:
+            if stage.name in self.stages:
+                raise ValueError(f"duplicate stage {stage.name}")
+            self.stages[stage.name] = stage
+        for stage in stages:
+            unknown = [dep for dep in stage.deps if dep not in self.stages]
+            if unknown:
+                raise ValueError(f"stage {stage.name} depends on unknown stages {unknown}")
+        self.order = self.topological_order()
+        self.state_path = state_path
+        self.workers = workers
+        self.force = force
+        self._lock = threading.Lock()
+        self.state = self.load_state()
+
+    def topological_order(self):
+        order, visiting, done = [], set(), set()
+
+        def visit(name):
+            if name in done:
+                return
+            if name in visiting:
+                raise ValueError(f"dependency cycle through stage {name}")
+            visiting.add(name)
+            for dep in self.stages[name].deps:
+                visit(dep)
+            visiting.discard(name)
+            done.add(name)
+            order.append(name)
+
+        for name in self.stages:
+            visit(name)
+        return order
+
+    def load_state(self):
+        if not os.path.exists(self.state_path):
+            return {'stages': {}, 'files': {}}
+        with open(self.state_path) as f:
+            return json.load(f)
+
+    def save_state(self):
+        with self._lock:
+            with open(self.state_path + ".tmp", "w") as f:
+                json.dump(self.state, f, indent=1, sort_keys=True)
+            os.replace(self.state_path + ".tmp", self.state_path)
+
+    # content hash of an input file, only re-read when its size or mtime changed
+    def input_file_digest(self, path):
+        stat = os.stat(path)
+        path = os.path.abspath(path)
+        with self._lock:
+            known = self.state['files'].get(path)
+        if known and known[0] == stat.st_size and known[1] == stat.st_mtime:
+            return known[2]
+        digest = file_digest(path)
+        with self._lock:
+            self.state['files'][path] = [stat.st_size, stat.st_mtime, digest]
+        return digest
+
+    def input_key(self, stage):
+        files = sorted({path for pattern in stage.inputs for path in glob.glob(pattern)})
+        with self._lock:
+            deps = {dep: self.state['stages'][dep]['outputs'] for dep in stage.deps}
+        key = {
+            'inputs': {path: self.input_file_digest(path) for path in files},
+            'patterns': stage.inputs,
+            'deps': deps,
+        }
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+    def output_fingerprints(self, stage):
+        outputs = {path: file_digest(path) if os.path.exists(path) else None for path in stage.outputs}
+        outputs.update({f"table:{table}": table_digest(table) for table in stage.tables})
+        return outputs
+
+    def run_stage(self, stage, processes):
+        key = self.input_key(stage)
+        outputs = self.output_fingerprints(stage)
+        with self._lock:
+            recorded = self.state['stages'].get(stage.name)
+        if (not self.force and recorded and recorded['input_key'] == key and recorded['outputs'] == outputs
+                and all(fingerprint is not None for fingerprint in outputs.values())):
+            logger.info(f"{stage.name} is up to date")
+            return SKIPPED
+
+        logger.info(f"running {stage.name}")
+        start = time.perf_counter()
+        with metrics_stage(f"pipeline.{stage.name}"):
+            if stage.isolated:
+                worker_result(processes.submit(worker_call, stage.run))
+            else:
+                stage.run()
+        outputs = self.output_fingerprints(stage)
+        missing = [name for name, fingerprint in outputs.items() if fingerprint is None]
+        if missing:
+            raise RuntimeError(f"{stage.name} did not produce {missing}")
+        with self._lock:
+            self.state['stages'][stage.name] = {'input_key': key, 'outputs': outputs, 'seconds': round(time.perf_counter() - start, 3)}
+        return RAN
+
+    def run(self, only=None):
+        """
+        Args:
+            only: run these stages and what they depend on, every stage when None
+
+        Returns:
+            {stage name: 'ran' | 'skipped' | 'failed' | 'blocked'} in dependency order
+        """
+        selected = set(self.order)
+        if only:
+            selected = set()
+            pending_names = list(only)
+            while pending_names:
+                name = pending_names.pop()
+                if name not in self.stages:
+                    raise ValueError(f"unknown stage {name}")
+                if name not in selected:
+                    selected.add(name)
+                    pending_names.extend(self.stages[name].deps)
+
+        results = {}
+        pending = [name for name in self.order if name in selected]
+        isolated = any(self.stages[name].isolated for name in pending)
+        with ThreadPoolExecutor(max_workers=self.workers) as threads, \
+                (ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker_logging, initargs=(worker_log_queue(),))
+                 if isolated else _NoProcesses()) as processes:
+            running = {}
+            while pending or running:
+                for name in list(pending):
+                    deps = [results.get(dep) for dep in self.stages[name].deps]
+                    if any(status in (FAILED, BLOCKED) for status in deps):
+                        results[name] = BLOCKED
+                        pending.remove(name)
+                        logger.warning(f"{name} not run, a stage it depends on failed")
+                    elif all(status in (RAN, SKIPPED) for status in deps):
+                        pending.remove(name)
+                        running[threads.submit(self.run_stage, self.stages[name], processes)] = name
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except Exception as e:
+                        results[name] = FAILED
+                        logger.error(f"stage {name} failed: {e}")
+                self.save_state()
+        self.save_state()
+        return {name: results[name] for name in self.order if name in results}
+
+
+# stands in for the process pool when no stage is isolated
+class _NoProcesses:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+# clearing price of every (datetime, demand) of the cleansed user table, pandas version of every_datetime_demand.py
+def pandas_every_datetime_demand(output_path="cleansed_data/every_datetime_demand.csv"):
+    from cleansed_file import USEP_OUTPUT_PATH
+    from check_final_price import load_merit_index, batch_check_final_price
+    from merit_index import SLOT_NS
+    from util import read_cleansed_table
+
+    user = read_cleansed_table(USEP_OUTPUT_PATH)
+    days = user.index.normalize()
+    queries = pd.DataFrame({
+        'date': days,
+        'period': (user.index.as_unit('ns').asi8 - days.as_unit('ns').asi8) // SLOT_NS + 1,
+        'demand': user['demand'].to_numpy(),
+    }, index=user.index)
+    result = batch_check_final_price(load_merit_index(), queries)
+    result.to_csv(output_path)
+
+
+def pandas_stages(compact=False, chunksize=None):
+    from cleansed_file import (cleanse_usep_file, cleanse_merit_file, USEP_RAW_PATH, MERIT_RAW_PATH,
+                               USEP_OUTPUT_PATH, MERIT_OUTPUT_PATH, USEP_QUARANTINE_PATH, MERIT_QUARANTINE_PATH)
+    from merit_index import MERIT_INDEX_PATH
+    return [
+        Stage("pandas.cleanse_usep", partial(cleanse_usep_file, compact),
+              inputs=[USEP_RAW_PATH], outputs=[USEP_OUTPUT_PATH, USEP_QUARANTINE_PATH], isolated=True),
+        Stage("pandas.cleanse_merit", partial(cleanse_merit_file, chunksize, compact),
+              inputs=[MERIT_RAW_PATH], outputs=[MERIT_OUTPUT_PATH, MERIT_INDEX_PATH, MERIT_QUARANTINE_PATH], isolated=True),
+        Stage("pandas.every_datetime_demand", pandas_every_datetime_demand,
+              outputs=["cleansed_data/every_datetime_demand.csv"], deps=["pandas.cleanse_usep", "pandas.cleanse_merit"]),
+    ]
+
+
+# the DuckDB scripts resolve data.duckdb and ../raw_data against the working directory, run from duckdb_script
+def duckdb_stages():
+    if DUCKDB_SCRIPT_DIR not in sys.path:
+        sys.path.append(DUCKDB_SCRIPT_DIR)
+    import load_file
+    import duckdb_cleansed_file
+    import given_datetime_final_price
+    import every_datetime_demand
+    import analysis_duckdb
+
+    # dates whose raw rows the load stage of this run added, changed or removed
+    loaded = {}
+
+    def load_raw_files():
+        loaded['dates'] = load_file.load_files_into_db()
+
+    # only the periods of the loaded dates are rebuilt, like load_file.ingest; without a load in this
+    # run the cleansed rows did not change, and only periods missing from the tables are added
+    def refresh_cumulative_table():
+        given_datetime_final_price.refresh_cumulative_table(sorted(loaded.get('dates', ())))
+
+    raw_tables = [settings['table'] for settings in load_file.RAW_FILE_KINDS.values()]
+    quarantine = duckdb_cleansed_file.QUARANTINE_SUFFIX
+    return [
+        Stage("duckdb.load", load_raw_files,
+              inputs=[os.path.join(load_file.RAW_DATA_DIR, "*.csv")], tables=raw_tables),
+        Stage("duckdb.cleanse_user", partial(duckdb_cleansed_file.cleansing_tables, tables=["user_validation"]),
+              outputs=[f"user_validation{quarantine}.csv"], tables=["user_validation", f"user_validation{quarantine}"], deps=["duckdb.load"]),
+        Stage("duckdb.cleanse_merit", partial(duckdb_cleansed_file.cleansing_tables, tables=["merit_validation"]),
+              outputs=[f"merit_validation{quarantine}.csv"], tables=["merit_validation", f"merit_validation{quarantine}"], deps=["duckdb.load"]),
+        Stage("duckdb.cumulative", refresh_cumulative_table,
+              tables=[given_datetime_final_price.CUMULATIVE_TABLE, given_datetime_final_price.CURVES_TABLE], deps=["duckdb.cleanse_merit"]),
+        Stage("duckdb.every_datetime_demand", every_datetime_demand.every_datetime_demand,
+              outputs=["every_datetime_demand.csv"], deps=["duckdb.cumulative", "duckdb.cleanse_user"]),
+        Stage("duckdb.analysis", analysis_duckdb.run_analyses,
+              tables=list(analysis_duckdb.analysis_sql), deps=["duckdb.cleanse_user"]),
+    ]
+
+
+def main(args):
+    stages = pandas_stages(args.compact, args.chunksize) if args.flow == "pandas" else duckdb_stages()
+    runner = PipelineRunner(stages, state_path=args.state, workers=args.workers, force=args.force)
+    results = runner.run(args.only)
+    for name, status in results.items():
+        print(f"{status:8} {name}")
+    return 1 if any(status in (FAILED, BLOCKED) for status in results.values()) else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='run the cleansing and pricing stages, skipping the ones whose inputs did not change')
+    parser.add_argument('--flow', choices=["pandas", "duckdb"], default="pandas",
+                        help='pandas: run from the repository folder; duckdb: run from duckdb_script')
+    parser.add_argument('--only', nargs='*', help='run these stages and the stages they depend on')
+    parser.add_argument('--force', action='store_true', help='run every stage even when its inputs did not change')
+    parser.add_argument('--workers', type=int, default=None, help='stages run at the same time (default: cpu count)')
+    parser.add_argument('--state', default=PIPELINE_STATE, help='file keeping the input hashes of the last runs')
+    parser.add_argument('--compact', action='store_true', help='pandas flow: cleanse with compact dtypes')
+    parser.add_argument('--chunksize', type=int, default=None, help='pandas flow: stream the merit file in chunks of this many rows')
+    args = parser.parse_args()
+    sys.exit(main(args))
@@ -1,60 +1,203 @@
-from cleansed_file import cleansed_file
-import matplotlib.pyplot as plt
-import pandas as pd
-from logger_config import setup_logger
+from lazy_import import lazy_import
+from logger_config import setup_logger, init_worker_logging, worker_log_queue
+from stage_metrics import worker_call, worker_result
 import argparse
-from util import select_certain_period, cumulative_vol_for_certain_period
+import os
+import json
+import hashlib
+import columnar_store
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from util import select_certain_period, cumulative_vol_for_certain_period, read_cleansed_table
 
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
 # Initialize logger
 logger = setup_logger('plot_merit_order')
 
+MERIT_CLEANSED_PATH = "cleansed_data/merit_cleansed.csv"
+PLOT_DIR = "plots"
+# file name -> input hash of every rendered chart, periods with the same hash are not drawn again
+RENDER_MANIFEST = "render_manifest.json"
+# more labels than this overlap into an unreadable block
+MAX_ANNOTATIONS = 20
+DPI = 300
+
+# evenly spaced offer steps to label, always including the cheapest and the most expensive one
+def annotation_positions(n_steps, max_annotations=MAX_ANNOTATIONS):
+    if max_annotations is None or n_steps <= max_annotations:
+        return np.arange(n_steps)
+    if max_annotations <= 0:
+        return np.arange(0)
+    if max_annotations == 1:
+        return np.array([n_steps - 1])
+    return np.unique(np.linspace(0, n_steps - 1, max_annotations).round().astype(int))
+
 # to plot merit table for certain date and period
 
-def plot_merit_table(plot_merit):
+def plot_merit_table(plot_merit, output_path='bid_stack_curve.png', max_annotations=MAX_ANNOTATIONS, dpi=DPI, title=None):
+    # matplotlib is only loaded when a chart is drawn
+    import matplotlib.pyplot as plt
+    cumulative_volume = plot_merit['cumulative_volume'].to_numpy()
+    bid_price = plot_merit['bid_price'].to_numpy()
+
     plt.figure(figsize=(10, 6))
-    plt.step(plot_merit['cumulative_volume'], plot_merit['bid_price'], 
+    plt.step(cumulative_volume, bid_price,
             where='post', linewidth=2, color='b')
-    
+
     # formatting
-    plt.title(f'Bid Stack Curve \n(Cumulative Volume vs. Bid Price)', pad=20)
+    plt.title(title or f'Bid Stack Curve \n(Cumulative Volume vs. Bid Price)', pad=20)
     plt.xlabel('Cumulative Volume (MW)')
     plt.ylabel('Bid Price ($/MWh)')
     plt.grid(True, linestyle='--', alpha=0.7)
 
     # Annotate key points
-    for _, row in plot_merit.iterrows():
-        plt.annotate(f"{row['bid_price']} $", 
-                    (row['cumulative_volume'], row['bid_price']),
+    for i in annotation_positions(len(plot_merit), max_annotations):
+        plt.annotate(f"{bid_price[i]} $",
+                    (cumulative_volume[i], bid_price[i]),
                     textcoords="offset points",
                     xytext=(10,-5),
                     ha='left')
 
 
     plt.tight_layout()
-    plt.savefig('bid_stack_curve.png', dpi=300, bbox_inches='tight')
-    logger.info("the merit order for one day with the cumulative bid volume is saved")
+    plt.savefig(output_path, dpi=dpi, bbox_inches='tight')
+    logger.info("the merit order for one day with the cumulative bid volume is saved to %s", output_path)
     # Close the figure to free memory
     plt.close()
 
 
+def period_plot_name(timestamp, period):
+    return f"bid_stack_curve_{timestamp.strftime('%Y-%m-%d')}_p{period:02d}.png"
+
+# hash of the offers and the drawing settings of one period, a chart is only redrawn when it changes
+def period_input_hash(merit_table, max_annotations, dpi):
+    digest = hashlib.sha256()
+    digest.update(np.ascontiguousarray(merit_table['bid_price'].to_numpy(dtype='float64')).tobytes())
+    digest.update(np.ascontiguousarray(merit_table['bid_volumn'].to_numpy(dtype='float64')).tobytes())
+    digest.update(f"{max_annotations}|{dpi}".encode())
+    return digest.hexdigest()
+
+def load_render_manifest(output_dir):
+    path = os.path.join(output_dir, RENDER_MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_render_manifest(output_dir, manifest):
+    path = os.path.join(output_dir, RENDER_MANIFEST)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+# worker: build the cumulative curve of one period and draw it
+def render_period_curve(merit_table, output_path, title, max_annotations=MAX_ANNOTATIONS, dpi=DPI):
+    curve, _ = cumulative_vol_for_certain_period(merit_table)
+    plot_merit_table(curve, output_path, max_annotations=max_annotations, dpi=dpi, title=title)
+    return output_path
+
+# merit offers of the given dates with datetime index, one partition per date from the columnar store when it exists
+def load_merit_for_dates(dates, compact=False):
+    if all(columnar_store.has_partition(columnar_store.MERIT_STORE, date) for date in dates):
+        return pd.concat([columnar_store.read_date(columnar_store.MERIT_STORE, date, columns=['bid_price', 'bid_volumn']) for date in dates])
+    merit_fulltable = read_cleansed_table(MERIT_CLEANSED_PATH, compact=compact)
+    return merit_fulltable[merit_fulltable.index.normalize().isin(pd.DatetimeIndex(dates))]
+
+# render the bid stack curves of many periods across a process pool
+def plot_merit_tables(dates, periods=range(1, 49), output_dir=PLOT_DIR, workers=None,
+                      max_annotations=MAX_ANNOTATIONS, dpi=DPI, force=False, compact=False):
+    """
+    Args:
+        dates: dates to render
+        periods: periods (1-48) of every date to render
+        output_dir: folder for bid_stack_curve_<date>_p<period>.png files
+        workers: number of processes, os.cpu_count() when None
+        max_annotations: label at most this many offer steps per chart
+        force: redraw charts whose input has not changed
+        compact: load the cleansed merit table with compact dtypes
+
+    Returns:
+        (rendered, skipped, failures): lists of file names and {file name: error message}
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = load_render_manifest(output_dir)
+    merit = load_merit_for_dates([pd.Timestamp(date) for date in dates], compact)
+    periods = set(periods)
+
+    jobs, skipped = {}, []
+    for timestamp, merit_table in merit.groupby(level=0, sort=True):
+        period = (timestamp - timestamp.normalize()) // pd.Timedelta(minutes=30) + 1
+        if period not in periods:
+            continue
+        file_name = period_plot_name(timestamp, period)
+        input_hash = period_input_hash(merit_table, max_annotations, dpi)
+        if not force and manifest.get(file_name) == input_hash and os.path.exists(os.path.join(output_dir, file_name)):
+            skipped.append(file_name)
+            continue
+        title = f'Bid Stack Curve {timestamp:%Y-%m-%d} period {period}\n(Cumulative Volume vs. Bid Price)'
+        jobs[file_name] = (merit_table, title, input_hash)
+    logger.info("%d charts to render, %d unchanged", len(jobs), len(skipped))
+
+    rendered, failures = [], {}
+    if jobs:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker_logging, initargs=(worker_log_queue(),)) as executor:
+            futures = {
+                executor.submit(worker_call, render_period_curve, merit_table, os.path.join(output_dir, file_name), title, max_annotations, dpi): file_name
+                for file_name, (merit_table, title, _) in jobs.items()
+            }
+            for future in as_completed(futures):
+                file_name = futures[future]
+                try:
+                    worker_result(future)
+                    manifest[file_name] = jobs[file_name][2]
+                    rendered.append(file_name)
+                except Exception as e:
+                    failures[file_name] = str(e)
+                    logger.error(f"failed to render {file_name}: {e}")
+        save_render_manifest(output_dir, manifest)
+    logger.info(f"{len(rendered)} charts rendered, {len(skipped)} skipped, {len(failures)} failed")
+    return sorted(rendered), skipped, failures
+
+
 def main(args):
-    merit_fulltable = pd.read_csv("cleansed_data/merit_cleansed.csv", index_col=0, parse_dates=True)
-    logger.info("read cleansed merit table")
-    selected_merit_table = select_certain_period(merit_fulltable, args.date, args.period)
+    if columnar_store.has_partition(columnar_store.MERIT_STORE, args.date):
+        selected_merit_table = columnar_store.read_period(columnar_store.MERIT_STORE, args.date, args.period, columns=['bid_price', 'bid_volumn'])
+        logger.info("read merit partition from columnar store")
+    else:
+        merit_fulltable = read_cleansed_table(MERIT_CLEANSED_PATH, compact=args.compact)
+        logger.info("read cleansed merit table")
+        selected_merit_table = select_certain_period(merit_fulltable, args.date, args.period)
     certain_time_merit_data, max_vol = cumulative_vol_for_certain_period(selected_merit_table)
-    print(certain_time_merit_data)
-    plot_merit_table(certain_time_merit_data)
+    logger.debug("merit curve:\n%s", certain_time_merit_data)
+    plot_merit_table(certain_time_merit_data, args.output, max_annotations=args.max_annotations, dpi=args.dpi)
 
+def batch_main(args):
+    dates = pd.date_range(args.date, args.end_date or args.date, freq="D")
+    periods = [args.period] if args.period else range(1, 49)
+    rendered, skipped, failures = plot_merit_tables(dates, periods, args.output_dir, args.workers,
+                                                    args.max_annotations, args.dpi, args.force, args.compact)
+    print(f"{len(rendered)} charts rendered to {args.output_dir}, {len(skipped)} unchanged, {len(failures)} failed")
+    for file_name, error in failures.items():
+        print(f"FAILED {file_name}: {error}")
 
 
 if __name__ == "__main__":
     # 1st param is for date, 2nd param is for period to choose
     parser = argparse.ArgumentParser(description='input date and period data')
-    parser.add_argument('--date', required=True, help='Target date (YYYY-MM-DD)')
-    parser.add_argument('--period', type=int, choices=range(1, 49), 
-                      help='30-min period (1-48)')
-    # parser.add_argument('--output', default='result.csv', help='Output file path')
+    parser.add_argument('--date', required=True, help='Target date (YYYY-MM-DD), first date with --end-date')
+    parser.add_argument('--period', type=int, choices=range(1, 49),
+                      help='30-min period (1-48), every period of the dates when omitted')
+    parser.add_argument('--end-date', help='render every date up to this one (YYYY-MM-DD)')
+    parser.add_argument('--output', default='bid_stack_curve.png', help='Output file path for one period')
+    parser.add_argument('--output-dir', default=PLOT_DIR, help='Output folder when rendering many periods')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: cpu count)')
+    parser.add_argument('--max-annotations', type=int, default=MAX_ANNOTATIONS, help='label at most this many offer steps per chart')
+    parser.add_argument('--dpi', type=int, default=DPI, help='resolution of the png files')
+    parser.add_argument('--force', action='store_true', help='redraw charts whose input has not changed')
+    parser.add_argument('--compact', action='store_true', help='load the cleansed merit table with compact dtypes')
     args = parser.parse_args()
-    main(args)
-    
+    if args.period and not args.end_date:
+        main(args)
+    else:
+        batch_main(args)
 
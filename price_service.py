@@ -0,0 +1,137 @@
+import os
+import json
+import math
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from lazy_import import lazy_import
+from logger_config import setup_logger
+from merit_index import MERIT_INDEX_PATH, PERIODS_PER_DAY
+from check_final_price import load_merit_index, batch_check_final_price, MERIT_CLEANSED_PATH
+
+pd = lazy_import("pandas")
+logger = setup_logger('price_service')
+
+
+# keeps the merit curves loaded and swaps them in when the cleansed data changes
+class PriceService:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.index = None
+        self.source_mtime = None
+        self.reload()
+
+    @staticmethod
+    def _source_mtime():
+        path = MERIT_INDEX_PATH if os.path.exists(MERIT_INDEX_PATH) else MERIT_CLEANSED_PATH
+        return path, os.path.getmtime(path)
+
+    def reload(self, force=False):
+        """Reload the merit curves if the index file (or the cleansed csv) changed, return True when reloaded"""
+        with self._lock:
+            path, mtime = self._source_mtime()
+            if not force and self.index is not None and mtime == self.source_mtime:
+                return False
+            # the new index is fully loaded before it replaces the old one, so queries never wait on a reload
+            index = load_merit_index()
+            self.index, self.source_mtime = index, mtime
+            logger.info(f"loaded {len(index)} merit curves from {path}")
+            return True
+
+    def clearing_price(self, date, period, demand):
+        return self.index.clearing_price(date, period, demand)
+
+    def clearing_prices(self, queries):
+        result = batch_check_final_price(self.index, pd.DataFrame(queries, columns=['date', 'period', 'demand']))
+        # NaN is not valid json
+        result['final_price'] = result['final_price'].astype(object).where(result['error'] == "ok", None)
+        return result.to_dict(orient='records')
+
+
+def make_handler(service):
+    class PriceRequestHandler(BaseHTTPRequestHandler):
+        def _send_json(self, status, body):
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def _read_json(self):
+            length = int(self.headers.get("Content-Length", 0))
+            return json.loads(self.rfile.read(length) or b"null")
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == "/health":
+                self._send_json(200, {'status': 'ok', 'periods': len(service.index)})
+            elif url.path == "/price":
+                params = {key: values[0] for key, values in parse_qs(url.query).items()}
+                try:
+                    date, period, demand = params['date'], int(params['period']), float(params['demand'])
+                    # period 0 or 49 would read a slot of the neighbouring day
+                    if not 1 <= period <= PERIODS_PER_DAY:
+                        raise ValueError(f"period {period} is outside 1-{PERIODS_PER_DAY}")
+                    if not math.isfinite(demand) or demand < 0:
+                        raise ValueError(f"{demand} is not a non-negative number")
+                    price = service.clearing_price(date, period, demand)
+                except (KeyError, ValueError) as e:
+                    self._send_json(400, {'error': str(e)})
+                    return
+                self._send_json(200, {'date': date, 'period': period, 'demand': demand, 'final_price': price})
+            else:
+                self._send_json(404, {'error': f"unknown path {url.path}"})
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path == "/prices":
+                try:
+                    queries = self._read_json()
+                    if not isinstance(queries, list):
+                        raise ValueError("body must be a list of {date, period, demand} objects")
+                    self._send_json(200, service.clearing_prices(queries))
+                except ValueError as e:
+                    self._send_json(400, {'error': str(e)})
+            elif url.path == "/reload":
+                try:
+                    force = self._read_json() is True
+                except ValueError as e:
+                    self._send_json(400, {'error': str(e)})
+                    return
+                try:
+                    reloaded = service.reload(force=force)
+                except FileNotFoundError as e:
+                    # the service keeps answering from the curves it has loaded
+                    self._send_json(503, {'error': f"no merit source to reload: {e}"})
+                    return
+                self._send_json(200, {'reloaded': reloaded})
+            else:
+                self._send_json(404, {'error': f"unknown path {url.path}"})
+
+        def log_message(self, format, *args):
+            logger.info(format, *args)
+
+    return PriceRequestHandler
+
+
+def serve(host="127.0.0.1", port=8050):
+    service = PriceService()
+    server = ThreadingHTTPServer((host, port), make_handler(service))
+    logger.info(f"clearing price service listening on http://{host}:{port}")
+    print(f"clearing price service listening on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='serve clearing price queries from the loaded merit curves')
+    parser.add_argument('--host', default="127.0.0.1", help='interface to listen on')
+    parser.add_argument('--port', type=int, default=8050, help='port to listen on')
+    args = parser.parse_args()
+    serve(args.host, args.port)
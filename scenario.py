@@ -0,0 +1,116 @@
+from lazy_import import lazy_import
+from logger_config import setup_logger
+from stage_metrics import stage, timed_stage
+import argparse
+from merit_index import SLOT_NS, ERROR_NAMES, PRICE_OK
+from check_final_price import load_merit_index
+from util import read_cleansed_table, validate_date
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+logger = setup_logger('scenario')
+
+USER_CLEANSED_PATH = "cleansed_data/user_cleansed.csv"
+BASE_SCENARIO = "base"
+
+
+def percent_scenario_name(pct):
+    return f"{pct:+g}%"
+
+def mw_scenario_name(mw):
+    return f"{mw:+g}MW"
+
+# demand of every period under every scenario, one column per scenario
+def demand_scenarios(base_demand, pct=(), mw=(), custom=None):
+    """
+    Args:
+        base_demand: Series of demand in MW with datetime index, one row per period
+        pct: percentage shocks, 5 means 5% above the base demand
+        mw: absolute shifts in MW added to the base demand
+        custom: DataFrame of whole demand series with datetime index, one column per scenario;
+                periods it does not cover are NaN
+
+    Returns:
+        DataFrame periods x scenarios, the first column is the base demand
+    """
+    base = base_demand.to_numpy(dtype='float64')
+    pct = np.asarray(pct, dtype='float64')
+    mw = np.asarray(mw, dtype='float64')
+    columns = [BASE_SCENARIO] + [percent_scenario_name(p) for p in pct] + [mw_scenario_name(m) for m in mw]
+    values = np.hstack([
+        base[:, None],
+        base[:, None] * (1 + pct[None, :] / 100),
+        base[:, None] + mw[None, :],
+    ])
+    demands = pd.DataFrame(values, index=base_demand.index, columns=columns)
+    if custom is not None:
+        demands = demands.join(custom.reindex(base_demand.index).astype('float64'))
+    if demands.columns.duplicated().any():
+        raise ValueError(f"duplicate scenario names: {list(demands.columns[demands.columns.duplicated()])}")
+    return demands
+
+# clearing price of every period under every scenario, one vectorized evaluation over the merit curves
+@timed_stage("scenario_prices", rows=lambda result: result[0].size)
+def scenario_prices(merit_index, demands):
+    """
+    Args:
+        merit_index: MeritIndex with the merit curves
+        demands: DataFrame periods x scenarios from demand_scenarios
+
+    Returns:
+        (prices, errors): DataFrames shaped like demands, NaN prices where the period
+        has no clearing price and the error name of every cell
+    """
+    timestamps = pd.DatetimeIndex(demands.index)
+    slots = timestamps.as_unit('ns').asi8 // SLOT_NS
+    dates = timestamps.normalize().to_numpy(dtype='datetime64[D]')
+    periods = slots - timestamps.normalize().as_unit('ns').asi8 // SLOT_NS + 1
+    price_values, error_values = merit_index.clearing_price_matrix(dates, periods, demands.to_numpy(dtype='float64'))
+
+    prices = pd.DataFrame(price_values, index=demands.index, columns=demands.columns)
+    errors = pd.DataFrame(error_values, index=demands.index, columns=demands.columns)
+    codes, counts = np.unique(error_values[error_values != PRICE_OK], return_counts=True)
+    if len(codes):
+        logger.warning(f"{counts.sum()} of {error_values.size} scenario prices failed: "
+                       f"{dict(zip((ERROR_NAMES[code] for code in codes), counts.tolist()))}")
+    return prices, errors.apply(lambda column: column.map(ERROR_NAMES))
+
+# base demand of the periods between two dates (inclusive) from the cleansed user table
+def load_base_demand(start_date=None, end_date=None, compact=False):
+    user = read_cleansed_table(USER_CLEANSED_PATH, compact=compact)
+    days = user.index.normalize()
+    selected = np.ones(len(user), dtype=bool)
+    if start_date is not None:
+        selected &= days >= pd.Timestamp(start_date)
+    if end_date is not None:
+        selected &= days <= pd.Timestamp(end_date)
+    return user.loc[selected, 'demand'].astype('float64')
+
+def read_custom_scenarios(path):
+    with stage("read_csv.scenarios") as run:
+        custom = pd.read_csv(path, index_col=0, parse_dates=True)
+        run.rows = len(custom)
+    return custom
+
+def main(args):
+    base_demand = load_base_demand(args.date, args.end_date, args.compact)
+    custom = read_custom_scenarios(args.custom) if args.custom else None
+    demands = demand_scenarios(base_demand, args.pct, args.mw, custom)
+    logger.info(f"{len(demands)} periods x {len(demands.columns)} scenarios")
+    prices, errors = scenario_prices(load_merit_index(args.compact), demands)
+    prices.to_csv(args.output)
+    print(f"{prices.shape[0]} periods x {prices.shape[1]} scenarios written to {args.output}")
+    print(prices.describe().loc[['mean', 'min', 'max']].T.to_string())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='clearing prices of every period under demand what-if scenarios')
+    parser.add_argument('--date', type=validate_date, help='first date (YYYY-MM-DD), all dates when omitted')
+    parser.add_argument('--end-date', type=validate_date, help='last date (YYYY-MM-DD)')
+    parser.add_argument('--pct', type=float, nargs='*', default=[], help='percentage demand shocks, e.g. 3 5 10 -5')
+    parser.add_argument('--mw', type=float, nargs='*', default=[], help='absolute demand shifts in MW, e.g. 200 -150')
+    parser.add_argument('--custom', help='CSV of demand series with a datetime first column, one column per scenario')
+    parser.add_argument('--output', default='scenario_prices.csv', help='Output file path of the price matrix')
+    parser.add_argument('--compact', action='store_true', help='load the cleansed tables with compact dtypes')
+    args = parser.parse_args()
+    main(args)
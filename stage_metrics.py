@@ -0,0 +1,231 @@
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+
+# resource is unix only, peak RSS is reported as None elsewhere
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# set either path to export the stage metrics of the run when the process exits
+METRICS_JSON = os.environ.get("METRICS_JSON")
+# node_exporter textfile collector format, e.g. /var/lib/node_exporter/textfile/pipeline.prom
+METRICS_TEXTFILE = os.environ.get("METRICS_TEXTFILE")
+METRIC_PREFIX = "pipeline_stage"
+
+_lock = threading.Lock()
+_stages = {}
+# only the process that started the run exports, not forked workers
+_owner_pid = os.getpid()
+
+
+def peak_rss_bytes():
+    """High-water mark of the resident set size of this process so far"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class StageRun:
+    """Handle yielded by stage(), set rows once the row count is known"""
+
+    def __init__(self, rows=None):
+        self.rows = rows
+
+
+def record(name, seconds, rows=None, failed=False):
+    peak = peak_rss_bytes()
+    with _lock:
+        entry = _stages.setdefault(name, {
+            'calls': 0, 'failures': 0, 'seconds': 0.0, 'last_seconds': 0.0,
+            'rows': 0, 'peak_rss_bytes': None,
+        })
+        entry['calls'] += 1
+        entry['failures'] += int(failed)
+        entry['seconds'] += seconds
+        entry['last_seconds'] = seconds
+        entry['rows'] += int(rows or 0)
+        entry['peak_rss_bytes'] = peak
+
+
+# time a block of code as one named stage
+@contextmanager
+def stage(name, rows=None):
+    """
+    Args:
+        name: stage name, repeated runs of the same stage are summed
+        rows: rows processed, or set run.rows inside the block
+
+    Example:
+        with stage("read_csv.merit") as run:
+            df = pd.read_csv(path)
+            run.rows = len(df)
+    """
+    run = StageRun(rows)
+    start = time.perf_counter()
+    failed = False
+    try:
+        yield run
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        record(name, time.perf_counter() - start, run.rows, failed)
+
+
+# decorator version of stage(), rows is a function of the return value, e.g. len
+def timed_stage(name, rows=None):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name) as run:
+                result = func(*args, **kwargs)
+                if rows is not None and result is not None:
+                    run.rows = rows(result)
+                return result
+        return wrapper
+    return decorator
+
+
+def reset():
+    with _lock:
+        _stages.clear()
+
+
+def _snapshot():
+    with _lock:
+        return {name: dict(entry) for name, entry in _stages.items()}
+
+
+def merge_stages(stages):
+    """Add the stage records of another process, e.g. a pool worker, to this one"""
+    with _lock:
+        for name, theirs in stages.items():
+            entry = _stages.setdefault(name, {
+                'calls': 0, 'failures': 0, 'seconds': 0.0, 'last_seconds': 0.0,
+                'rows': 0, 'peak_rss_bytes': None,
+            })
+            for key in ('calls', 'failures', 'seconds', 'rows'):
+                entry[key] += theirs[key]
+            entry['last_seconds'] = theirs['last_seconds']
+            # the highest peak of any process that ran the stage
+            peaks = [peak for peak in (entry['peak_rss_bytes'], theirs['peak_rss_bytes']) if peak is not None]
+            entry['peak_rss_bytes'] = max(peaks) if peaks else None
+
+
+# pool task wrapper: only the run owner exports, so a worker hands back the stages it recorded
+def worker_call(func, *args, **kwargs):
+    """
+    Returns:
+        (result of func, stage records of this call) in a worker process; when func raises,
+        the records travel back on the exception. In the owner process the stages are
+        recorded directly and None is returned in their place
+    """
+    if os.getpid() == _owner_pid:
+        return func(*args, **kwargs), None
+    # a forked worker starts with a copy of the parent's stages, and runs one task after another
+    reset()
+    try:
+        result = func(*args, **kwargs)
+    except BaseException as e:
+        e.worker_stages = _snapshot()
+        raise
+    return result, _snapshot()
+
+
+def worker_result(future):
+    """Result of a future of worker_call, its stage records are merged into this process"""
+    try:
+        result, stages = future.result()
+    except BaseException as e:
+        merge_stages(getattr(e, 'worker_stages', None) or {})
+        raise
+    merge_stages(stages or {})
+    return result
+
+
+def report():
+    """
+    Returns:
+        dict with the per-stage calls, failures, total and last wall time, rows,
+        rows per second and the process peak RSS when the stage last finished
+    """
+    stages = _snapshot()
+    for entry in stages.values():
+        entry['rows_per_second'] = entry['rows'] / entry['seconds'] if entry['rows'] and entry['seconds'] > 0 else None
+    return {
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'pid': os.getpid(),
+        'peak_rss_bytes': peak_rss_bytes(),
+        'stages': stages,
+    }
+
+
+# write to a temporary file first, so readers never see a half written report
+def _write_atomic(path, text):
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def write_json_report(path):
+    _write_atomic(path, json.dumps(report(), indent=2))
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def prometheus_text(metrics=None):
+    metrics = metrics or report()
+    series = (
+        ('seconds_total', 'counter', 'Wall time spent in the stage', 'seconds'),
+        ('last_seconds', 'gauge', 'Wall time of the last run of the stage', 'last_seconds'),
+        ('calls_total', 'counter', 'Runs of the stage', 'calls'),
+        ('failures_total', 'counter', 'Runs of the stage that raised', 'failures'),
+        ('rows_total', 'counter', 'Rows processed by the stage', 'rows'),
+        ('rows_per_second', 'gauge', 'Rows processed per second of stage wall time', 'rows_per_second'),
+        ('peak_rss_bytes', 'gauge', 'Process peak RSS when the stage last finished', 'peak_rss_bytes'),
+    )
+    lines = []
+    for suffix, metric_type, help_text, key in series:
+        metric = f"{METRIC_PREFIX}_{suffix}"
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} {metric_type}")
+        for name, entry in sorted(metrics['stages'].items()):
+            if entry[key] is not None:
+                lines.append(f'{metric}{{stage="{_label(name)}"}} {entry[key]}')
+    lines.append(f"# HELP {METRIC_PREFIX}_report_timestamp_seconds Unix time the metrics were written")
+    lines.append(f"# TYPE {METRIC_PREFIX}_report_timestamp_seconds gauge")
+    lines.append(f"{METRIC_PREFIX}_report_timestamp_seconds {time.time()}")
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus_textfile(path):
+    _write_atomic(path, prometheus_text())
+
+
+def _export_at_exit():
+    if not _stages or os.getpid() != _owner_pid:
+        return
+    if METRICS_JSON:
+        write_json_report(METRICS_JSON)
+    if METRICS_TEXTFILE:
+        write_prometheus_textfile(METRICS_TEXTFILE)
+
+
+if METRICS_JSON or METRICS_TEXTFILE:
+    atexit.register(_export_at_exit)
@@ -0,0 +1,268 @@
+from lazy_import import lazy_import
+from logger_config import setup_logger
+from stage_metrics import stage
+import io
+import os
+import csv
+import time
+import argparse
+from check_final_price import check_final_price
+from data_quality import QualityChecker, MERIT_RULES, USEP_RULES
+from util import clean_merit_frame, clean_usep_frame, generate_datetime_index, cumulative_vol_for_certain_period
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+logger = setup_logger('tail_prices')
+
+MERIT_RAW_PATH = "raw_data/DelayedOfferStacks_Energy_01-Jan-2023 to 31-Jan-2023.csv"
+USEP_RAW_PATH = "raw_data/USEP_Jan-2023.csv"
+TAIL_OUTPUT_PATH = "tail_prices.csv"
+# the offer stack file starts with two title lines before its header
+MERIT_PREAMBLE_LINES = 2
+POLL_INTERVAL = 0.2
+# seconds without new merit rows after which the latest merit period counts as complete
+MERIT_IDLE_TIMEOUT = 0.5
+# periods further than this behind the latest one seen are forgotten: unmatched curves and USEP rows
+# are dropped, and merit rows arriving for them are treated as late
+RETENTION = "1D"
+RESULT_COLUMNS = ['datetime', 'demand', 'clearing_price', 'usep', 'price_difference', 'max_capacity', 'error', 'latency_ms']
+
+
+# follows one raw csv file and returns only the complete lines appended since the last read
+class RawFileTail:
+    def __init__(self, path, preamble_lines=0):
+        self.path = path
+        self.preamble_lines = preamble_lines
+        self.reset()
+
+    def reset(self):
+        self.offset = 0
+        self.header = None
+        self.skip = self.preamble_lines
+        # carried into the date repair of the next rows, like the chunks of stream_cleansed_merit_table
+        self.last_valid_date = None
+
+    def read_new_rows(self):
+        """
+        Returns:
+            DataFrame of the raw rows appended since the last call (a trailing line
+            without newline waits for the next call), None when nothing new
+        """
+        if not os.path.exists(self.path):
+            return None
+        size = os.path.getsize(self.path)
+        if size < self.offset:
+            logger.warning(f"{self.path} was truncated, reading it again from the start")
+            self.reset()
+        if size == self.offset:
+            return None
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            data = f.read(size - self.offset)
+        end = data.rfind(b"\n") + 1
+        if end == 0:
+            return None
+        self.offset += end
+
+        lines = data[:end].decode("utf-8").splitlines()
+        skipped = min(self.skip, len(lines))
+        self.skip -= skipped
+        lines = lines[skipped:]
+        if self.header is None and lines:
+            self.header = lines.pop(0).lstrip("\ufeff")
+        lines = [line for line in lines if line.strip()]
+        if not lines:
+            return None
+        return pd.read_csv(io.StringIO("\n".join([self.header] + lines)))
+
+
+# cleans appended raw rows with the batch rules and prices every period once it is complete
+class ClearingPriceTail:
+    """
+    A merit period is complete when its USEP row arrives, when rows of a later period arrive
+    (the offer stack is written in date, period order), when no merit rows arrived for
+    idle_timeout seconds, or when the input is flushed at the end.
+    Its price is emitted as soon as both the complete curve and the USEP row are there, and its
+    latency is timed from the read that delivered the last of them.
+    """
+
+    def __init__(self, merit_path=MERIT_RAW_PATH, usep_path=USEP_RAW_PATH, merit_quarantine_path=None, usep_quarantine_path=None,
+                 idle_timeout=MERIT_IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self.merit = RawFileTail(merit_path, MERIT_PREAMBLE_LINES)
+        self.usep = RawFileTail(usep_path)
+        # the batch data-quality rules, applied to every read; counts add up over the whole feed
+        self.merit_quality = QualityChecker(MERIT_RULES, "merit", merit_quarantine_path)
+        self.usep_quality = QualityChecker(USEP_RULES, "user", usep_quarantine_path)
+        self.pending_merit = None
+        # perf_counter of the read that last delivered merit rows, and of the one per pending period
+        self.merit_read_at = None
+        self.merit_arrived = {}
+        # datetime -> (complete merit table, arrival) waiting for its USEP row, and the other way round
+        self.curves = {}
+        self.usep_rows = {}
+        # priced periods inside the retention, older ones are all behind evicted_until
+        self.emitted = set()
+        self.evicted_until = None
+        self.latest = None
+
+    @staticmethod
+    def _check(checker, df):
+        # a live feed keeps running: bad rows are logged and left out instead of failing the whole read
+        quarantined = checker.quarantined
+        df = checker.check(df)
+        if checker.quarantined > quarantined:
+            logger.error(f"quarantined {checker.quarantined - quarantined} {checker.name} rows breaking data-quality rules")
+        return df
+
+    def _cleanse(self, tail, raw, clean_frame, checker):
+        df = clean_frame(raw, last_valid_date=tail.last_valid_date)
+        if df['date'].notna().any():
+            tail.last_valid_date = df['date'].dropna().iloc[-1]
+        return generate_datetime_index(self._check(checker, df))
+
+    def _seen(self, timestamps):
+        if len(timestamps):
+            latest = timestamps.max()
+            self.latest = latest if self.latest is None else max(self.latest, latest)
+
+    def _priced(self, timestamp):
+        return timestamp in self.emitted or (self.evicted_until is not None and timestamp < self.evicted_until)
+
+    def _read_merit(self, final):
+        raw = self.merit.read_new_rows()
+        if raw is not None:
+            arrived = time.perf_counter()
+            with stage("tail.cleanse_merit", rows=len(raw)):
+                rows = self._cleanse(self.merit, raw, clean_merit_frame, self.merit_quality)
+            self.merit_read_at = arrived
+            self.merit_arrived.update(dict.fromkeys(rows.index.unique(), arrived))
+            self._seen(rows.index)
+            self.pending_merit = rows if self.pending_merit is None else pd.concat([self.pending_merit, rows])
+        if self.pending_merit is None or self.pending_merit.empty:
+            return
+        # the latest period may still grow, unless its USEP row is in, the feed went idle or the input is flushed
+        timestamps = self.pending_merit.index
+        idle = self.merit_read_at is not None and time.perf_counter() - self.merit_read_at >= self.idle_timeout
+        if final or idle:
+            complete = np.ones(len(timestamps), dtype=bool)
+        else:
+            complete = (timestamps < timestamps.max()) | timestamps.isin(list(self.usep_rows))
+        for timestamp, merit_table in self.pending_merit[complete].groupby(level=0, sort=True):
+            arrived = self.merit_arrived.pop(timestamp)
+            if self._priced(timestamp):
+                logger.warning(f"late merit rows for already priced period {timestamp} are ignored")
+                continue
+            self.curves[timestamp] = (merit_table, arrived)
+        self.pending_merit = self.pending_merit[~complete]
+
+    def _read_usep(self):
+        raw = self.usep.read_new_rows()
+        if raw is None:
+            return
+        arrived = time.perf_counter()
+        with stage("tail.cleanse_usep", rows=len(raw)):
+            rows = self._cleanse(self.usep, raw, clean_usep_frame, self.usep_quality)
+        self._seen(rows.index)
+        for timestamp, demand, usep in zip(rows.index, rows['demand'], rows['usep']):
+            if not self._priced(timestamp):
+                self.usep_rows[timestamp] = (float(demand), float(usep), arrived)
+
+    # forget what lies more than RETENTION behind the latest period, so a long-running tail stays bounded
+    def _evict(self):
+        if self.latest is None:
+            return
+        horizon = self.latest - pd.Timedelta(RETENTION)
+        for name, waiting in (("merit curves", self.curves), ("USEP rows", self.usep_rows)):
+            stale = [timestamp for timestamp in waiting if timestamp < horizon]
+            if stale:
+                logger.warning(f"dropped {len(stale)} {name} never matched before {horizon}")
+            for timestamp in stale:
+                del waiting[timestamp]
+        self.emitted = {timestamp for timestamp in self.emitted if timestamp >= horizon}
+        self.evicted_until = horizon
+
+    def price_period(self, timestamp):
+        merit_table, merit_arrived = self.curves.pop(timestamp)
+        demand, usep, usep_arrived = self.usep_rows.pop(timestamp)
+        curve, max_vol = cumulative_vol_for_certain_period(merit_table)
+        try:
+            price, error = float(check_final_price(curve, demand, max_vol)), ""
+        except ValueError as e:
+            price, error = float("nan"), str(e)
+            logger.warning(f"no clearing price for {timestamp}: {e}")
+        self.emitted.add(timestamp)
+        return {
+            'datetime': timestamp,
+            'demand': demand,
+            'clearing_price': price,
+            'usep': usep,
+            'price_difference': price - usep,
+            'max_capacity': float(max_vol),
+            'error': error,
+            'latency_ms': round((time.perf_counter() - max(merit_arrived, usep_arrived)) * 1000, 3),
+        }
+
+    def poll(self, final=False):
+        """
+        Args:
+            final: treat the latest merit period as complete, at the end of the input
+
+        Returns:
+            list of result dicts (RESULT_COLUMNS) of the periods completed by the new rows
+        """
+        # USEP first, its rows complete the merit periods they belong to
+        self._read_usep()
+        self._read_merit(final)
+        ready = sorted(set(self.curves) & set(self.usep_rows))
+        with stage("tail.clearing_price", rows=len(ready)):
+            results = [self.price_period(timestamp) for timestamp in ready]
+        self._evict()
+        return results
+
+
+def append_results(results, output_path):
+    new_file = not os.path.exists(output_path)
+    with open(output_path, "a", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=RESULT_COLUMNS)
+        if new_file:
+            writer.writeheader()
+        writer.writerows(results)
+
+def report(result):
+    print(f"{result['datetime']}: demand {result['demand']} MW, clearing price {result['clearing_price']:.2f}, "
+          f"USEP {result['usep']:.2f}, difference {result['price_difference']:+.2f} ({result['latency_ms']:.1f} ms)", flush=True)
+
+def main(args):
+    tail = ClearingPriceTail(args.merit, args.usep, args.merit_quarantine, args.usep_quarantine, args.idle_timeout)
+    logger.info(f"following {args.merit} and {args.usep}")
+    try:
+        while True:
+            results = tail.poll(final=args.once)
+            for result in results:
+                report(result)
+            if results:
+                append_results(results, args.output)
+                logger.info(f"{len(results)} periods priced, latest {results[-1]['datetime']}")
+            if args.once:
+                break
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        logger.info("stopped following the raw files")
+    tail.merit_quality.log_summary()
+    tail.usep_quality.log_summary()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='follow the raw files and price every half-hour period as soon as it is complete')
+    parser.add_argument('--merit', default=MERIT_RAW_PATH, help='raw DelayedOfferStacks csv file to follow')
+    parser.add_argument('--usep', default=USEP_RAW_PATH, help='raw USEP csv file to follow')
+    parser.add_argument('--output', default=TAIL_OUTPUT_PATH, help='csv file the priced periods are appended to')
+    parser.add_argument('--merit-quarantine', help='csv file for the merit rows breaking a data-quality rule')
+    parser.add_argument('--usep-quarantine', help='csv file for the USEP rows breaking a data-quality rule')
+    parser.add_argument('--interval', type=float, default=POLL_INTERVAL, help='seconds between two reads of the files')
+    parser.add_argument('--idle-timeout', type=float, default=MERIT_IDLE_TIMEOUT,
+                        help='seconds without new merit rows after which the latest period is priced')
+    parser.add_argument('--once', action='store_true', help='price what is in the files now, including the last period, and exit')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,110 @@
+import os
+import sys
+import tempfile
+import unittest
+from datetime import date
+from unittest import mock
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'duckdb_script'))
+import analysis_duckdb
+import duckdb_cleansed_file
+from analysis_duckdb import run_analyses, SHARED_AGGREGATES_TABLE, BY_DATE, BY_PERIOD
+from db_connection import ConnectionManager, ThreadCursor
+from duckdb_cleansed_file import bump_table_version
+
+
+# date, period, demand_mw, usep_price; on 2 Jan the max demand is reached at periods 20 and 30
+ROWS = [
+    (date(2023, 1, 1), 1, 5000.0, 100.0),
+    (date(2023, 1, 1), 20, 6000.0, 300.0),
+    (date(2023, 1, 1), 40, 5500.0, 200.0),
+    (date(2023, 1, 2), 1, 4000.0, 50.0),
+    (date(2023, 1, 2), 20, 7000.0, 400.0),
+    (date(2023, 1, 2), 30, 7000.0, 500.0),
+    (date(2023, 1, 2), 40, None, 150.0),
+]
+
+
+class TestRunAnalyses(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.manager = ConnectionManager(path=os.path.join(self.tmp.name, "test.duckdb"))
+        cursor = ThreadCursor(self.manager)
+        for module in (analysis_duckdb, duckdb_cleansed_file):
+            patcher = mock.patch.multiple(module, manager=self.manager, con=cursor)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.con = self.manager.cursor()
+        self.con.execute("CREATE TABLE user_validation (date DATE, period INTEGER, demand_mw DOUBLE, usep_price DOUBLE)")
+        self.con.executemany("INSERT INTO user_validation VALUES (?, ?, ?, ?)", ROWS)
+        bump_table_version("user_validation")
+
+    def tearDown(self):
+        self.manager.close()
+        self.tmp.cleanup()
+
+    def rows(self, sql):
+        return self.con.execute(sql).fetchall()
+
+    def test_grouping_sets_by_date_and_period(self):
+        run_analyses()
+        by_date = self.rows(f"""
+            SELECT date, max_demand, min_demand, max_demand_period, min_demand_period, usep_at_max_demand,
+                   usep_count, demand_count, observation_count
+            FROM {SHARED_AGGREGATES_TABLE} WHERE grouping_id = {BY_DATE} ORDER BY date""")
+        self.assertEqual(by_date, [
+            (date(2023, 1, 1), 6000.0, 5000.0, 20, 1, 300.0, 3, 3, 3),
+            (date(2023, 1, 2), 7000.0, 4000.0, 20, 1, 400.0, 4, 3, 4),
+        ])
+        by_period = self.rows(f"""
+            SELECT period, usep_sum, demand_sum, demand_count
+            FROM {SHARED_AGGREGATES_TABLE} WHERE grouping_id = {BY_PERIOD} ORDER BY period""")
+        self.assertEqual(by_period, [
+            (1, 150.0, 9000.0, 2),
+            (20, 700.0, 13000.0, 2),
+            (30, 500.0, 7000.0, 1),
+            (40, 350.0, 5500.0, 1),
+        ])
+
+    def test_results_derived_from_shared_aggregates(self):
+        run_analyses()
+        self.assertEqual(self.rows("SELECT * FROM analysis_demand_limit_by_date"), [
+            (date(2023, 1, 1), 1, 5000.0, 'MIN'),
+            (date(2023, 1, 1), 20, 6000.0, 'MAX'),
+            (date(2023, 1, 2), 1, 4000.0, 'MIN'),
+            (date(2023, 1, 2), 20, 7000.0, 'MAX'),
+        ])
+        self.assertEqual(self.rows("SELECT * FROM analysis_period_for_max_demand"), [(20, 2)])
+        self.assertEqual(self.rows("SELECT * FROM analysis_peak_demand_identification"), [
+            (date(2023, 1, 2), 20, 7000.0, 400.0),
+            (date(2023, 1, 1), 20, 6000.0, 300.0),
+        ])
+        # period 1 is night, 20 and 30 are daytime and 40 is evening
+        time_of_day = self.rows("SELECT time_of_day, avg_price, avg_demand, observation_count FROM analysis_time_of_day_price")
+        self.assertEqual(time_of_day, [('Daytime', 400.0, 20000.0 / 3, 3), ('Evening', 175.0, 5500.0, 2), ('Night', 75.0, 4500.0, 2)])
+        volatility = dict((row[0], row[2]) for row in self.rows("SELECT * FROM analysis_price_volatility"))
+        self.assertEqual(volatility, {date(2023, 1, 1): 200.0, date(2023, 1, 2): 450.0})
+
+    def test_results_kept_until_version_bumped(self):
+        run_analyses()
+        # a change that is not recorded in table_versions leaves the stored results alone
+        self.con.execute("UPDATE user_validation SET demand_mw = 9000.0 WHERE date = '2023-01-01' AND period = 40")
+        run_analyses()
+        self.assertEqual(self.rows("SELECT period, demand_mw FROM analysis_peak_demand_identification WHERE date = '2023-01-01'"),
+                         [(20, 6000.0)])
+
+        bump_table_version("user_validation")
+        run_analyses()
+        self.assertEqual(self.rows("SELECT period, demand_mw FROM analysis_peak_demand_identification WHERE date = '2023-01-01'"),
+                         [(40, 9000.0)])
+        self.assertEqual(self.rows("SELECT source_version FROM analysis_cache WHERE source_table = 'user_validation'"), [(2,)])
+
+    def test_force_recomputes_unchanged_version(self):
+        run_analyses()
+        self.con.execute("UPDATE user_validation SET usep_price = 1000.0 WHERE date = '2023-01-02' AND period = 20")
+        run_analyses(force=True)
+        self.assertEqual(self.rows("SELECT usep_price FROM analysis_peak_demand_identification WHERE date = '2023-01-02'"),
+                         [(1000.0,)])
+
+
+if __name__ == '__main__':
+    unittest.main()
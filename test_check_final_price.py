@@ -100,7 +100,9 @@ class TestCheckFinalPrice(unittest.TestCase):
     def test_main_success(self, mock_print):
         # Test main function with valid arguments
         test_args = ["check_final_price.py", "--date", "2023-01-01", "--period", "1", "--demand", "300"]
-        with patch.object(sys, 'argv', test_args):
+        # no merit index or columnar store, so main reads the mocked cleansed table
+        with patch.object(sys, 'argv', test_args), patch('check_final_price.os.path.exists', return_value=False), \
+                patch('check_final_price.columnar_store.has_partition', return_value=False):
             main(argparse.Namespace(date="2023-01-01", period=1, demand=300))
             mock_print.assert_called_with("based on the demand 300, final clearing price is 30.0")
 
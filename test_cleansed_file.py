@@ -0,0 +1,76 @@
+import os
+import tempfile
+import unittest
+import pandas as pd
+import util
+from cleansed_file import cleansed_files_parallel
+from merit_index import MeritIndex
+
+USEP_HEADER = "INFORMATION TYPE,DATE,PERIOD,USEP ($/MWh),LCP ($/MWh),DEMAND (MW),TCL (MW)\n"
+MERIT_HEADER = "Date,Period,Lowest to Highest Offer Price ($/MWh),Total Offer Capacity At Specified Offer Price (MW)\n"
+
+
+class TestCleansedFilesParallel(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.output_dir = os.path.join(self.tmp.name, "cleansed_data")
+        self.usep_path = os.path.join(self.tmp.name, "USEP_Jan-2023.csv")
+        self.merit_path = os.path.join(self.tmp.name, "DelayedOfferStacks_Jan-2023.csv")
+        with open(self.usep_path, "w") as f:
+            f.write(USEP_HEADER)
+            f.writelines(f"USEP,{day:02d} Jan 2023,{period},150.5,150.0,{5000 + period},0\n" for day in (1, 2) for period in range(1, 49))
+            # quarantined, period out of range
+            f.write("USEP,02 Jan 2023,49,150.5,150.0,5000,0\n")
+        with open(self.merit_path, "w") as f:
+            f.write("Delayed Offer Stacks\nEnergy\n" + MERIT_HEADER)
+            f.writelines(f"{day:02d}-Jan-2023,{period},{(step * 7) % 5 * 10.5},{100 + step}\n"
+                         for day in (1, 2) for period in range(1, 49) for step in range(4))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_pool_matches_serial_cleansing(self):
+        outputs, failures = cleansed_files_parallel([self.usep_path, self.merit_path], self.output_dir, workers=2)
+        self.assertEqual(failures, {})
+        serial = {
+            self.usep_path: util.generate_datetime_index(util.cleansed_usep_table(self.usep_path)),
+            self.merit_path: util.generate_datetime_index(util.cleansed_merit_table(self.merit_path)),
+        }
+        for raw_path, expected in serial.items():
+            with self.subTest(raw_path=os.path.basename(raw_path)):
+                output_path, rows = outputs[raw_path]
+                written = pd.read_csv(output_path, index_col=0, parse_dates=True)
+                self.assertEqual(rows, len(expected))
+                expected_csv = os.path.join(self.tmp.name, "expected.csv")
+                expected.to_csv(expected_csv)
+                pd.testing.assert_frame_equal(written, pd.read_csv(expected_csv, index_col=0, parse_dates=True))
+        self.assertEqual(outputs[self.usep_path][1], 96)
+
+        # the merit index is rebuilt from the pool's merit output
+        index = MeritIndex.open(os.path.join(self.output_dir, "merit_index.bin"))
+        self.assertEqual(len(index), 2 * 48)
+
+    def test_merit_index_covers_earlier_runs(self):
+        cleansed_files_parallel([self.merit_path], self.output_dir, workers=1)
+        index_path = os.path.join(self.output_dir, "merit_index.bin")
+        # a later run of another month adds its dates to the index
+        february_path = os.path.join(self.tmp.name, "DelayedOfferStacks_Feb-2023.csv")
+        with open(february_path, "w") as f:
+            f.write("Delayed Offer Stacks\nEnergy\n" + MERIT_HEADER)
+            f.writelines(f"01-Feb-2023,{period},10.5,100\n" for period in range(1, 49))
+        outputs, failures = cleansed_files_parallel([february_path], self.output_dir, workers=1)
+        self.assertEqual(failures, {})
+        self.assertEqual(len(MeritIndex.open(index_path)), 3 * 48)
+
+        # a failed merit file leaves the index as it was
+        broken_path = os.path.join(self.tmp.name, "DelayedOfferStacks_Mar-2023.csv")
+        with open(broken_path, "w") as f:
+            f.write("not an offer stack\n")
+        os.remove(os.path.join(self.output_dir, "merit_cleansed_DelayedOfferStacks_Feb-2023.csv"))
+        outputs, failures = cleansed_files_parallel([broken_path], self.output_dir, workers=1)
+        self.assertEqual(list(failures), [broken_path])
+        self.assertEqual(len(MeritIndex.open(index_path)), 3 * 48)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+import pandas as pd
+import clearing_engines
+from check_final_price import batch_check_final_price
+from merit_index import MeritIndex
+from clearing_engines import (NumpyEngine, PandasEngine, DuckDBEngine, parity_check, choose_engine, select_engine,
+                              PANDAS_MAX_PERIODS, CURVES_TABLE, DUCKDB_SCRIPT_DIR)
+
+
+class TestClearingEngines(unittest.TestCase):
+    def setUp(self):
+        # two periods with offers in random price order, a zero volume step and a price tie
+        index = pd.DatetimeIndex(["2023-01-01 00:00"] * 5 + ["2023-01-01 00:30"] * 3, name='datetime')
+        self.df = pd.DataFrame({
+            'bid_price': [30.0, 10.5, 50.0, 20.0, 20.0, 7.0, 5.0, 9.0],
+            'bid_volumn': [100.0, 100.0, 200.0, 0.0, 100.0, 10.0, 20.0, 30.0],
+        }, index=index)
+        self.queries = pd.DataFrame({
+            'date': ["2023-01-01"] * 8 + ["2023-01-02", "2023-01-01", "2023-01-01"],
+            'period': [1, 1, 1, 1, 1, 2, 2, 2, 1, 49, 1],
+            'demand': [0, 100, 150, 200, 501, 10, 25, 60, 5, 5, -1],
+        })
+        self.engines = [NumpyEngine(MeritIndex.from_frame(self.df)), PandasEngine(self.df), DuckDBEngine.from_frame(self.df)]
+
+    def test_engines_agree(self):
+        mismatches, summary = parity_check(self.engines, self.queries)
+        self.assertEqual(summary['mismatches'], 0, mismatches.to_string())
+        self.assertEqual(set(summary['seconds']), {"numpy", "pandas", "duckdb"})
+
+    def test_batch_on_every_engine(self):
+        for engine in self.engines:
+            with self.subTest(engine=engine.name):
+                result = batch_check_final_price(engine, self.queries)
+                self.assertEqual(list(result['final_price'].fillna(-1)), [10.5, 10.5, 20.0, 20.0, -1, 5.0, 7.0, 9.0, -1, -1, -1])
+                self.assertEqual(list(result['error'].iloc[4:]), ["demand_exceeds_capacity"] + ["ok"] * 3 + ["unknown_period"] * 2 + ["invalid_demand"])
+
+    def test_choose_engine(self):
+        self.assertEqual(choose_engine(10**6, True, True, True), "numpy")
+        self.assertEqual(choose_engine(PANDAS_MAX_PERIODS, False, True, True), "pandas")
+        self.assertEqual(choose_engine(PANDAS_MAX_PERIODS + 1, False, True, True, merit_bytes=2**40), "duckdb")
+        self.assertEqual(choose_engine(PANDAS_MAX_PERIODS + 1, False, True, True, merit_bytes=2**20), "numpy")
+        self.assertEqual(choose_engine(1, False, False, False), "numpy")
+
+    def test_select_engine_picks_duckdb(self):
+        sys.path.append(DUCKDB_SCRIPT_DIR)
+        import db_connection
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "data.duckdb")
+            # the curves of the test offers in a database file, with no merit index or store next to it
+            built = DuckDBEngine.from_frame(self.df).con
+            built.execute(f"ATTACH '{path}' AS target")
+            built.execute(f"CREATE TABLE target.{CURVES_TABLE} AS SELECT * FROM {CURVES_TABLE}")
+            built.close()
+            manager = db_connection.ConnectionManager()
+            with mock.patch.object(db_connection, 'manager', manager), \
+                    mock.patch.multiple(clearing_engines, MERIT_INDEX_PATH=os.path.join(tmp, "merit_index.bin"),
+                                        MERIT_CLEANSED_PATH=os.path.join(tmp, "merit_cleansed.csv")), \
+                    mock.patch.object(clearing_engines.columnar_store, 'store_available', return_value=False):
+                try:
+                    engine = select_engine(self.queries, duckdb_path=path)
+                    self.assertEqual(engine.name, "duckdb")
+                    self.assertTrue(manager.read_only)
+                    result = batch_check_final_price(engine, self.queries)
+                    self.assertEqual(list(result['final_price'].fillna(-1)), [10.5, 10.5, 20.0, 20.0, -1, 5.0, 7.0, 9.0, -1, -1, -1])
+                    # opening the same database again reuses the connection
+                    self.assertIsInstance(DuckDBEngine.open(path), DuckDBEngine)
+                finally:
+                    manager.close()
+
+    def test_select_engine_leaves_duckdb_closed(self):
+        sys.path.append(DUCKDB_SCRIPT_DIR)
+        import db_connection
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "data.duckdb")
+            index_path = os.path.join(tmp, "merit_index.bin")
+            MeritIndex.from_frame(self.df).write(index_path)
+            manager = db_connection.ConnectionManager()
+            with mock.patch.object(db_connection, 'manager', manager), \
+                    mock.patch.object(clearing_engines, 'open_engine', side_effect=lambda name, *args: name):
+                # numpy answers from the index, the database is not even opened
+                with mock.patch.object(clearing_engines, 'MERIT_INDEX_PATH', index_path):
+                    self.assertEqual(select_engine(self.queries, duckdb_path=path), "numpy")
+                self.assertFalse(manager.is_open)
+                # a connection already open on another database falls back to numpy
+                manager.configure(path=os.path.join(tmp, "other.duckdb"))
+                manager.cursor()
+                open(path, "w").close()
+                with mock.patch.multiple(clearing_engines, MERIT_INDEX_PATH=os.path.join(tmp, "missing.bin"),
+                                         MERIT_CLEANSED_PATH=os.path.join(tmp, "merit_cleansed.csv")), \
+                        mock.patch.object(clearing_engines.columnar_store, 'store_available', return_value=False):
+                    try:
+                        self.assertEqual(select_engine(self.queries, duckdb_path=path), "numpy")
+                    finally:
+                        manager.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import unittest
+import tempfile
+import pandas as pd
+import columnar_store
+
+
+@unittest.skipUnless(columnar_store.store_available(), "pyarrow is not installed")
+class TestColumnarStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        index = pd.DatetimeIndex(["2023-01-01 00:00", "2023-01-01 00:00", "2023-01-01 00:30", "2023-01-02 00:00"], name='datetime')
+        self.df = pd.DataFrame({'bid_price': [10.0, 20.0, 30.0, 40.0], 'bid_volumn': [1.0, 2.0, 3.0, 4.0]}, index=index)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_read_period_matches_select(self):
+        # Test one period is read back with the same index and values
+        columnar_store.write_partitioned(self.df, self.tmp_dir.name)
+        result = columnar_store.read_period(self.tmp_dir.name, "2023-01-01", 1, columns=['bid_price', 'bid_volumn'])
+        expected = self.df.loc[pd.Timestamp("2023-01-01 00:00")]
+        self.assertEqual(list(result['bid_price']), list(expected['bid_price']))
+        self.assertTrue((result.index == expected.index).all())
+
+    def test_rewrite_replaces_partition(self):
+        # Test writing the same dates twice does not duplicate rows
+        columnar_store.write_partitioned(self.df, self.tmp_dir.name)
+        columnar_store.write_partitioned(self.df, self.tmp_dir.name)
+        result = columnar_store.read_period(self.tmp_dir.name, "2023-01-02", 1)
+        self.assertEqual(len(result), 1)
+
+    def test_missing_partition(self):
+        # Test a date that was never written
+        self.assertFalse(columnar_store.has_partition(self.tmp_dir.name, "2023-01-05"))
+        with self.assertRaises(KeyError):
+            columnar_store.read_period(self.tmp_dir.name, "2023-01-05", 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
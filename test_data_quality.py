@@ -0,0 +1,95 @@
+import os
+import tempfile
+import unittest
+import duckdb
+import pandas as pd
+from data_quality import QualityChecker, MERIT_RULES, violations_sql, quarantine_sql, rule_counts_sql, quality_summary
+
+ROWS = pd.DataFrame({
+    'date': pd.to_datetime(["2023-01-01", "2023-01-01", None, "2023-01-01", "2023-01-01", "2023-01-01"]),
+    'period': [1, 49, 2, 3, 3, 4],
+    'bid_price': [10.5, 20.0, 30.0, 40.0, 40.0, None],
+    'bid_volumn': [100.0, 50.0, 25.0, -5.0, -5.0, 10.0],
+})
+
+
+class TestQualityChecker(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.quarantine_path = os.path.join(self.tmp.name, "quarantine.csv")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_counts_and_quarantine(self):
+        checker = QualityChecker(MERIT_RULES, "merit", self.quarantine_path)
+        # checked in two chunks, the duplicate of row 3 is in the second one
+        kept = pd.concat([checker.check(ROWS.iloc[:4]), checker.check(ROWS.iloc[4:])])
+        summary = checker.summary()
+
+        self.assertEqual(list(kept.index), [0])
+        self.assertEqual(summary['rows'], 6)
+        self.assertEqual(summary['quarantined'], 5)
+        self.assertEqual(summary['rules']['period_range'], 1)
+        self.assertEqual(summary['rules']['date_not_null'], 1)
+        self.assertEqual(summary['rules']['bid_volumn_range'], 2)
+        self.assertEqual(summary['rules']['duplicate_row'], 1)
+        self.assertEqual(summary['columns']['bid_price'], 1)
+
+        quarantine = pd.read_csv(self.quarantine_path, index_col='row')
+        self.assertEqual(list(quarantine.index), [1, 2, 3, 4, 5])
+        self.assertEqual(quarantine.loc[4, 'violations'], "bid_volumn_range;duplicate_row")
+
+    def test_clean_rows_write_empty_quarantine(self):
+        checker = QualityChecker(MERIT_RULES, "merit", self.quarantine_path)
+        self.assertEqual(len(checker.check(ROWS.iloc[:1])), 1)
+        self.assertEqual(len(pd.read_csv(self.quarantine_path)), 0)
+
+    def test_duplicate_hashes_kept_per_date(self):
+        checker = QualityChecker(MERIT_RULES, "merit")
+        day = pd.DataFrame({'date': pd.to_datetime(["2023-01-01"] * 2), 'period': [1, 2],
+                            'bid_price': [1.0, 2.0], 'bid_volumn': [5.0, 5.0]})
+        checker.check(day)
+        # the next date, then a repeat of the first one: still inside the window, found
+        checker.check(day.assign(date=pd.Timestamp("2023-01-02")))
+        checker.check(day.iloc[1:])
+        self.assertEqual(checker.counts['duplicate_row'], 1)
+        # undated rows are compared across chunks too
+        checker.check(day.iloc[:1].assign(date=pd.NaT))
+        checker.check(day.iloc[:1].assign(date=pd.NaT))
+        self.assertEqual(checker.counts['duplicate_row'], 2)
+        # two days on, the first date is dropped and its late rows are counted as out of order
+        checker.check(day.assign(date=pd.Timestamp("2023-01-03")))
+        self.assertEqual(sorted(key for key in checker._hashes if key is not None),
+                         [pd.Timestamp("2023-01-02"), pd.Timestamp("2023-01-03")])
+        checker.check(day)
+        self.assertEqual(checker.out_of_order, 2)
+        self.assertEqual(checker.counts['duplicate_row'], 2)
+
+        # a whole file in one chunk spans many dates, none of its rows is late
+        whole_file = QualityChecker(MERIT_RULES, "merit")
+        whole_file.check(pd.concat([day, day.assign(date=pd.Timestamp("2023-01-05")), day.iloc[:1]]))
+        self.assertEqual(whole_file.out_of_order, 0)
+        self.assertEqual(whole_file.counts['duplicate_row'], 1)
+
+    def test_sql_matches_pandas(self):
+        # the same rules rendered to SQL give the same counts and quarantine
+        con = duckdb.connect()
+        con.register("raw_rows", ROWS)
+        columns = list(ROWS.columns)
+        con.execute(f"""
+            CREATE TABLE checked AS
+            SELECT *, {violations_sql(MERIT_RULES, row_columns=columns)} AS violations,
+                {quarantine_sql(MERIT_RULES, row_columns=columns)} AS quarantined
+            FROM raw_rows
+        """)
+        counts = con.execute(rule_counts_sql(MERIT_RULES, "checked")).fetchone()
+        quarantined = con.execute("SELECT count(*) FROM checked WHERE quarantined").fetchone()[0]
+
+        checker = QualityChecker(MERIT_RULES, "merit")
+        checker.check(ROWS)
+        self.assertEqual(quality_summary(MERIT_RULES, counts[1:], counts[0], quarantined), checker.summary())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import os
+import sys
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'duckdb_script'))
+import db_connection
+from db_connection import ConnectionManager, ThreadCursor
+
+
+class TestConnectionManager(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.manager = ConnectionManager(path=os.path.join(self.tmp.name, "test.duckdb"), threads=2, memory_limit="256MB",
+                                         temp_directory=os.path.join(self.tmp.name, "spill"))
+        self.manager.cursor().execute("CREATE TABLE t AS SELECT range AS a FROM range(100)")
+
+    def tearDown(self):
+        self.manager.close()
+        self.tmp.cleanup()
+
+    def test_settings_are_applied(self):
+        threads = self.manager.cursor().execute("SELECT current_setting('threads')").fetchone()[0]
+        self.assertEqual(threads, 2)
+        with self.assertRaises(RuntimeError):
+            self.manager.configure(read_only=True)
+
+    def test_threads_query_on_their_own_cursor(self):
+        # Test parallel readers each get a cursor and a prepared statement of their own
+        con = ThreadCursor(self.manager)
+
+        def lookup(limit):
+            self.manager.prepare("below", "PREPARE below AS SELECT count(*) FROM t WHERE a < $1")
+            return id(self.manager.cursor()), con.execute(f"EXECUTE below({limit})").fetchone()[0]
+
+        with ThreadPoolExecutor(4) as executor:
+            results = list(executor.map(lookup, range(0, 100, 5)))
+        self.assertEqual([count for _, count in results], list(range(0, 100, 5)))
+        self.assertNotIn(id(self.manager.cursor()), {cursor for cursor, _ in results})
+
+    def test_transaction_rolls_back_and_hides_uncommitted_rows(self):
+        with self.assertRaises(ValueError):
+            with self.manager.transaction() as cursor:
+                cursor.execute("DELETE FROM t")
+                # another thread still reads the committed rows
+                with ThreadPoolExecutor(1) as executor:
+                    seen = executor.submit(lambda: self.manager.cursor().execute("SELECT count(*) FROM t").fetchone()[0]).result()
+                self.assertEqual(seen, 100)
+                raise ValueError("abort")
+        self.assertEqual(self.manager.cursor().execute("SELECT count(*) FROM t").fetchone()[0], 100)
+
+    def test_preview_and_export_skip_pandas(self):
+        with mock.patch.object(db_connection, 'manager', self.manager):
+            head = db_connection.preview("t", limit=3)
+            self.assertEqual(head.column("a").to_pylist(), [0, 1, 2])
+            self.assertIn("│", db_connection.format_preview(head))
+            path = os.path.join(self.tmp.name, "t.parquet")
+            self.assertEqual(db_connection.export_query("SELECT * FROM t WHERE a >= 90", path), 10)
+            self.assertEqual(db_connection.preview(f"'{path}'", limit=None).num_rows, 10)
+            with self.assertRaises(ValueError):
+                db_connection.export_query("SELECT * FROM t", os.path.join(self.tmp.name, "t.json"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import os
+import sys
+import unittest
+import duckdb
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'duckdb_script'))
+from given_datetime_final_price import cumulative_sql, curves_sql, CUMULATIVE_TABLE, CURVES_TABLE
+from every_datetime_demand import every_datetime_demand_sql
+
+# the join + ROW_NUMBER query every_datetime_demand used before merit_curves, ties of cumulative
+# volume (zero volume steps) broken by bid price
+legacy_every_datetime_demand_sql = """
+    WITH joined_data AS (
+        SELECT C.*, U.demand_mw
+        FROM merit_cumulative_volumn C JOIN user_validation U
+        ON C.date = U.date AND C.period = U.period
+        WHERE C.cumulative_bid_volumn >= U.demand_mw
+    ),
+    ranked_data AS (
+        SELECT *, ROW_NUMBER() OVER (PARTITION BY date, period ORDER BY cumulative_bid_volumn, bid_price) AS rn
+        FROM joined_data
+    )
+    SELECT date, period, demand_mw, bid_price AS final_bid_price, cumulative_bid_volumn
+    FROM ranked_data
+    WHERE rn = 1
+    ORDER BY date, period
+"""
+
+
+class TestEveryDatetimeDemand(unittest.TestCase):
+    def test_curve_search_matches_join(self):
+        con = duckdb.connect()
+        # curves of 1 to 200 offers with zero volume steps and repeated prices
+        con.execute("""
+            CREATE TABLE merit_validation AS
+            SELECT DATE '2023-01-01' + d::INT AS date, p::INT AS period,
+                   (hash(d, p, o) % 40)::DOUBLE / 2 AS bid_price,
+                   CASE WHEN o % 7 = 3 THEN 0.0 ELSE (hash(o, p) % 50)::DOUBLE END AS bid_volumn
+            FROM range(3) t1(d), range(1, 49) t2(p), range(200) t3(o)
+            WHERE o < 1 + (d * 48 + p) * 37 % 200
+        """)
+        con.execute(f"CREATE TABLE {CUMULATIVE_TABLE} AS " + cumulative_sql.format(where=""))
+        con.execute(f"CREATE TABLE {CURVES_TABLE} AS " + curves_sql.format(where=""))
+        # demands from 0 to beyond the whole curve, some exactly on a step, one period without a demand
+        con.execute(f"""
+            CREATE TABLE user_validation AS
+            SELECT c.date::TIMESTAMP AS date, c.period,
+                   CASE WHEN c.period = 7 THEN NULL
+                        WHEN c.period % 5 = 0 THEN c.cumulative_volumes[len(c.cumulative_volumes) // 2 + 1]
+                        ELSE c.cumulative_volumes[-1] * ((hash(c.date, c.period) % 130)::DOUBLE / 100) END AS demand_mw
+            FROM {CURVES_TABLE} c
+        """)
+        expected = con.execute(legacy_every_datetime_demand_sql).fetchall()
+        result = con.execute(every_datetime_demand_sql).fetchall()
+        self.assertEqual(result, expected)
+        # some demands exceed their curve and have no price
+        self.assertLess(len(result), 3 * 48 - 3)
+        self.assertGreater(len(result), 3 * 48 // 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'duckdb_script'))
+import given_datetime_final_price
+from db_connection import ConnectionManager, ThreadCursor
+from given_datetime_final_price import refresh_cumulative_table, CUMULATIVE_TABLE, CURVES_TABLE
+
+
+class TestRefreshCumulativeTable(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.manager = ConnectionManager(path=os.path.join(self.tmp.name, "test.duckdb"))
+        self.con = self.manager.cursor()
+        # three offers in every period of two days, in random price order
+        self.con.execute("""
+            CREATE TABLE merit_validation AS
+            SELECT DATE '2023-01-01' + d::INT AS date, p::INT AS period,
+                   ((p * 7 + s * 13) % 10)::DOUBLE AS bid_price, (10 + s)::DOUBLE AS bid_volumn
+            FROM range(2) r(d), range(1, 49) q(p), range(3) t(s)
+        """)
+        patcher = mock.patch.multiple(given_datetime_final_price, manager=self.manager, con=ThreadCursor(self.manager))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.manager.close()
+        self.tmp.cleanup()
+
+    def rows(self, table=CUMULATIVE_TABLE):
+        # every row except date 1 period 1, which carries the marker of an untouched period
+        return self.con.execute(f"""
+            SELECT * FROM {table} WHERE NOT (date = DATE '2023-01-01' AND period = 1) ORDER BY ALL
+        """).fetchall()
+
+    def test_refreshed_dates_match_full_rebuild(self):
+        refresh_cumulative_table()
+        self.assertEqual(self.con.execute(f"SELECT count(*) FROM {CUMULATIVE_TABLE}").fetchone()[0], 2 * 48 * 3)
+
+        # a re-cleansed day and a new day; the marked period of the untouched day must survive the refresh
+        self.con.execute(f"UPDATE {CUMULATIVE_TABLE} SET cumulative_bid_volumn = -1 WHERE date = DATE '2023-01-01' AND period = 1")
+        self.con.execute("UPDATE merit_validation SET bid_volumn = bid_volumn * 2 WHERE date = DATE '2023-01-02' AND period = 5")
+        self.con.execute("INSERT INTO merit_validation SELECT date + 2, period, bid_price, bid_volumn FROM merit_validation WHERE date = DATE '2023-01-01'")
+        refresh_cumulative_table(dates=["2023-01-02"])
+        refreshed, refreshed_curves = self.rows(), self.rows(CURVES_TABLE)
+        marked = self.con.execute(f"SELECT count(*) FROM {CUMULATIVE_TABLE} WHERE cumulative_bid_volumn = -1").fetchone()[0]
+        self.assertEqual(marked, 3)
+
+        self.con.execute(f"DROP TABLE {CUMULATIVE_TABLE}")
+        refresh_cumulative_table()
+        self.assertEqual(refreshed, self.rows())
+        self.assertEqual(refreshed_curves, self.rows(CURVES_TABLE))
+        self.assertEqual(len(refreshed_curves), 3 * 48 - 1)
+        self.assertEqual(len(refreshed), 3 * 48 * 3 - 3)
+    def test_non_finite_demand_rejected(self):
+        refresh_cumulative_table()
+        final_price = given_datetime_final_price.given_datetime_final_price
+        self.assertEqual(final_price("2023-01-01", 1, 20), 3.0)
+        for demand in (float("nan"), float("inf")):
+            with self.subTest(demand=demand), self.assertRaises(ValueError):
+                final_price("2023-01-01", 1, demand)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from datetime import date
+from unittest import mock
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'duckdb_script'))
+import load_file
+import duckdb_cleansed_file
+from db_connection import ConnectionManager, ThreadCursor
+from load_file import load_files_into_db, UNDATED
+
+USEP_HEADER = "INFORMATION TYPE,DATE,PERIOD,USEP ($/MWh),LCP ($/MWh),DEMAND (MW),TCL (MW)\n"
+MERIT_HEADER = "Date,Period,Lowest to Highest Offer Price ($/MWh),Total Offer Capacity At Specified Offer Price (MW)\n"
+
+
+def usep_rows(day, demand=5000.0):
+    return "".join(f"USEP,{day:02d} Jan 2023,{period},150.5,150.0,{demand + period},0\n" for period in range(1, 49))
+
+
+class TestLoadFilesIntoDb(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.raw_dir = os.path.join(self.tmp.name, "raw_data")
+        os.makedirs(self.raw_dir)
+        self.usep_path = os.path.join(self.raw_dir, "USEP_Jan-2023.csv")
+        with open(self.usep_path, "w") as f:
+            f.write(USEP_HEADER + usep_rows(1) + usep_rows(2))
+        with open(os.path.join(self.raw_dir, "DelayedOfferStacks_Jan-2023.csv"), "w") as f:
+            f.write("Delayed Offer Stacks\nEnergy\n" + MERIT_HEADER)
+            f.writelines(f"{day:02d}-Jan-2023,{period},{step * 10.5},100\n" for day in (1, 2) for period in range(1, 49) for step in range(3))
+
+        self.manager = ConnectionManager(path=os.path.join(self.tmp.name, "test.duckdb"))
+        patcher = mock.patch.multiple(load_file, manager=self.manager, con=ThreadCursor(self.manager))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.assertEqual(load_files_into_db(self.raw_dir), {date(2023, 1, 1), date(2023, 1, 2)})
+
+    def tearDown(self):
+        self.manager.close()
+        self.tmp.cleanup()
+
+    def count(self, table, where="true"):
+        return self.manager.cursor().execute(f"SELECT count(*) FROM {table} WHERE {where}").fetchone()[0]
+
+    def test_second_run_loads_nothing(self):
+        self.assertEqual(load_files_into_db(self.raw_dir), set())
+        self.assertEqual(self.count("RAW_USER_TABLE"), 96)
+        self.assertEqual(self.count("RAW_MERIT_TABLE"), 2 * 48 * 3)
+
+    def test_one_row_edit_replaces_its_date(self):
+        with open(self.usep_path, "w") as f:
+            f.write(USEP_HEADER + usep_rows(1) + usep_rows(2).replace(",5007.0,", ",6007.0,"))
+        self.assertEqual(load_files_into_db(self.raw_dir), {date(2023, 1, 2)})
+        self.assertEqual(self.count("RAW_USER_TABLE"), 96)
+        self.assertEqual(self.count("RAW_USER_TABLE", "\"DEMAND (MW)\" = 6007"), 1)
+
+    def test_renamed_file_and_moved_folder_do_not_duplicate(self):
+        os.rename(self.usep_path, os.path.join(self.raw_dir, "USEP_January-2023.csv"))
+        load_files_into_db(self.raw_dir)
+        self.assertEqual(self.count("RAW_USER_TABLE"), 96)
+        self.assertEqual(self.count("RAW_USER_TABLE", "source_file = 'USEP_January-2023.csv'"), 96)
+
+        moved_dir = shutil.move(self.raw_dir, os.path.join(self.tmp.name, "raw_data_moved"))
+        self.assertEqual(load_files_into_db(moved_dir), set())
+        self.assertEqual(self.count("RAW_USER_TABLE"), 96)
+        self.assertEqual(self.count("RAW_MERIT_TABLE"), 2 * 48 * 3)
+
+    def test_deleted_file_rows_removed(self):
+        os.remove(self.usep_path)
+        self.assertEqual(load_files_into_db(self.raw_dir), {date(2023, 1, 1), date(2023, 1, 2)})
+        self.assertEqual(self.count("RAW_USER_TABLE"), 0)
+        self.assertEqual(self.count("load_manifest"), 1)
+
+    def test_undated_rows_reported_and_recleansed(self):
+        patcher = mock.patch.multiple(duckdb_cleansed_file, manager=self.manager, con=ThreadCursor(self.manager),
+                                      export_query=mock.DEFAULT)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        duckdb_cleansed_file.cleansing_tables(tables=["user_validation"])
+        undated_row = "USEP,40 Jan 2023,1,150.5,150.0,5000,0\n"
+        with open(self.usep_path, "a") as f:
+            f.write(undated_row)
+        self.assertEqual(load_files_into_db(self.raw_dir), {UNDATED})
+        duckdb_cleansed_file.cleansing_tables(sorted({UNDATED}), tables=["user_validation"])
+        self.assertEqual(self.count("user_validation_quarantine"), 1)
+        self.assertEqual(self.count("user_validation"), 96)
+
+        # the row is fixed: its day is re-cleansed and the undated row leaves the quarantine
+        with open(self.usep_path, "w") as f:
+            f.write(USEP_HEADER + usep_rows(1) + usep_rows(2) + undated_row.replace("40 Jan", "03 Jan"))
+        dates = load_files_into_db(self.raw_dir)
+        self.assertEqual(dates, {UNDATED, date(2023, 1, 3)})
+        duckdb_cleansed_file.cleansing_tables(sorted(dates), tables=["user_validation"])
+        self.assertEqual(self.count("user_validation_quarantine"), 0)
+        self.assertEqual(self.count("user_validation"), 97)
+
+
+if __name__ == '__main__':
+    unittest.main()
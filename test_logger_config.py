@@ -0,0 +1,47 @@
+import unittest
+import logging
+import logging.handlers
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+import logger_config
+from logger_config import setup_logger, init_worker_logging
+
+
+def log_from_worker(value):
+    setup_logger('test_logger_config_worker').warning("worker value %s", value)
+    return os.getpid(), isinstance(logger_config._listener, logging.handlers.QueueListener)
+
+
+class TestSetupLogger(unittest.TestCase):
+    def test_single_shared_handler(self):
+        # Test every module logger hands records to the same queue handler
+        first = setup_logger('test_logger_config_a')
+        second = setup_logger('test_logger_config_b')
+        self.assertEqual(len(first.handlers), 1)
+        self.assertIs(first.handlers[0], second.handlers[0])
+        self.assertIs(setup_logger('test_logger_config_a'), first)
+
+    def test_args_rendered_when_logged(self):
+        # Test msg % args is rendered by the logging call, a later change of the logged object is not written
+        values = {'demand': 1}
+        record = logging.LogRecord('test_logger_config_c', logging.INFO, __file__, 0, "values: %s", (values,), None)
+        prepared = logger_config._get_queue_handler().prepare(record)
+        values['demand'] = 2
+        self.assertEqual(prepared.getMessage(), "values: {'demand': 1}")
+        self.assertIsNone(prepared.args)
+
+    def test_worker_records_go_to_parent_queue(self):
+        # Test a pool worker formats its records and sends them to the parent instead of opening the log file
+        log_queue = multiprocessing.Queue()
+        with ProcessPoolExecutor(1, initializer=init_worker_logging, initargs=(log_queue,)) as executor:
+            pid, own_listener = executor.submit(log_from_worker, 42).result()
+        record = log_queue.get(timeout=5)
+        self.assertFalse(own_listener)
+        self.assertEqual(record.process, pid)
+        self.assertEqual(record.getMessage(), "worker value 42")
+        self.assertIsNone(record.args)
+
+
+if __name__ == '__main__':
+    unittest.main()
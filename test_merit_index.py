@@ -0,0 +1,133 @@
+import unittest
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+from check_final_price import check_final_price, batch_check_final_price, batch_supply_at_price
+from util import cumulative_vol_for_certain_period
+from merit_index import MeritIndex, build_merit_index, build_merit_index_from_csv, PRICE_OK, UNKNOWN_PERIOD, DEMAND_EXCEEDS_CAPACITY
+
+
+class TestMeritIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.index_path = os.path.join(self.tmp_dir.name, "merit_index.bin")
+        # two periods with offers in random price order
+        index = pd.DatetimeIndex(["2023-01-01 00:00"] * 4 + ["2023-01-01 00:30"] * 3, name='datetime')
+        self.df = pd.DataFrame({
+            'bid_price': [30.0, 10.5, 50.0, 20.0, 7.0, 5.0, 9.0],
+            'bid_volumn': [100.0, 100.0, 200.0, 100.0, 10.0, 20.0, 30.0],
+        }, index=index)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_curve_sorted_by_price(self):
+        # Test each period is an ascending price curve with cumulative volume
+        index = MeritIndex.from_frame(self.df)
+        prices, cumulative_volumes = index.curve("2023-01-01", 1)
+        self.assertEqual(list(prices), [10.5, 20.0, 30.0, 50.0])
+        self.assertEqual(list(cumulative_volumes), [100.0, 200.0, 300.0, 500.0])
+
+    def test_memory_mapped_matches_pandas(self):
+        # Test lookups on the written file match check_final_price
+        build_merit_index(self.df, self.index_path)
+        index = MeritIndex.open(self.index_path)
+        self.assertIsInstance(index.prices, np.memmap)
+        curve, max_vol = cumulative_vol_for_certain_period(self.df.loc[pd.Timestamp("2023-01-01 00:00")])
+        for demand in (0, 100, 150, 300, 500):
+            with self.subTest(demand=demand):
+                self.assertEqual(index.clearing_price("2023-01-01", 1, demand), check_final_price(curve, demand, max_vol))
+        self.assertEqual(index.clearing_price("2023-01-01", 2, 25), 7.0)
+
+    def test_built_from_cleansed_csv(self):
+        # Test the index rebuilt from written cleansed output, split over two files, matches the in-memory one
+        paths = [os.path.join(self.tmp_dir.name, f"merit_{i}.csv") for i in (1, 2)]
+        self.df.iloc[:4].to_csv(paths[0])
+        self.df.iloc[4:].to_csv(paths[1])
+        index = build_merit_index_from_csv(paths, self.index_path)
+        expected = MeritIndex.from_frame(self.df)
+        self.assertTrue(os.path.exists(self.index_path))
+        for name in ('keys', 'offsets', 'prices', 'cumulative_volumes'):
+            np.testing.assert_array_equal(getattr(index, name), getattr(expected, name))
+
+    def test_demand_exceeds_max(self):
+        # Test when demand exceeds max volume
+        index = MeritIndex.from_frame(self.df)
+        with self.assertRaises(ValueError):
+            index.clearing_price("2023-01-01", 1, 501)
+
+    def test_unknown_period(self):
+        # Test a period that is not in the index
+        index = MeritIndex.from_frame(self.df)
+        with self.assertRaises(KeyError):
+            index.clearing_price("2023-01-02", 1, 10)
+
+    def test_period_out_of_range(self):
+        # Test periods 49 and 50 of the previous day are not read as periods 1 and 2
+        index = MeritIndex.from_frame(self.df)
+        for period in (0, 49, 50):
+            with self.subTest(period=period):
+                with self.assertRaises(KeyError):
+                    index.clearing_price("2022-12-31", period, 10)
+
+    def test_invalid_demand(self):
+        # Test NaN, infinite and negative demands
+        index = MeritIndex.from_frame(self.df)
+        for demand in (float('nan'), float('inf'), -1):
+            with self.subTest(demand=demand):
+                with self.assertRaises(ValueError):
+                    index.clearing_price("2023-01-01", 1, demand)
+
+    def test_clearing_prices_batch(self):
+        # Test a batch mixes good and bad queries without raising
+        index = MeritIndex.from_frame(self.df)
+        prices, errors = index.clearing_prices(
+            ["2023-01-01", "2023-01-01", "2023-01-01", "2023-01-01", "2023-01-02", "2023-01-01"],
+            [1, 1, 2, 1, 1, 0],
+            [150, 500, 25, 501, 10, 10],
+        )
+        self.assertEqual(list(prices[:3]), [20.0, 50.0, 7.0])
+        self.assertTrue(np.isnan(prices[3:]).all())
+        self.assertEqual(list(errors), [PRICE_OK, PRICE_OK, PRICE_OK, DEMAND_EXCEEDS_CAPACITY, UNKNOWN_PERIOD, UNKNOWN_PERIOD])
+
+    def test_batch_check_final_price(self):
+        # Test the batch api flags unparsable rows instead of failing the whole file
+        index = MeritIndex.from_frame(self.df)
+        queries = pd.DataFrame({
+            'date': ["2023-01-01", "not-a-date", "2023-01-01"],
+            'period': [1, 1, 1],
+            'demand': [300, 10, -5],
+        })
+        result = batch_check_final_price(index, queries)
+        self.assertEqual(result['final_price'].iloc[0], 30.0)
+        self.assertEqual(list(result['error']), ["ok", "unknown_period", "invalid_demand"])
+
+    def test_supply_at_prices(self):
+        # Test the inverse lookup: capacity up to the cap, the marginal offer and the next price step
+        df = pd.concat([self.df, pd.DataFrame({'bid_price': [50.0], 'bid_volumn': [40.0]},
+                                              index=pd.DatetimeIndex(["2023-01-01 00:00"], name='datetime'))])
+        index = MeritIndex.from_frame(df)
+        supply = index.supply_at_prices(["2023-01-01"] * 4 + ["2023-01-02"], [1, 1, 1, 2, 1], [25.0, 5.0, 30.0, 100.0, 25.0])
+        np.testing.assert_array_equal(supply['offered_volume'][:4], [200.0, 0.0, 300.0, 60.0])
+        self.assertEqual(list(supply['marginal_step']), [1, -1, 2, 2, -1])
+        np.testing.assert_array_equal(supply['marginal_price'][:4], [20.0, np.nan, 30.0, 9.0])
+        # both offers at 50 form the next step after 30
+        np.testing.assert_array_equal(supply['next_price'][:4], [30.0, 10.5, 50.0, np.nan])
+        np.testing.assert_array_equal(supply['price_headroom'][:3], [5.0, 5.5, 20.0])
+        np.testing.assert_array_equal(supply['next_step_volume'][:4], [100.0, 100.0, 240.0, np.nan])
+        self.assertEqual(list(supply['error']), [PRICE_OK] * 4 + [UNKNOWN_PERIOD])
+
+    def test_supply_matches_clearing_price(self):
+        # Test the capacity offered at a clearing price covers the demand that set it
+        index = MeritIndex.from_frame(self.df)
+        demands = np.array([0.0, 50.0, 100.0, 250.0, 500.0])
+        prices, _ = index.clearing_prices(["2023-01-01"] * 5, [1] * 5, demands)
+        supply = index.supply_at_prices(["2023-01-01"] * 5, [1] * 5, prices)
+        self.assertTrue((supply['offered_volume'] >= demands).all())
+        result = batch_supply_at_price(index, pd.DataFrame({'date': ["2023-01-01", "2023-01-01"], 'period': [1, 1], 'price': [20, "x"]}))
+        self.assertEqual(list(result['error']), ["ok", "invalid_price"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import os
+import sys
+import tempfile
+import threading
+import unittest
+from datetime import date
+from unittest import mock
+from pipeline import Stage, PipelineRunner, RAN, SKIPPED, FAILED, BLOCKED, DUCKDB_SCRIPT_DIR, duckdb_stages
+
+
+class TestPipelineRunner(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.state_path = self.path("state.json")
+        self.calls = []
+        self.write(self.path("raw.csv"), "a,b\n1,2\n")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmp.name, name)
+
+    @staticmethod
+    def write(path, text):
+        with open(path, "w") as f:
+            f.write(text)
+
+    def copy_stage(self, name, source, target, deps=()):
+        def run():
+            self.calls.append(name)
+            with open(source) as f:
+                self.write(target, f.read().upper())
+        return Stage(name, run, inputs=[source], outputs=[target], deps=deps)
+
+    def stages(self):
+        return [
+            self.copy_stage("cleanse", self.path("raw.csv"), self.path("clean.csv")),
+            self.copy_stage("report", self.path("clean.csv"), self.path("report.csv"), deps=["cleanse"]),
+        ]
+
+    def run_pipeline(self, **kwargs):
+        return PipelineRunner(self.stages(), state_path=self.state_path, **kwargs).run()
+
+    def test_skips_unchanged_inputs(self):
+        self.assertEqual(self.run_pipeline(), {"cleanse": RAN, "report": RAN})
+        self.assertEqual(self.run_pipeline(), {"cleanse": SKIPPED, "report": SKIPPED})
+        # a new mtime with the same content is not a change
+        os.utime(self.path("raw.csv"), (0, 0))
+        self.assertEqual(self.run_pipeline(), {"cleanse": SKIPPED, "report": SKIPPED})
+
+        self.write(self.path("raw.csv"), "a,b\n1,3\n")
+        self.assertEqual(self.run_pipeline(), {"cleanse": RAN, "report": RAN})
+        # a deleted output is rebuilt, its unchanged content leaves the next stage alone
+        os.remove(self.path("clean.csv"))
+        self.assertEqual(self.run_pipeline(), {"cleanse": RAN, "report": SKIPPED})
+        self.assertEqual(self.run_pipeline(force=True), {"cleanse": RAN, "report": RAN})
+
+    def test_failure_blocks_dependents(self):
+        def broken():
+            raise ValueError("bad raw file")
+        stages = [Stage("cleanse", broken), self.copy_stage("report", self.path("raw.csv"), self.path("report.csv"), deps=["cleanse"]),
+                  self.copy_stage("other", self.path("raw.csv"), self.path("other.csv"))]
+        results = PipelineRunner(stages, state_path=self.state_path).run()
+        self.assertEqual(results, {"cleanse": FAILED, "report": BLOCKED, "other": RAN})
+        self.assertNotIn("report", self.calls)
+
+    def test_independent_stages_run_concurrently(self):
+        barrier = threading.Barrier(2, timeout=5)
+        stages = [Stage("usep", barrier.wait), Stage("merit", barrier.wait)]
+        # each stage waits for the other, which only returns when both run at the same time
+        results = PipelineRunner(stages, state_path=self.state_path, workers=2).run()
+        self.assertEqual(results, {"usep": RAN, "merit": RAN})
+
+    def test_rejects_cycles(self):
+        stages = [Stage("a", print, deps=["b"]), Stage("b", print, deps=["a"])]
+        with self.assertRaises(ValueError):
+            PipelineRunner(stages, state_path=self.state_path)
+
+
+class TestDuckDBStages(unittest.TestCase):
+    def test_cumulative_refreshes_loaded_dates(self):
+        stages = {stage.name: stage for stage in duckdb_stages()}
+        sys.path.append(DUCKDB_SCRIPT_DIR)
+        import load_file
+        import given_datetime_final_price
+        with mock.patch.object(given_datetime_final_price, 'refresh_cumulative_table') as refresh:
+            # without a load in this run only the missing periods are added
+            stages["duckdb.cumulative"].run()
+            refresh.assert_called_once_with([])
+            loaded = {date(2023, 1, 2), date(2023, 1, 1)}
+            with mock.patch.object(load_file, 'load_files_into_db', return_value=loaded):
+                stages["duckdb.load"].run()
+            stages["duckdb.cumulative"].run()
+            refresh.assert_called_with([date(2023, 1, 1), date(2023, 1, 2)])
+
+
+if __name__ == '__main__':
+    unittest.main()
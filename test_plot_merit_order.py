@@ -0,0 +1,31 @@
+import unittest
+import pandas as pd
+from plot_merit_order import annotation_positions, period_input_hash
+
+
+class TestAnnotationPositions(unittest.TestCase):
+    def test_small_curve_labels_every_step(self):
+        self.assertEqual(list(annotation_positions(5, 20)), [0, 1, 2, 3, 4])
+
+    def test_large_curve_is_thinned(self):
+        # Test the labels are capped and keep the cheapest and most expensive step
+        positions = annotation_positions(500, 20)
+        self.assertLessEqual(len(positions), 20)
+        self.assertEqual(positions[0], 0)
+        self.assertEqual(positions[-1], 499)
+
+    def test_no_labels(self):
+        self.assertEqual(len(annotation_positions(500, 0)), 0)
+
+
+class TestPeriodInputHash(unittest.TestCase):
+    def test_hash_follows_offers_and_settings(self):
+        merit = pd.DataFrame({'bid_price': [10.0, 20.0], 'bid_volumn': [100.0, 50.0]})
+        changed = merit.assign(bid_volumn=[100.0, 60.0])
+        self.assertEqual(period_input_hash(merit, 20, 300), period_input_hash(merit.copy(), 20, 300))
+        self.assertNotEqual(period_input_hash(merit, 20, 300), period_input_hash(changed, 20, 300))
+        self.assertNotEqual(period_input_hash(merit, 20, 300), period_input_hash(merit, 10, 300))
+
+
+if __name__ == '__main__':
+    unittest.main()
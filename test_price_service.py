@@ -0,0 +1,93 @@
+import json
+import threading
+import unittest
+from http.client import HTTPConnection
+from http.server import ThreadingHTTPServer
+from unittest.mock import patch
+import pandas as pd
+from merit_index import MeritIndex
+from price_service import PriceService, make_handler
+
+
+class TestPriceRequestHandler(unittest.TestCase):
+    def setUp(self):
+        index = pd.DatetimeIndex(["2023-01-01 00:00"] * 3 + ["2023-01-01 00:30"] * 2, name='datetime')
+        df = pd.DataFrame({'bid_price': [30.0, 10.5, 20.0, 7.0, 5.0],
+                           'bid_volumn': [100.0, 100.0, 100.0, 10.0, 20.0]}, index=index)
+        # the service loads the test curves instead of the cleansed data folder
+        with patch('price_service.load_merit_index', return_value=MeritIndex.from_frame(df)), \
+                patch.object(PriceService, '_source_mtime', return_value=("merit_index.bin", 0.0)):
+            service = PriceService()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(service))
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def request(self, method, path, body=None, raw_body=None):
+        if raw_body is None and body is not None:
+            raw_body = json.dumps(body)
+        connection = HTTPConnection(*self.server.server_address, timeout=5)
+        try:
+            connection.request(method, path, body=raw_body)
+            response = connection.getresponse()
+            return response.status, json.loads(response.read())
+        finally:
+            connection.close()
+
+    def test_price(self):
+        status, body = self.request("GET", "/price?date=2023-01-01&period=1&demand=150")
+        self.assertEqual(status, 200)
+        self.assertEqual(body['final_price'], 20.0)
+
+    def test_bad_period(self):
+        # Test periods 0 and 49 are rejected instead of reading the neighbouring day
+        for period in (0, 49):
+            with self.subTest(period=period):
+                status, body = self.request("GET", f"/price?date=2023-01-02&period={period}&demand=10")
+                self.assertEqual(status, 400)
+                self.assertIn("period", body['error'])
+
+    def test_bad_demand(self):
+        for demand in ("nan", "inf", "-5", "abc"):
+            with self.subTest(demand=demand):
+                status, _ = self.request("GET", f"/price?date=2023-01-01&period=1&demand={demand}")
+                self.assertEqual(status, 400)
+
+    def test_unknown_date(self):
+        status, body = self.request("GET", "/price?date=2023-02-01&period=1&demand=10")
+        self.assertEqual(status, 400)
+        self.assertIn("No merit data", body['error'])
+
+    def test_batch(self):
+        queries = [
+            {'date': "2023-01-01", 'period': 1, 'demand': 150},
+            {'date': "2023-01-01", 'period': 2, 'demand': 25},
+            {'date': "2023-01-01", 'period': 1, 'demand': 301},
+            {'date': "2023-01-01", 'period': 49, 'demand': 10},
+        ]
+        status, body = self.request("POST", "/prices", queries)
+        self.assertEqual(status, 200)
+        self.assertEqual([row['final_price'] for row in body], [20.0, 7.0, None, None])
+        self.assertEqual([row['error'] for row in body], ["ok", "ok", "demand_exceeds_capacity", "unknown_period"])
+
+        status, _ = self.request("POST", "/prices", {'date': "2023-01-01"})
+        self.assertEqual(status, 400)
+
+    def test_reload_errors(self):
+        status, body = self.request("POST", "/reload", raw_body="{not json")
+        self.assertEqual(status, 400)
+        # both the index and the cleansed csv are gone, the loaded curves keep answering
+        with patch.object(PriceService, '_source_mtime', side_effect=FileNotFoundError("merit_cleansed.csv")):
+            status, body = self.request("POST", "/reload", True)
+        self.assertEqual(status, 503)
+        self.assertIn("merit_cleansed.csv", body['error'])
+        status, body = self.request("GET", "/price?date=2023-01-01&period=1&demand=150")
+        self.assertEqual(body['final_price'], 20.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import unittest
+import numpy as np
+import pandas as pd
+from merit_index import MeritIndex
+from scenario import demand_scenarios, scenario_prices
+
+
+class TestScenario(unittest.TestCase):
+    def setUp(self):
+        # two periods with offers in random price order
+        index = pd.DatetimeIndex(["2023-01-01 00:00"] * 4 + ["2023-01-01 00:30"] * 3, name='datetime')
+        self.merit_index = MeritIndex.from_frame(pd.DataFrame({
+            'bid_price': [30.0, 10.5, 50.0, 20.0, 7.0, 5.0, 9.0],
+            'bid_volumn': [100.0, 100.0, 200.0, 100.0, 10.0, 20.0, 30.0],
+        }, index=index))
+        self.base = pd.Series([200.0, 40.0], index=pd.DatetimeIndex(["2023-01-01 00:00", "2023-01-01 00:30"]), name='demand')
+
+    def test_demand_scenarios(self):
+        custom = pd.DataFrame({'peak': [450.0]}, index=pd.DatetimeIndex(["2023-01-01 00:00"]))
+        demands = demand_scenarios(self.base, pct=[10], mw=[-50], custom=custom)
+        self.assertEqual(list(demands.columns), ['base', '+10%', '-50MW', 'peak'])
+        np.testing.assert_allclose(demands.loc["2023-01-01 00:00"].to_numpy(), [200.0, 220.0, 150.0, 450.0])
+        # the custom series does not cover the second period
+        self.assertTrue(np.isnan(demands['peak'].iloc[1]))
+
+    def test_prices_match_single_lookups(self):
+        # Test every cell of the matrix matches a batch lookup of that scenario
+        demands = demand_scenarios(self.base, pct=np.linspace(-50, 200, 11), mw=[100])
+        prices, errors = scenario_prices(self.merit_index, demands)
+        self.assertEqual(prices.shape, demands.shape)
+        for scenario in demands.columns:
+            with self.subTest(scenario=scenario):
+                expected, _ = self.merit_index.clearing_prices(["2023-01-01"] * 2, [1, 2], demands[scenario])
+                np.testing.assert_array_equal(prices[scenario].to_numpy(), expected)
+        # period 2 only offers 60 MW
+        self.assertEqual(errors.loc["2023-01-01 00:30", '+100MW'], "demand_exceeds_capacity")
+        self.assertEqual(errors.loc["2023-01-01 00:00", 'base'], "ok")
+
+
+if __name__ == '__main__':
+    unittest.main()
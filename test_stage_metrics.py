@@ -0,0 +1,83 @@
+import os
+import json
+import tempfile
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+import stage_metrics
+from stage_metrics import stage, timed_stage, worker_call, worker_result
+
+
+def cleanse_in_worker(rows):
+    with stage("worker.cleanse") as run:
+        run.rows = rows
+        if rows < 0:
+            raise ValueError("negative rows")
+    return rows
+
+
+class TestStageMetrics(unittest.TestCase):
+    def setUp(self):
+        stage_metrics.reset()
+
+    def tearDown(self):
+        stage_metrics.reset()
+
+    def test_stage_records_rows_and_calls(self):
+        # Test repeated runs of one stage are summed
+        for rows in (10, 30):
+            with stage("read_csv.merit") as run:
+                run.rows = rows
+        entry = stage_metrics.report()['stages']['read_csv.merit']
+        self.assertEqual(entry['calls'], 2)
+        self.assertEqual(entry['rows'], 40)
+        self.assertGreater(entry['rows_per_second'], 0)
+
+    def test_timed_stage_keeps_function_and_counts_failures(self):
+        # Test the decorator keeps the wrapped name and records runs that raise
+        @timed_stage("lookup", rows=len)
+        def lookup(values):
+            if not values:
+                raise ValueError("empty")
+            return values
+
+        self.assertEqual(lookup.__name__, "lookup")
+        self.assertEqual(lookup([1, 2, 3]), [1, 2, 3])
+        with self.assertRaises(ValueError):
+            lookup([])
+        entry = stage_metrics.report()['stages']['lookup']
+        self.assertEqual((entry['calls'], entry['failures'], entry['rows']), (2, 1, 3))
+
+    def test_exports(self):
+        # Test the json report and the prometheus textfile carry every stage
+        with stage("sql.cumulative.create", rows=5):
+            pass
+        with tempfile.TemporaryDirectory() as tmp:
+            json_path = os.path.join(tmp, "metrics.json")
+            prom_path = os.path.join(tmp, "metrics.prom")
+            stage_metrics.write_json_report(json_path)
+            stage_metrics.write_prometheus_textfile(prom_path)
+            with open(json_path) as f:
+                self.assertEqual(json.load(f)['stages']['sql.cumulative.create']['rows'], 5)
+            with open(prom_path) as f:
+                text = f.read()
+        self.assertIn('pipeline_stage_rows_total{stage="sql.cumulative.create"} 5', text)
+        self.assertIn('# TYPE pipeline_stage_seconds_total counter', text)
+
+    def test_worker_stages_merged_into_parent(self):
+        # Test stages timed in pool workers reach the exporting process, failed tasks included
+        with stage("parent.read", rows=7):
+            pass
+        with ProcessPoolExecutor(2) as executor:
+            futures = [executor.submit(worker_call, cleanse_in_worker, rows) for rows in (10, 20, -1)]
+            self.assertEqual([worker_result(future) for future in futures[:2]], [10, 20])
+            with self.assertRaises(ValueError):
+                worker_result(futures[2])
+        stages = stage_metrics.report()['stages']
+        self.assertEqual((stages['worker.cleanse']['calls'], stages['worker.cleanse']['failures']), (3, 1))
+        self.assertEqual(stages['worker.cleanse']['rows'], 29)
+        # the parent's own stages are not sent back by the forked workers
+        self.assertEqual(stages['parent.read']['calls'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import os
+import sys
+import time
+import tempfile
+import unittest
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+# --help and argument errors must come back without loading the data stack;
+# measured around 0.1s, the budget leaves room for slow CI machines
+STARTUP_BUDGET_SECONDS = 0.5
+HEAVY_MODULES = ("pandas", "numpy", "matplotlib", "pyarrow")
+
+# run the script as __main__ and report which heavy packages were really loaded
+# (a lazy module has no submodules imported until it is first used)
+PROBE = """
+import sys, runpy
+sys.argv = sys.argv[1:]
+sys.path.insert(0, {repo!r})
+try:
+    runpy.run_path(sys.argv[0], run_name="__main__")
+except SystemExit:
+    pass
+loaded = sorted({{name.split('.')[0] for name in sys.modules if '.' in name}} & set({heavy!r}))
+sys.stderr.write("LOADED=" + ",".join(loaded) + "\\n")
+"""
+
+ENTRY_POINTS = (
+    ["check_final_price.py", "--help"],
+    ["check_final_price.py", "--date", "2023-13-01", "--demand", "1"],
+    ["check_final_price.py", "--date", "2023-01-01", "--demand", "-5"],
+    ["plot_merit_order.py", "--help"],
+    ["cleansed_file.py", "--help"],
+    ["clearing_engines.py", "--help"],
+    ["merit_index.py", "--help"],
+    ["pipeline.py", "--help"],
+    ["price_service.py", "--help"],
+    ["scenario.py", "--help"],
+    ["tail_prices.py", "--help"],
+)
+
+
+class TestStartup(unittest.TestCase):
+    def run_entry_point(self, args, cwd):
+        script = [os.path.join(REPO_DIR, args[0])] + args[1:]
+        probe = PROBE.format(repo=REPO_DIR, heavy=HEAVY_MODULES)
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, "-c", probe] + script, cwd=cwd, capture_output=True, text=True)
+        return time.perf_counter() - start, result
+
+    def test_help_and_bad_arguments_are_fast(self):
+        for args in ENTRY_POINTS:
+            with self.subTest(args=" ".join(args)), tempfile.TemporaryDirectory() as cwd:
+                elapsed = min(self.run_entry_point(args, cwd)[0] for _ in range(3))
+                _, result = self.run_entry_point(args, cwd)
+                loaded = result.stderr.rsplit("LOADED=", 1)[-1].strip()
+                self.assertEqual(loaded, "", f"{args[0]} loaded {loaded}")
+                self.assertLess(elapsed, STARTUP_BUDGET_SECONDS)
+                # no import-time I/O: nothing printed or written to the working directory
+                self.assertFalse(result.stdout.startswith("Current working directory"))
+                self.assertEqual(os.listdir(cwd), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import os
+import time
+import tempfile
+import unittest
+import pandas as pd
+from tail_prices import ClearingPriceTail
+
+MERIT_HEADER = "Delayed Offer Stacks\nEnergy\nDate,Period,Lowest to Highest Offer Price ($/MWh),Total Offer Capacity At Specified Offer Price (MW)\n"
+USEP_HEADER = "INFORMATION TYPE,DATE,PERIOD,USEP ($/MWh),LCP ($/MWh),DEMAND (MW),TCL (MW)\n"
+
+
+class TestClearingPriceTail(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.merit_path = os.path.join(self.tmp.name, "merit.csv")
+        self.usep_path = os.path.join(self.tmp.name, "usep.csv")
+        self.append(self.merit_path, MERIT_HEADER)
+        self.append(self.usep_path, USEP_HEADER)
+        self.tail = ClearingPriceTail(self.merit_path, self.usep_path)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    @staticmethod
+    def append(path, text):
+        with open(path, "a") as f:
+            f.write(text)
+
+    def test_period_priced_once_complete(self):
+        self.append(self.merit_path, "01-Jan-2023,1,30,100\n01-Jan-2023,1,10.5,100\n01-Jan-2023,1,20")
+        # the latest period can still grow
+        self.assertEqual(self.tail.poll(), [])
+
+        # the rest of the half-written line plus the USEP row completes period 1
+        self.append(self.merit_path, ",100\n")
+        self.append(self.usep_path, "USEP,01 Jan 2023,1,25.5,0,150,0\n")
+        results = self.tail.poll()
+        self.assertEqual(len(results), 1)
+        self.assertEqual(str(results[0]['datetime']), "2023-01-01 00:00:00")
+        self.assertEqual(results[0]['clearing_price'], 20.0)
+        self.assertEqual(results[0]['price_difference'], -5.5)
+        self.assertEqual(results[0]['max_capacity'], 300.0)
+        self.assertLess(results[0]['latency_ms'], 1000)
+
+        # period 2 waits for its USEP row, flushed at the end of the input
+        self.append(self.merit_path, "01-Jan-2023,2,5,50\n")
+        self.assertEqual(self.tail.poll(final=True), [])
+        self.append(self.usep_path, "USEP,40 Jan 2023,2,9,0,80,0\n")
+        results = self.tail.poll()
+        self.assertEqual(len(results), 1)
+        # the invalid date is repaired to the last valid one, like cleansed_usep_table
+        self.assertEqual(str(results[0]['datetime']), "2023-01-01 00:30:00")
+        self.assertIn("exceeds maximum capacity", results[0]['error'])
+
+    def test_later_period_or_idle_feed_completes_period(self):
+        tail = ClearingPriceTail(self.merit_path, self.usep_path, idle_timeout=0.05)
+        self.append(self.merit_path, "01-Jan-2023,1,10,100\n01-Jan-2023,2,20,100\n")
+        self.assertEqual(tail.poll(), [])
+        self.assertEqual(list(tail.curves), [pd.Timestamp("2023-01-01 00:00")])
+        time.sleep(0.06)
+        self.assertEqual(tail.poll(), [])
+        self.assertEqual(sorted(tail.curves), [pd.Timestamp("2023-01-01 00:00"), pd.Timestamp("2023-01-01 00:30")])
+
+    def test_old_periods_evicted(self):
+        self.append(self.merit_path, "01-Jan-2023,1,10,100\n")
+        self.append(self.usep_path, "USEP,01 Jan 2023,1,25.5,0,50,0\nUSEP,01 Jan 2023,2,25.5,0,50,0\n")
+        self.assertEqual(len(self.tail.poll()), 1)
+        self.assertEqual(len(self.tail.emitted), 1)
+        # two days later the priced period and the unmatched USEP row are forgotten
+        self.append(self.usep_path, "USEP,03 Jan 2023,1,25.5,0,50,0\n")
+        self.assertEqual(self.tail.poll(), [])
+        self.assertEqual(self.tail.emitted, set())
+        self.assertEqual(list(self.tail.usep_rows), [pd.Timestamp("2023-01-03 00:00")])
+        # late rows of a forgotten period are still recognised as late
+        self.append(self.merit_path, "01-Jan-2023,1,10,100\n")
+        self.assertEqual(self.tail.poll(final=True), [])
+        self.assertEqual(self.tail.curves, {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import unittest
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+from util import clean_mixed_date_column, cleansed_merit_table, generate_datetime_index, stream_cleansed_merit_table
+from util import compact_dtypes, widen_float32, cumulative_vol_for_certain_period, FLOAT32_TOLERANCE
+
+MERIT_HEADER = "Date,Period,Lowest to Highest Offer Price ($/MWh),Total Offer Capacity At Specified Offer Price (MW)\n"
+
+
+class TestCleanMixedDateColumn(unittest.TestCase):
+    def test_mixed_formats(self):
+        # Test the known raw formats are all parsed to the same datetime64 column
+        df = pd.DataFrame({'date': ["01 Jan 2023", "02-Jan-2023", "2023-01-03"]})
+        result = clean_mixed_date_column(df)
+        self.assertTrue(pd.api.types.is_datetime64_any_dtype(result['date']))
+        self.assertEqual(list(result['date']), list(pd.to_datetime(["2023-01-01", "2023-01-02", "2023-01-03"])))
+        self.assertEqual(result.attrs['repaired_dates'], 0)
+
+    def test_invalid_date_forward_filled(self):
+        # Test invalid dates ('40 Jan 2024') take the last valid date
+        df = pd.DataFrame({'date': ["01 Jan 2023", "40 Jan 2024", "40 Jan 2024", "02 Jan 2023"]})
+        result = clean_mixed_date_column(df)
+        self.assertEqual(list(result['date']), list(pd.to_datetime(["2023-01-01", "2023-01-01", "2023-01-01", "2023-01-02"])))
+        self.assertEqual(result.attrs['repaired_dates'], 2)
+
+    def test_last_valid_date_carried_in(self):
+        # Test a leading invalid date uses the date carried from a previous chunk
+        df = pd.DataFrame({'date': ["40 Jan 2024", "02 Jan 2023"]})
+        result = clean_mixed_date_column(df, last_valid_date="2023-01-01")
+        self.assertEqual(result['date'].iloc[0], pd.Timestamp("2023-01-01"))
+
+    def test_null_date_kept_null(self):
+        # Test null raw values are left null for the null checks
+        df = pd.DataFrame({'date': ["01 Jan 2023", None]})
+        result = clean_mixed_date_column(df)
+        self.assertTrue(pd.isna(result['date'].iloc[1]))
+        self.assertEqual(result.attrs['repaired_dates'], 0)
+
+
+class TestStreamCleansedMeritTable(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.merit_path = os.path.join(self.tmp_dir.name, "merit.csv")
+        self.output_path = os.path.join(self.tmp_dir.name, "merit_cleansed.csv")
+        with open(self.merit_path, "w") as f:
+            f.write("Delayed Offer Stacks\nEnergy\n" + MERIT_HEADER)
+            for day in (1, 2):
+                for period in range(1, 49):
+                    for step in range(5):
+                        # an invalid date right at the start of the second day
+                        date_str = "40-Jan-2024" if (day, period, step) == (2, 1, 0) else f"{day:02d}-Jan-2023"
+                        f.write(f"{date_str},{period},{step * 10.5},{100 + step}\n")
+            f.write("02-Jan-2023,48,42.0,104\n")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_matches_in_memory_cleansing(self):
+        # Test the chunked output is the same as cleansing the whole file at once
+        stats = stream_cleansed_merit_table(self.merit_path, self.output_path, chunksize=7)
+        streamed = pd.read_csv(self.output_path, index_col=0, parse_dates=True)
+        expected = generate_datetime_index(cleansed_merit_table(self.merit_path))
+        self.assertEqual(stats['rows'], len(expected))
+        self.assertEqual(stats['repaired_dates'], 1)
+        # the repaired row copies day 1 period 1, plus the explicit duplicate at the end
+        self.assertEqual(stats['duplicates'], 2)
+        self.assertTrue((streamed.index == expected.index).all())
+        self.assertTrue((streamed.values == expected.values).all())
+
+
+class TestCompactDtypes(unittest.TestCase):
+    def setUp(self):
+        self.df = pd.DataFrame({
+            'information type': ["USEP"] * 4,
+            'period': [1, 2, 47, 48],
+            'usep': [158.62, 147.58, 4500.0, -50.25],
+            'demand': [5539.761, 5443.353, 7012.5, 6000.125],
+        })
+
+    def test_compact_schema_and_memory_report(self):
+        result = compact_dtypes(self.df.copy(), name="user")
+        self.assertIsInstance(result['information type'].dtype, pd.CategoricalDtype)
+        self.assertEqual(result['period'].dtype, np.int8)
+        self.assertEqual(result['usep'].dtype, np.float32)
+        self.assertLess(result.attrs['memory_bytes']['after'], result.attrs['memory_bytes']['before'])
+        self.assertLessEqual((result['demand'].astype('float64') - self.df['demand']).abs().max(), FLOAT32_TOLERANCE)
+
+    def test_widen_round_trip_above_ten_thousand(self):
+        # Test values past 10^4 keep the digits float32 still resolves there
+        values = np.array([12345.678, 10000.001, 16383.999, 54321.5, 7012.5, 0.0, -12345.678])
+        widened = widen_float32(values.astype('float32'))
+        self.assertEqual(widened[0], 12345.678)
+        self.assertLessEqual(np.abs(widened - values).max(), FLOAT32_TOLERANCE)
+        result = compact_dtypes(pd.DataFrame({'demand': values}))
+        self.assertEqual(result['demand'].dtype, np.float32)
+        self.assertLessEqual(np.abs(widen_float32(result['demand'].to_numpy()) - values).max(), FLOAT32_TOLERANCE)
+
+    def test_out_of_tolerance_column_kept(self):
+        # Test a column float32 cannot hold within the tolerance stays float64
+        df = pd.DataFrame({'demand': [123456789.123]})
+        self.assertEqual(compact_dtypes(df)['demand'].dtype, np.float64)
+
+    def test_widened_curve_matches_float64(self):
+        # Test the cumulative curve of compact offers equals the float64 one
+        merit = pd.DataFrame({'bid_price': [388.84, 12.5, 100.01], 'bid_volumn': [123.4, 2500.7, 88.8]})
+        expected, expected_max = cumulative_vol_for_certain_period(merit)
+        compact, compact_max = cumulative_vol_for_certain_period(merit.astype('float32'))
+        self.assertEqual(list(compact['bid_price']), list(expected['bid_price']))
+        self.assertEqual(compact_max, expected_max)
+        self.assertEqual(widen_float32(np.float32([388.84]))[0], 388.84)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,121 +1,329 @@
-import pandas as pd
 import re
 import os
 from datetime import datetime
-from functools import wraps
 import argparse
+from lazy_import import lazy_import
 from logger_config import setup_logger
+from stage_metrics import stage, timed_stage
+import columnar_store
+from data_quality import QualityChecker, MERIT_RULES, USEP_RULES
+# pandas and numpy load on first use, validate_date does not need them
+pd = lazy_import("pandas")
+np = lazy_import("numpy")
 logger = setup_logger('util')
 
-# to uniform the date column as YYYY-MM-DD, also handling invalid date
-def clean_mixed_date_column(df, date_col='date'):
-    cleaned_dates = []
-    last_valid_date = None
+# known raw date formats, tried in order as whole-column operations
+DATE_FORMATS = ("%d %b %Y", "%d-%b-%Y", "ISO8601")
 
-    for i, raw_date in enumerate(df[date_col]):
-        parsed_date = None
+# opt-in compact schema of the cleansed tables, see compact_dtypes
+CATEGORY_COLUMNS = ("information type",)
+INT8_COLUMNS = ("period",)
+FLOAT32_COLUMNS = ("bid_price", "bid_volumn", "usep", "lcp", "demand", "tcl")
+# largest absolute change float32 may make to a price ($/MWh) or volume (MW); any value below
+# 16384 in magnitude stays within it, a column with a larger round-trip error is kept as float64
+FLOAT32_TOLERANCE = 1e-3
 
-        # Try different formats: "%d %b %Y", "%d-%b-%Y"
-        for fmt in ("%d %b %Y", "%d-%b-%Y"):
-            try:
-                parsed_date = datetime.strptime(str(raw_date), fmt)
-                break
-            except ValueError:
-                continue
+# to uniform the date column as datetime64, also handling invalid date
+@timed_stage("clean_mixed_date_column", rows=len)
+def clean_mixed_date_column(df, date_col='date', last_valid_date=None):
+    """
+    Args:
+        df: DataFrame with a raw date column in mixed formats
+        date_col: name of the date column
+        last_valid_date: date to carry into leading invalid rows (e.g. from a previous chunk)
+
+    Returns:
+        DataFrame with date_col as datetime64; the number of repaired rows is
+        stored in df.attrs['repaired_dates']
+    """
+    # only parse each distinct raw string once, then map back by code
+    codes, uniques = pd.factorize(df[date_col].astype("string"))
+    uniques = pd.Index(uniques.astype(object))
+    parsed = pd.Series(pd.NaT, index=range(len(uniques)), dtype="datetime64[ns]")
+
+    remaining = np.arange(len(uniques))
+    for fmt in DATE_FORMATS:
+        if len(remaining) == 0:
+            break
+        attempt = pd.to_datetime(uniques[remaining], format=fmt, errors='coerce')
+        ok = ~attempt.isna()
+        parsed.iloc[remaining[ok]] = attempt[ok]
+        remaining = remaining[~ok]
+
+    # last resort for any other format pandas understands
+    if len(remaining) > 0:
+        attempt = pd.to_datetime(uniques[remaining], format='mixed', errors='coerce')
+        ok = ~attempt.isna()
+        parsed.iloc[remaining[ok]] = attempt[ok]
+        remaining = remaining[~ok]
+
+    if len(remaining) > 0:
+        logger.warning(f"found invalid dates {list(uniques[remaining])}, replace the value to the last valid date")
+
+    dates = pd.Series(parsed.to_numpy()[np.where(codes >= 0, codes, 0)], index=df.index)
+    # null raw values stay null, so the null checks downstream still catch them
+    dates[codes < 0] = pd.NaT
+    invalid = (codes >= 0) & np.isin(codes, remaining)
+    repaired = int(invalid.sum())
+
+    # Handle invalid date ('40 Jan 2024'): fallback to previous valid date
+    if repaired:
+        valid = dates.where(~invalid)
+        if last_valid_date is not None and invalid[0]:
+            valid.iloc[0] = pd.Timestamp(last_valid_date)
+        dates = dates.where(~invalid, valid.ffill())
+        logger.warning(f"repaired {repaired} rows with invalid date in column {date_col}")
+
+    df[date_col] = dates
+    df.attrs['repaired_dates'] = repaired
+    return df
+
+# standardize column name, e.g. "Lowest to Highest Offer Price ($/MWh)" -> "lowest to highest offer price"
+def standardize_columns(columns):
+    return [re.sub(r"\s*\(.*?\)", "", col).strip().lower() for col in columns]
 
-        # Handle invalid date ('40 Jan 2024')
-        if not parsed_date:
-            try:
-                parsed_date = pd.to_datetime(raw_date, errors='raise')
-            except Exception:
-                logger.warning(f"found invalid date {parsed_date}, replace the value to the last valid date, ")
-                parsed_date = last_valid_date  # fallback to previous
+# keep numeric format and rename the merit columns
+def convert_merit_columns(df_merit):
+    df_merit['lowest to highest offer price'] = pd.to_numeric(df_merit['lowest to highest offer price'], errors='coerce')
+    df_merit['total offer capacity at specified offer price'] = pd.to_numeric(df_merit['total offer capacity at specified offer price'], errors='coerce')
+    # Changing column name
+    df_merit = df_merit.rename(columns = {'lowest to highest offer price': "bid_price"})
+    df_merit = df_merit.rename(columns = {'total offer capacity at specified offer price': "bid_volumn"})
+    return df_merit
 
-        cleaned_dates.append(parsed_date)
-        last_valid_date = parsed_date
+# column cleaning of raw merit rows, shared by the whole-file read and the tail mode
+def clean_merit_frame(df_merit, last_valid_date=None):
+    df_merit.columns = standardize_columns(df_merit.columns)
+    # cleaning and parsing date column
+    df_merit = clean_mixed_date_column(df_merit, last_valid_date=last_valid_date)
+    return convert_merit_columns(df_merit)
 
-    # Set the cleaned column with desired format
-    df[date_col] = [d.strftime("%d-%b-%Y") if pd.notnull(d) else np.nan for d in cleaned_dates]
+# column cleaning of raw USEP rows, shared by the whole-file read and the tail mode
+def clean_usep_frame(df_usep, last_valid_date=None):
+    df_usep.columns = standardize_columns(df_usep.columns)
+    df_usep = clean_mixed_date_column(df_usep, last_valid_date=last_valid_date)
+    df_usep['demand'] = pd.to_numeric(df_usep['demand'], errors='coerce')
+    df_usep['usep'] = pd.to_numeric(df_usep['usep'], errors='coerce')
+    df_usep['lcp'] = pd.to_numeric(df_usep['lcp'], errors='coerce')
+    df_usep['tcl'] = pd.to_numeric(df_usep['tcl'], errors='coerce')
+    return df_usep
+
+# shrink a cleansed table: categorical information type, int8 period, float32 prices and volumes
+def compact_dtypes(df, name="table"):
+    """
+    Args:
+        df: cleansed DataFrame, before or after generate_datetime_index
+        name: table name used in the memory report
+
+    Returns:
+        DataFrame with compact dtypes; the memory used before and after is logged and
+        stored in df.attrs['memory_bytes']
+
+    float32 keeps 6 to 9 significant digits, a column is only made float32 when its values
+    come back through widen_float32 within FLOAT32_TOLERANCE; the clearing lookups widen
+    them back and sum the cumulative volumes in float64.
+    """
+    before = int(df.memory_usage(deep=True).sum())
+    for col in CATEGORY_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].astype("category")
+    for col in INT8_COLUMNS:
+        if col in df.columns and df[col].between(-128, 127).all():
+            df[col] = df[col].astype("int8")
+    for col in FLOAT32_COLUMNS:
+        if col in df.columns and df[col].dtype == "float64":
+            compact = df[col].astype("float32")
+            error = np.nanmax(np.abs(widen_float32(compact.to_numpy()) - df[col].to_numpy()), initial=0.0)
+            if error > FLOAT32_TOLERANCE:
+                logger.warning("%s column %s kept as float64, float32 error %s exceeds %s", name, col, error, FLOAT32_TOLERANCE)
+                continue
+            df[col] = compact
+    after = int(df.memory_usage(deep=True).sum())
+    df.attrs['memory_bytes'] = {'before': before, 'after': after}
+    logger.info("%s memory %.2f MB -> %.2f MB with compact dtypes", name, before / 2**20, after / 2**20)
     return df
 
-def cleansed_merit_table(merit_file_path):
+# float32 -> float64 at the shortest decimal that reads back as the same float32 (like repr of a float32),
+# so 388.84 does not come back as 388.8399963 and 12345.678 not as 12345.68
+def widen_float32(values):
+    values = np.asarray(values)
+    if values.dtype != np.float32:
+        return values
+    x = values.astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        exponent = np.floor(np.log10(np.abs(x)))
+    exponent = np.where(np.isfinite(exponent), exponent, 0)
+    widened = x.copy()
+    pending = np.isfinite(x) & (x != 0)
+    # float32 holds 6 to 9 significant digits depending on the magnitude; 9 always read back
+    for digits in (6, 7, 8, 9):
+        decimals = digits - 1 - exponent
+        # scale by exact powers of ten either way, so the rounded integer maps back to the nearest float64
+        up = 10.0 ** np.maximum(decimals, 0)
+        down = 10.0 ** np.maximum(-decimals, 0)
+        rounded = np.round(x * up / down) * down / up
+        found = pending & (rounded.astype(np.float32) == values)
+        widened[found] = rounded[found]
+        pending &= ~found
+    return widened
+
+# read a cleansed csv written by cleansed_file, with its datetime index
+def read_cleansed_table(path, compact=False):
+    with stage("read_csv.cleansed") as run:
+        df = pd.read_csv(path, index_col=0, parse_dates=True)
+        run.rows = len(df)
+    return compact_dtypes(df, name=path) if compact else df
+
+def cleansed_merit_table(merit_file_path, compact=False, quarantine_path=None):
+    """
+    Args:
+        merit_file_path: raw DelayedOfferStacks csv file
+        compact: return compact dtypes (see compact_dtypes)
+        quarantine_path: csv file for the rows breaking a data_quality.MERIT_RULES rule
+
+    Returns:
+        cleaned DataFrame without the quarantined rows, the rule counts are stored in
+        df.attrs['quality']; None on failure
+    """
     try:
         if not os.path.exists(merit_file_path):
             logger.error(f"File not found: {merit_file_path}")
             return
     
-        df_merit = pd.read_csv(merit_file_path, skiprows=2)
-        # standardize column name
-        df_merit.columns = [re.sub(r"\s*\(.*?\)", "", col).strip().lower() for col in df_merit.columns]
-        # cleaning and parsing date column
-        df_merit = clean_mixed_date_column(df_merit)
-        # keep numeric format
-        df_merit['lowest to highest offer price'] = pd.to_numeric(df_merit['lowest to highest offer price'], errors='coerce')
-        df_merit['total offer capacity at specified offer price'] = pd.to_numeric(df_merit['total offer capacity at specified offer price'], errors='coerce')
-        # Changing column name
-        df_merit = df_merit.rename(columns = {'lowest to highest offer price': "bid_price"})
-        df_merit = df_merit.rename(columns = {'total offer capacity at specified offer price': "bid_volumn"})
+        with stage("read_csv.merit") as run:
+            df_merit = pd.read_csv(merit_file_path, skiprows=2)
+            run.rows = len(df_merit)
+        df_merit = clean_merit_frame(df_merit)
         logger.info("merit table columns cleaned and converted.")
 
-        # Warnings: check if any value is null or duplicated row
-        total_nulls = df_merit.isnull().sum().sum()
-        if total_nulls > 0:
-            msg = f"Detected {total_nulls} missing/null values in the merit dataframe."
-            logger.error(msg)
-            raise ValueError(msg)
-
-        if df_merit.duplicated().any():
-            logger.warning("Duplicated rows found in the merit dataframe.")
+        # bad rows go to the quarantine file, the rest of the file is kept
+        with stage("validate.merit", rows=len(df_merit)):
+            checker = QualityChecker(MERIT_RULES, "merit", quarantine_path)
+            df_merit = checker.check(df_merit)
+            checker.log_summary()
+        df_merit.attrs['quality'] = checker.summary()
 
-        return df_merit
+        return compact_dtypes(df_merit, name="merit") if compact else df_merit
         
     except Exception as e:
         logger.error(f"Unexpected error: {str(e)} in the merit dataframe")
         return None
 
-def cleansed_usep_table(usep_file_path):
+# streaming version of cleansed_merit_table + generate_datetime_index for files too big for memory
+@timed_stage("stream_cleansed_merit_table", rows=lambda stats: stats['rows'])
+def stream_cleansed_merit_table(merit_file_path, output_path, chunksize=200_000, store_root=None, compact=False, quarantine_path=None):
+    """
+    Args:
+        merit_file_path: raw DelayedOfferStacks csv file
+        output_path: cleansed csv file, written chunk by chunk with datetime index
+        chunksize: number of raw rows held in memory at once
+        store_root: also write each chunk to this date-partitioned parquet store
+        compact: write the store chunks with compact dtypes
+        quarantine_path: csv file for the rows breaking a data_quality.MERIT_RULES rule
+
+    Returns:
+        dict with rows, nulls, duplicates, repaired_dates and quarantined counts and the
+        data_quality summary under 'quality', or None on failure
+    """
+    try:
+        if not os.path.exists(merit_file_path):
+            logger.error(f"File not found: {merit_file_path}")
+            return
+
+        columns = None
+        last_valid_date = None
+        # keeps the row hashes of the latest dates across chunks, to count duplicates of earlier chunks
+        checker = QualityChecker(MERIT_RULES, "merit", quarantine_path)
+        stats = {'rows': 0, 'repaired_dates': 0}
+
+        if store_root:
+            columnar_store.clear_store(store_root)
+
+        reader = pd.read_csv(merit_file_path, skiprows=2, chunksize=chunksize)
+        for i, chunk in enumerate(reader):
+            # normalize headers once, reuse for every chunk
+            if columns is None:
+                columns = standardize_columns(chunk.columns)
+            chunk.columns = columns
+            chunk = clean_mixed_date_column(chunk, last_valid_date=last_valid_date)
+            chunk = convert_merit_columns(chunk)
+            if chunk['date'].notna().any():
+                last_valid_date = chunk['date'].dropna().iloc[-1]
+
+            stats['repaired_dates'] += chunk.attrs['repaired_dates']
+            chunk = checker.check(chunk)
+            stats['rows'] += len(chunk)
+
+            chunk = generate_datetime_index(chunk)
+            if compact:
+                chunk = compact_dtypes(chunk, name=f"merit chunk {i}")
+            chunk.to_csv(output_path, mode='w' if i == 0 else 'a', header=(i == 0))
+            if store_root:
+                # a date can span two chunks, so each chunk adds its own file to the partition
+                columnar_store.write_partitioned(chunk, store_root, basename_template=f"part-{i}-{{i}}.parquet", replace_dates=False)
+            logger.info("merit chunk %d cleansed, %d rows written so far", i, stats['rows'])
+
+        checker.log_summary()
+        quality = checker.summary()
+        stats['nulls'] = sum(count for name, count in quality['rules'].items() if name.endswith("_not_null"))
+        stats['duplicates'] = quality['rules']['duplicate_row']
+        stats['quarantined'] = quality['quarantined']
+        stats['quality'] = quality
+        return stats
+
+    except Exception as e:
+        logger.error(f"Unexpected error: {str(e)} in the merit dataframe")
+        return None
+
+def cleansed_usep_table(usep_file_path, compact=False, quarantine_path=None):
+    """
+    Args:
+        usep_file_path: raw USEP csv file
+        compact: return compact dtypes (see compact_dtypes)
+        quarantine_path: csv file for the rows breaking a data_quality.USEP_RULES rule
+
+    Returns:
+        cleaned DataFrame without the quarantined rows, the rule counts are stored in
+        df.attrs['quality']; None on failure
+    """
     try:
         if not os.path.exists(usep_file_path):
             logger.error(f"File not found: {usep_file_path}")
             return
 
-        df_usep = pd.read_csv(usep_file_path)
+        with stage("read_csv.user") as run:
+            df_usep = pd.read_csv(usep_file_path)
+            run.rows = len(df_usep)
 
-        df_usep.columns = [re.sub(r"\s*\(.*?\)", "", col).strip().lower() for col in df_usep.columns]
-        df_usep = clean_mixed_date_column(df_usep)
-        df_usep['demand'] = pd.to_numeric(df_usep['demand'], errors='coerce')
-        df_usep['usep'] = pd.to_numeric(df_usep['usep'], errors='coerce')
-        df_usep['lcp'] = pd.to_numeric(df_usep['lcp'], errors='coerce')
-        df_usep['tcl'] = pd.to_numeric(df_usep['tcl'], errors='coerce')
+        df_usep = clean_usep_frame(df_usep)
         logger.info("user table columns cleaned and converted.")
-        print(df_usep.head(5))
-
-        # Warnings: check if any value is null or duplicated row
-        total_nulls = df_usep.isnull().sum().sum()
-        if total_nulls > 0:
-            msg = f"Detected {total_nulls} missing/null values in the user dataframe."
-            logger.error(msg)
-            raise ValueError(msg)
+        logger.debug("user table sample:\n%s", df_usep.head(5))
 
-        if df_usep.duplicated().any():
-            logger.warning("Duplicated rows found in the user dataframe.")
+        # bad rows go to the quarantine file, the rest of the file is kept
+        with stage("validate.user", rows=len(df_usep)):
+            checker = QualityChecker(USEP_RULES, "user", quarantine_path)
+            df_usep = checker.check(df_usep)
+            checker.log_summary()
+        df_usep.attrs['quality'] = checker.summary()
 
-        return df_usep
+        return compact_dtypes(df_usep, name="user") if compact else df_usep
     
     except Exception as e:
         logger.error(f"Unexpected error: {str(e)}in the user dataframe.")
         return None 
     
+@timed_stage("generate_datetime_index", rows=len)
 def generate_datetime_index(df, date_col = 'date', period_col = 'period'):
     df[date_col] = pd.to_datetime(df[date_col], format='%d-%b-%Y')
     # based on the period; if period is 1 then time will be 00:30:00, 2 will be 1:00:00, so on so forth to create timestamp
-    df["time"] = pd.to_timedelta((df[period_col] - 1) * 30, unit='min')
+    df["time"] = pd.to_timedelta((df[period_col].astype('int64') - 1) * 30, unit='min')
     df['datetime'] = df[date_col] + df['time']
     df = df.set_index('datetime')
     df = df.drop(columns=[date_col, period_col, 'time'])
     return df
 
 # Select rows matching a specific date and time period
+@timed_stage("select_certain_period", rows=len)
 def select_certain_period(df, date_str, period, period_duration = '30min'):
     """
     Args:
@@ -128,25 +336,29 @@ def select_certain_period(df, date_str, period, period_duration = '30min'):
         Filtered DataFrame
     """
     date = pd.to_datetime(date_str).normalize()
-    print(date)
 
     if period_duration == '30min':
         time_offset = pd.to_timedelta((period-1)*30, unit='min')
-        logger.info(time_offset)
+        logger.debug("time offset %s", time_offset)
 
     else:
         raise ValueError("period_duration must be '30min'")
     
     target_timestamp = date + time_offset
-    print(target_timestamp)
-    print(df)
-    print(df.loc[target_timestamp])
-    return df.loc[target_timestamp]
+    selected = df.loc[target_timestamp]
+    # the rows are only rendered when debug logging is enabled
+    logger.debug("selected rows for %s:\n%s", target_timestamp, selected)
+    return selected
 
 
 # calculate the cumulative bid volumn for ceretain peiord
+@timed_stage("cumulative_vol_for_certain_period", rows=lambda result: len(result[0]))
 def cumulative_vol_for_certain_period(df): 
     plot_merit = pd.DataFrame(df).sort_values('bid_price', ascending=True)
+    # compact float32 offers are widened first, so the prices and sums match the float64 merit index
+    for col in ('bid_price', 'bid_volumn'):
+        if plot_merit[col].dtype == np.float32:
+            plot_merit[col] = widen_float32(plot_merit[col].to_numpy())
 
     logger.info("calculate the cumulative volumn")
     plot_merit['cumulative_volume'] = plot_merit['bid_volumn'].cumsum()